@@ -8,11 +8,28 @@
 #
 
 import argparse
+import atexit
 import json
+import math
+import sys
 from xml.dom.minidom import parseString
 from rtree import index
+from region_creator import region_map
+from multiprocessing import Pool
+from timeit import default_timer as timer
+from util import address_catalog
+from util import edge_query
+from util import geocode_stats
+from util import lookup_grid
+from util import name_index
+from util import round_trip
 from util.utils import haversine, on_segment, get_bounding_box, \
-get_closest_point, convert, point_dist_from_start
+get_closest_point, GeoTransform, point_dist_from_start, bbox, EARTH_RADIUS
+
+
+NEIGHBOURHOOD_SLACK = 50  # meters a trace's R-tree query box is grown by
+AREA_CHUNK = 4096  # edges clipped at a time by area queries
+NEAREST = 5
 
 
 def get_address_city(path, lat, lon, city):
@@ -24,31 +41,70 @@ def get_address_city(path, lat, lon, city):
         lon -- longitude (float)
         city -- name of city
     """
-    idx = index.Index(path + '/rtree')
+    stats = geocode_stats.STATS
+    sampled = stats.sample()
+    # the lookup grid answers most points without the R-tree
+    grid = lookup_grid.load(path)
+    if sampled:
+        start = timer()
+    candidates = grid.lookup(lat, lon) if grid is not None else None
 
-    candidates = list(idx.intersection(
-                get_bounding_box(lat, lon), objects=True
-            ))
+    if candidates is None:
+        stats.count('forward_rtree')
+        opened = timer()
+        idx = index.Index(path + '/rtree')
+        stats.load(path, 'rtree', opened)
+        # in R-tree order, the lookup grid lists edges in the same order
+        candidates = [can.object for can in idx.intersection(
+                    get_bounding_box(lat, lon), objects=True
+                )]
 
+    if sampled:
+        stats.time('forward_index', start, timer())
+    stats.query('forward', len(candidates), not candidates)
     if not candidates:
         print("No address")
         return (float('inf'), 'No address found :(')
 
-    close_points = [(get_closest_point(can.object[0], can.object[1],
-                        (lat, lon)), can.object[0], can.object[1],
-                        can.object[2], can.object[3]) for can in candidates]
+    if sampled:
+        start = timer()
+    orth_dist, address = closest_address(lat, lon, city, candidates)
+    if sampled:
+        stats.time('forward_geometry', start, timer())
+    print "Adress: " + address
+    return orth_dist, address
+
+
+def closest_address(lat, lon, city, candidates):
+    """ returns (orth_dist, address) of lat lon on the closest of the
+        candidate edges
+
+        Keyword arguments:
+        lat -- latitude (float)
+        lon -- longitude (float)
+        city -- name of city
+        candidates -- non empty list of edges as stored in the R-tree
+    """
+    close_points = [(get_closest_point(can[0], can[1], (lat, lon)), can)
+                    for can in candidates]
+
+    dist, close_point, edge = min([(haversine(close_point, (lat, lon)),
+                                    close_point, can)
+                                   for close_point, can in close_points],
+                                  key=lambda x: x[0])
+    return edge_address(lat, lon, city, dist, close_point, edge)
 
-    ainf = min([(haversine(close_point[0], (lat, lon)),
-                        close_point[0], close_point[1],
-                        close_point[2], close_point[3], close_point[4])
-                        for close_point in close_points], key=lambda x: x[0])
 
-    orth_dist = round(ainf[0]) / 5 + 65
-    meter = (haversine(ainf[1], ainf[2]) + ainf[4]) / 5
-    name = ainf[5]
+def edge_address(lat, lon, city, dist, close_point, edge):
+    """ returns (orth_dist, address) of lat lon, which is dist meters from
+        close_point on edge
+    """
+    orth_dist = round(dist) / 5 + 65
+    meter = (haversine(close_point, edge[0]) + edge[2]) / 5
+    name = edge[3]
 
-    a = ainf[2]
-    b = ainf[3]
+    a = edge[0]
+    b = edge[1]
     sign = ((b[0] - a[0])*(lon - b[1]) - (b[1] - a[1])*(lat - b[0]))
 
     if sign <= 0:
@@ -57,13 +113,301 @@ def get_address_city(path, lat, lon, city):
     else:
         meter = int(2 * round(meter/2) + 1)
 
-    print "Adress: " + str(str(meter) + str(chr(int(orth_dist)))
-                          + "." + name + "." + city)
-
     return (orth_dist, str(str(meter) + str(chr(int(orth_dist)))
                           + "." + name + "." + city))
 
 
+class TraceMatcher(object):
+    """ generates the addresses of the ordered lat lons of a GPS trace
+
+        Consecutive fixes of a trace are a few meters apart and share their
+        candidate edges, so the matcher keeps the candidates of the last
+        lookup grid cell, and those of one R-tree query grown by
+        NEIGHBOURHOOD_SLACK meters. The grid or the R-tree is only asked
+        again when a fix leaves them. The edge of the previous fix is tried
+        first, and candidates whose bounding box is farther than it are
+        skipped. Every fix gets the address get_address_city would give it.
+    """
+
+    def __init__(self, path, city, slack=NEIGHBOURHOOD_SLACK):
+        self.path = path
+        self.city = city
+        self.slack = slack
+        self.m_per_lat = math.radians(1) * EARTH_RADIUS
+        self.grid = lookup_grid.load(path)
+        self.idx = None
+        self.cell = None
+        self.cell_candidates = None
+        self.area = None
+        self.area_candidates = []
+        self.edge = None
+        self.stats = {'cell': 0, 'grid': 0, 'area': 0, 'rtree': 0}
+
+    def candidates(self, lat, lon):
+        """ returns the candidate edges of lat lon, as in get_address_city,
+            with their bounding boxes
+        """
+        if self.grid is not None:
+            cell = self.grid.cell_value(lat, lon)
+            if cell == self.cell:
+                self.stats['cell'] += 1
+                return self.cell_candidates
+            if cell != lookup_grid.FALLBACK:
+                self.stats['grid'] += 1
+                self.cell = cell
+                self.cell_candidates = [
+                    (bbox(edge[:2]), edge)
+                    for edge in self.grid.candidate_edges(cell)
+                ]
+                return self.cell_candidates
+
+        box = get_bounding_box(lat, lon)
+        if self.area is None or not (
+                self.area[0] <= box[0] and self.area[1] <= box[1] and
+                box[2] <= self.area[2] and box[3] <= self.area[3]):
+            self.stats['rtree'] += 1
+            if self.idx is None:
+                start = timer()
+                self.idx = index.Index(self.path + '/rtree')
+                geocode_stats.STATS.load(self.path, 'rtree', start)
+            self.area = get_bounding_box(
+                lat, lon, (lookup_grid.SEARCH_RADIUS + self.slack) / 1000.0
+            )
+            # any query returns its edges in the same relative order
+            self.area_candidates = [
+                (bbox(can.object[:2]), can.object)
+                for can in self.idx.intersection(self.area, objects=True)
+            ]
+        else:
+            self.stats['area'] += 1
+        # the edges the R-tree would return for box, in the same order
+        return [(edge_box, edge) for edge_box, edge in self.area_candidates
+                if edge_box[0] <= box[2] and box[0] <= edge_box[2] and
+                edge_box[1] <= box[3] and box[1] <= edge_box[3]]
+
+    def closest_edge(self, lat, lon, candidates):
+        """ returns (dist, close_point, edge) of the candidate that
+            closest_address would pick
+        """
+        m_per_lon = self.m_per_lat * math.cos(math.radians(lat))
+        order = list(range(len(candidates)))
+        for pos, (edge_box, edge) in enumerate(candidates):
+            if edge == self.edge:
+                order.insert(0, order.pop(pos))
+                break
+
+        best = None
+        for pos in order:
+            edge_box, edge = candidates[pos]
+            if best is not None:
+                # get_closest_point returns a point of the bounding box
+                north = max(edge_box[0] - lat, 0, lat - edge_box[2])
+                east = max(edge_box[1] - lon, 0, lon - edge_box[3])
+                if math.hypot(north * self.m_per_lat, east * m_per_lon) > \
+                        (best[0] + 1) * (1 + lookup_grid.DIST_SLACK):
+                    continue
+            close_point = get_closest_point(edge[0], edge[1], (lat, lon))
+            dist = haversine(close_point, (lat, lon))
+            # ties go to the first candidate, as with min
+            if best is None or dist < best[0] or \
+                    (dist == best[0] and pos < best[1]):
+                best = (dist, pos, close_point, edge)
+        self.edge = best[3]
+        return best[0], best[2], best[3]
+
+    def match(self, points):
+        """ yields (orth_dist, address) for every (lat, lon) of points, in
+            order, consuming points as it goes
+        """
+        stats = geocode_stats.STATS
+        for lat, lon in points:
+            sampled = stats.sample()
+            if sampled:
+                start = timer()
+            candidates = self.candidates(lat, lon)
+            if sampled:
+                stats.time('trace_index', start, timer())
+            stats.query('trace', len(candidates), not candidates)
+            if not candidates:
+                yield (float('inf'), 'No address found :(')
+            else:
+                if sampled:
+                    start = timer()
+                dist, close_point, edge = self.closest_edge(
+                    lat, lon, candidates
+                )
+                if sampled:
+                    stats.time('trace_geometry', start, timer())
+                yield edge_address(lat, lon, self.city, dist, close_point,
+                                   edge)
+
+
+def get_area_addresses(path, polygon):
+    """ yields (street, side, first meter, last meter) for the addresses of
+        the streets inside a polygon, a chunk of R-tree edges at a time
+
+        A street that leaves and enters the polygon has a range for every
+        part inside it, and so does a street split between chunks. Side
+        is 'even' or 'odd'.
+
+        Keyword arguments:
+        path -- path to data
+        polygon -- list of (lat, lon) corners, the last one joins the first
+    """
+    lats = [corner[0] for corner in polygon]
+    lons = [corner[1] for corner in polygon]
+    idx = index.Index(path + '/rtree')
+    chunk = []
+    for can in idx.intersection((min(lats), min(lons), max(lats), max(lons)),
+                                objects=True):
+        chunk.append(can.object)
+        if len(chunk) == AREA_CHUNK:
+            for street_range in area_ranges(chunk, polygon):
+                yield street_range
+            chunk = []
+    for street_range in area_ranges(chunk, polygon):
+        yield street_range
+
+
+def area_ranges(edges, polygon):
+    """ street ranges of the parts of edges inside polygon """
+    table, names = edge_query.edge_table(edges)
+    edge, t0, t1 = edge_query.polygon_intervals(table, polygon)
+    return edge_query.street_ranges(table, names, edge, t0, t1)
+
+
+def get_nearest_addresses(path, lat, lon, city, k=NEAREST):
+    """ returns (orth_dist, address) of lat lon on each of the k streets
+        closest to it, closest first
+
+        Keyword arguments:
+        path -- path to data
+        lat -- latitude (float)
+        lon -- longitude (float)
+        city -- name of city
+        k -- number of streets
+    """
+    idx = index.Index(path + '/rtree')
+    bounds = idx.bounds
+    half_side = lookup_grid.SEARCH_RADIUS
+    while True:
+        box = get_bounding_box(lat, lon, half_side / 1000.0)
+        # in R-tree order, so that ties go to the same edge as in
+        # get_address_city
+        edges = [can.object for can in idx.intersection(box, objects=True)]
+        table, names = edge_query.edge_table(edges)
+        dists, closest = edge_query.street_distances(table, names, lat, lon)
+        # a street this close to lat lon has an edge in the box
+        within = half_side * (1 - lookup_grid.SEARCH_SLACK)
+        if (dists <= within).sum() >= k or (
+                box[0] <= bounds[0] and box[1] <= bounds[1] and
+                box[2] >= bounds[2] and box[3] >= bounds[3]):
+            break
+        half_side *= 2
+
+    addresses = []
+    for edge in [edges[e] for e in closest[:k].tolist()]:
+        close_point = get_closest_point(edge[0], edge[1], (lat, lon))
+        addresses.append(edge_address(
+            lat, lon, city, haversine(close_point, (lat, lon)), close_point,
+            edge
+        ))
+    # orth_dist is rounded, the sort is stable
+    addresses.sort(key=lambda address: address[0])
+    return addresses
+
+
+def get_geo_transform(path, row, col):
+    """ builds the pixel to lat lon transform from the bounds in roads.osm
+
+        Keyword arguments:
+        path -- path to data
+        row -- height of the pixel image
+        col -- width of the pixel image
+    """
+    with open(path + '/roads.osm', 'r') as f:
+        for i in range(3):
+            osm = f.readline()
+    doc = parseString(osm)
+    bounds = doc.getElementsByTagName('bounds')[0]
+
+    return GeoTransform(bounds.getAttribute('minlat'),
+                        bounds.getAttribute('minlon'),
+                        bounds.getAttribute('maxlat'),
+                        bounds.getAttribute('maxlon'),
+                        row, col
+                        )
+
+
+def get_regions(path, lats, lons):
+    """ returns the region name of every lat lon, '' outside of the map
+
+        Keyword arguments:
+        path -- path to data
+        lats -- latitude or array of latitudes
+        lons -- longitude or array of longitudes
+    """
+    regions = region_map.RegionMap.load(path)
+    geo = get_geo_transform(path, *regions.shape)
+    x, y = geo.latlon_to_pixel(lats, lons)
+    return regions.region_names(x, y)
+
+
+def validate_city(path, spacing=round_trip.SPACING):
+    """ returns the round trip validation report of the city under path, see
+        util.round_trip
+
+        Keyword arguments:
+        path -- path to data, with a lookup grid
+        spacing -- meters between sample points
+    """
+    dim_road = json.loads(open(path + '/name_to_road.json').read())
+    geo = get_geo_transform(path, dim_road[0]['height'],
+                            dim_road[0]['width'])
+    matcher = TraceMatcher(path, '')
+
+    def fallback(lat, lon):
+        candidates = matcher.candidates(lat, lon)
+        if not candidates:
+            return None
+        dist, close_point, edge = matcher.closest_edge(lat, lon, candidates)
+        try:
+            address = edge_address(lat, lon, '', dist, close_point, edge)[1]
+        except ValueError:
+            # python 2 has no block letter past 955 m from the street
+            return None
+        meter, block, street, _ = name_index.parse(address)
+        return street, meter, ord(block)
+
+    return round_trip.validate(lookup_grid.load(path), dim_road[1], geo,
+                               spacing, fallback)
+
+
+def export_catalog(path):
+    """ writes the address catalog of the city under path, see
+        util.address_catalog, and returns its statistics
+    """
+    dim_road = json.loads(open(path + '/name_to_road.json').read())
+    geo = get_geo_transform(path, dim_road[0]['height'],
+                            dim_road[0]['width'])
+    return address_catalog.export(dim_road[1], geo, path)
+
+
+def export_catalogs(paths, workers=None):
+    """ writes the address catalogs of several cities in parallel
+
+        Keyword arguments:
+        paths -- paths to the data of every city
+        workers -- number of worker processes (defaults to cpu count)
+    """
+    pool = Pool(workers)
+    try:
+        return pool.map(export_catalog, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_lat_lon(path, meter, block, street):
     """ generates lat lon from address in the form 52b, nc17
 
@@ -76,37 +420,34 @@ def get_lat_lon(path, meter, block, street):
     meter = int(meter)
     orth_dist = (ord(block.upper()) - 64.5)*5
     street = street.upper()
+    stats = geocode_stats.STATS
+    sampled = stats.sample()
 
+    start = timer()
     ntr_str = open(path + '/name_to_road.json').read()
     dim_road = json.loads(ntr_str)
     dims = dim_road[0]
     row, col = dims['height'], dims['width']
     name_to_road = dim_road[1]
 
-    with open(path + '/roads.osm', 'r') as f:
-        for i in range(3):
-            osm = f.readline()
-    doc = parseString(osm)
-    bounds = doc.getElementsByTagName('bounds')[0]
-
-    convert(bounds.getAttribute('minlat'),
-                   bounds.getAttribute('minlon'),
-                   bounds.getAttribute('maxlat'),
-                   bounds.getAttribute('maxlon'),
-                   row, col
-                   )
+    geo = get_geo_transform(path, row, col)
+    stats.load(path, 'name_to_road', start)
     try:
         road = name_to_road[street]
     except:
+        stats.query('reverse', miss=True)
         print "Street " + street + " was not found on the current map."
         return None
-    prev = None
-    curr = (convert.x_to_lat(int(road[0][0])),
-            convert.y_to_lon(int(road[0][1])))
+    stats.query('reverse', len(road))
+    if sampled:
+        start = timer()
+    lats, lons = geo.pixel_to_latlon([int(p[0]) for p in road],
+                                     [int(p[1]) for p in road])
+    points = list(zip(lats.tolist(), lons.tolist()))
+    curr = points[0]
     dist = 0
     for i in range(len(road)-1):
-        next = (convert.x_to_lat(int(road[i+1][0])),
-                 convert.y_to_lon(int(road[i+1][1])))
+        next = points[i+1]
         edge_dist = haversine(curr, next)/float(5)
         dist += edge_dist
         if dist > meter:
@@ -115,6 +456,8 @@ def get_lat_lon(path, meter, block, street):
 
     lat, lon = point_dist_from_start(curr, next, meter - (dist - edge_dist),
                                 orth_dist, (meter % 2 != 0))
+    if sampled:
+        stats.time('reverse_geometry', start, timer())
     print "Lat, Lon: " + str(lat) + ", " + str(lon)
     return lat, lon
 
@@ -128,8 +471,76 @@ if __name__ == "__main__":
     ap.add_argument('-meter', '--meter', type=int, help='Meter along road')
     ap.add_argument('-block', '--block', type=str, help='Block from road (a, b, c, etc.)')
     ap.add_argument('-street', '--street', type=str, help='Name of street')
+    ap.add_argument('-region', '--region', action='store_true', help='Only find the region of the lat lon')
+    ap.add_argument('-trace', '--trace', type=str, help='File of "lat,lon" lines of a GPS trace, in order')
+    ap.add_argument('-complete', '--complete', type=str, help='Start of a robocode to complete, such as 388A.NA')
+    ap.add_argument('-check', '--check', type=str, help='File of robocodes to validate, one per line')
+    ap.add_argument('-area', '--area', type=float, nargs='+', help='minlat minlon maxlat maxlon of a box, or lat lon pairs of a polygon, to list the addresses of')
+    ap.add_argument('-nearest', '--nearest', type=int, help='Number of closest streets to address the lat lon on')
+    ap.add_argument('-validate', '--validate', action='store_true', help='Geocode sample points to robocodes and back and report the errors')
+    ap.add_argument('-spacing', '--spacing', type=float, default=round_trip.SPACING, help='Meters between the sample points of --validate')
+    ap.add_argument('-max_failed', '--max_failed', type=float, help='Exit with an error when a larger share of the addressed points fails the round trip')
+    ap.add_argument('-catalog', '--catalog', action='store_true', help='Write the catalog of every robocode with its lat lon')
+    ap.add_argument('-workers', '--workers', type=int, help='Number of cities to export catalogs of in parallel, defaults to the cpu count')
+    ap.add_argument('-stats', '--stats', type=str, help='Write the counters and timings of the geocoding queries to this json file')
+    ap.add_argument('-sample_every', '--sample_every', type=int, default=geocode_stats.SAMPLE_EVERY, help='Queries per timed query of --stats, 1 times all of them')
+    ap.add_argument('-cities', '--cities', nargs='+', help='city=path pairs to complete and validate robocodes of several cities')
     args = vars(ap.parse_args())
-    if args.get('lat') and args.get('lon'):
+    geocode_stats.STATS.sample_every = args['sample_every']
+    if args.get('stats'):
+        # also written when a command exits early
+        atexit.register(geocode_stats.STATS.dump, args['stats'])
+    if args.get('catalog'):
+        if args.get('cities'):
+            paths = [pair.split('=', 1)[1] for pair in args['cities']]
+        else:
+            paths = [args['path']]
+        for path, stats in zip(paths, export_catalogs(paths, args.get('workers'))):
+            print path + ": " + str(stats['rows']) + " robocodes on " + str(stats['streets']) + " streets"
+    elif args.get('validate'):
+        if lookup_grid.load(args['path']) is None:
+            print("Validation needs the lookup grid, build it with --lookup_cell_size.")
+            sys.exit(1)
+        report = validate_city(args['path'], args['spacing'])
+        round_trip.write_report(report, args['path'] + '/validation.json')
+        print json.dumps(report, indent=2, sort_keys=True)
+        failed = report['far'] / float(max(report['addressed'], 1))
+        if args.get('max_failed') is not None and failed > args['max_failed']:
+            sys.exit(1)
+    elif args.get('complete') or args.get('check'):
+        if args.get('cities'):
+            paths = dict(pair.split('=', 1) for pair in args['cities'])
+        else:
+            paths = {args['city']: args['path']}
+        robocodes = name_index.RobocodeIndex.load(paths)
+        if args.get('complete'):
+            for code in robocodes.complete(args['complete']):
+                print code
+        else:
+            with open(args['check']) as f:
+                codes = [line.strip() for line in f if line.strip()]
+            for code, problem in zip(codes, robocodes.check(codes)):
+                print code + ": " + (problem or "valid")
+    elif args.get('area'):
+        area = args['area']
+        if len(area) == 4:
+            area = [(area[0], area[1]), (area[0], area[3]),
+                    (area[2], area[3]), (area[2], area[1])]
+        else:
+            area = list(zip(area[::2], area[1::2]))
+        for street, side, first, last in get_area_addresses(args['path'], area):
+            print street + " " + side + ": " + str(first) + "-" + str(last)
+    elif args.get('lat') and args.get('lon') and args.get('nearest'):
+        for orth_dist, address in get_nearest_addresses(args['path'], args['lat'], args['lon'], args['city'], args['nearest']):
+            print address
+    elif args.get('trace'):
+        with open(args['trace']) as f:
+            points = (map(float, line.split(',')) for line in f if line.strip())
+            for orth_dist, address in TraceMatcher(args['path'], args['city']).match(points):
+                print address
+    elif args.get('lat') and args.get('lon') and args.get('region'):
+        print "Region: " + get_regions(args['path'], args['lat'], args['lon'])
+    elif args.get('lat') and args.get('lon'):
         get_address_city(args['path'], args['lat'], args['lon'], args['city'])
     elif args.get('meter') and args.get('block') and args.get('street'):
         get_lat_lon(args['path'], args['meter'], args['block'], args['street'])
@@ -15,7 +15,7 @@ import json
 import math
 import numpy as np
 from region_creator import compress_json
-from scipy.spatial import distance
+from region_creator import region_map
 import sys
 sys.path.insert(0,'../')
 
@@ -28,7 +28,7 @@ class Name_Changer:
     def __init__(self):
         self.name_to_road = {}
 
-    def give_names(self, id_to_road, color_to_name, inter_to_color):
+    def give_names(self, road_set, region_names, inter_xy, inter_region):
         """ populates the name_to_road json mapping road name to ordered pixels
             in the road
 
@@ -38,47 +38,35 @@ class Name_Changer:
             of each road along that axis for that particular region
 
             Keyword arguments:
-            id_to_road -- dict which maps road id to ordered pixels in road
-            color_to_name -- maps a color (region index) to name of region
-            inter_to_color -- dict which maps road intersection to its color
+            road_set -- road_set.RoadSet of all roads
+            region_names -- name of every region label
+            inter_xy -- array of the (x, y) pixel of every intersection
+            inter_region -- array of the region label of every intersection
         """
-        color_to_rids = {}
         orients = 8
         o_angle = 180 / float(orients)
 
-        # assign colors two character names
-        for color in color_to_name.keys():
-            color_to_rids[color] = []
-
-        # determine which color/region a road belongs to
-        for rid, road in id_to_road.items():
-            x, y, d = road[0]
-            for i in range(x - 2, x + 3):
-                for j in range(x - 2, x + 3):
-                    if (i, j) in inter_to_color:
-                        color = inter_to_color[(i, j)]
-            else:
-                color = min(
-                    inter_to_color.items(),
-                    key=lambda t: distance.euclidean(t[0], (x, y))
-                )[1]
-            # average road pixel is used for ordering roads
-            avg_pix = np.average(road, axis=0)
-            color_to_rids[color].append([rid, avg_pix])
-
-        index = 0
-        for color, roads in color_to_rids.items():
-            index += 1
-            gradients = [0 for i in range(orients)]
-            even_odd = [[], []]
+        # determine which region a road belongs to
+        road_region = road_regions(road_set, inter_xy, inter_region)
+        # average road pixel is used for ordering roads
+        avg_pix = road_set.means()
+        angles = road_angles(road_set) / float(o_angle)
+
+        # roads of each region, in road order
+        by_region = np.argsort(road_region, kind='mergesort')
+        bounds = np.searchsorted(
+            road_region[by_region], np.arange(len(region_names) + 1)
+        )
+        for region, region_name in enumerate(region_names):
+            roads = by_region[bounds[region]:bounds[region + 1]]
+            # roads without a direction are not named
+            roads = roads[angles[roads] != 0]
 
             # determine the directionality of the roads in a region
-            for road in roads:
-                angle = get_angle(road[0], id_to_road)
-                if angle:
-                    rid = road[0]
-                    avg_pix = road[1]
-                    gradients[int(round(angle / float(o_angle))) % orients] += 1
+            gradients = np.bincount(
+                np.round(angles[roads]).astype(np.int64) % orients,
+                minlength=orients
+            )
 
             sort_grad_ind = np.argsort(gradients)
             axis = [sort_grad_ind[-1], sort_grad_ind[-2]]
@@ -88,55 +76,52 @@ class Name_Changer:
 
             if (2 <= axis[0] <= 5):
                 axis[0], axis[1] = axis[1], axis[0]
-            # append roads to even_odd based on which direction they are closer
-            for road in roads:
-                angle = get_angle(road[0], id_to_road)
-                if angle:
-                    angle = angle / float(o_angle)
-                    rid = road[0]
-                    avg_pix = road[1]
-                    if mod_dist(angle, axis[0], orients) < \
-                       mod_dist(angle, axis[1], orients):
-                        even_odd[0].append((rid, avg_pix))
-                    else:
-                        even_odd[1].append((rid, avg_pix))
+            # split the roads by which direction they are closer to
+            closer = mod_dist(angles[roads], axis[0], orients) < \
+                mod_dist(angles[roads], axis[1], orients)
+            even_odd = [roads[closer], roads[~closer]]
 
             # for each axis order the roads and append to name_to_road
             for ind in range(2):
-                i = 10 + ind
-                rot_points = []
-                for rid, _avg_pix in sorted(
-                    even_odd[ind],
-                    key=lambda x: rotate(x[1], axis[ind] * o_angle)[0],
-                    reverse=True
+                key = rotate(avg_pix[even_odd[ind]].T, axis[ind] * o_angle)[0]
+                for i, rid in enumerate(
+                    even_odd[ind][np.argsort(-key, kind='mergesort')].tolist()
                 ):
-                    name = str(color_to_name.get(color)) + str(i)
-                    self.name_to_road[str(name)] = id_to_road[rid]
+                    name = str(region_name) + str(10 + ind + 2 * i)
+                    self.name_to_road[str(name)] = road_set.road(rid)
 
-                    for point in id_to_road[rid]:
-                        rot_p = rotate(point, axis[ind] * o_angle)
-                        rot_points.append(rot_p)
 
-                    i += 2
+def road_regions(road_set, inter_xy, inter_region):
+    """ returns the region of the intersection closest to the start of every
+        road, see region_map.NearestRegion
+
+        Keyword arguments:
+        road_set -- road_set.RoadSet of all roads
+        inter_xy -- array of the (x, y) pixel of every intersection
+        inter_region -- array of the region label of every intersection
+    """
+    nearest_region = region_map.NearestRegion(inter_xy, inter_region)
+    return nearest_region(road_set.point_at(0)[:, :2])
 
 
 def mod_dist(a, b, n):
     """ returns 'clock hand distance' between a, b, mod n
 
         Keyword arguments:
-        a -- number to find distance between
-        b -- number to find distance between
+        a -- number or array to find distance between
+        b -- number or array to find distance between
         n -- number to modulo by
     """
 
-    return min((a - b) % n, (b - a) % n)
+    return np.minimum((a - b) % n, (b - a) % n)
 
 
 def rotate(point, theta):
     """ rotate a point treated as vector from origin by theta degrees
 
         Keyword arguments:
-        point -- x, y point treated as 2d vector
+        point -- x, y point treated as 2d vector, or the x and y arrays of
+                 many points
         theta -- degrees from x axis
     """
     theta = math.radians(theta)
@@ -146,35 +131,44 @@ def rotate(point, theta):
     return np.dot(rot_mat, [point[0], point[1]])
 
 
-def get_angle(rid, id_to_road):
-    """ returns angle of road start and end points
+def road_angles(road_set):
+    """ returns the angle of the road start and end points for every road
+
+        The angle is 0 for roads of up to 4 pixels and for roads whose
+        start and end points are the same.
 
         Keyword arguments:
-        rid -- road id, key for id_to_road dict
-        id_to_road -- dict which maps road id to ordered pixels of road
+        road_set -- road_set.RoadSet of all roads
     """
-    road = id_to_road[rid]
-    angle = 0
-    if len(road) > 4:
-        start, end = road[1], road[-2]
+    angles = np.zeros(len(road_set))
+    roads = np.flatnonzero(road_set.lengths > 4)
+    start = road_set.point_at(1, roads)[:, :2].astype(np.float64)
+    end = road_set.point_at(-2, roads)[:, :2].astype(np.float64)
+
+    l = np.where((start[:, 0] <= end[:, 0])[:, None], start, end)
+    m = (start + end) / float(2)
+    n = m + [0, 100]
+
+    A = euclidean(l, m)
+    B = euclidean(n, m)
+    C = euclidean(l, n)
 
-        l = min(start, end, key=lambda p: p[0])
-        m = ((start[0] + end[0]) / float(2), (start[1] + end[1]) / float(2))
-        n = (m[0], m[1] + 100)
+    valid = (A != 0) & (B != 0)
+    A, B, C = A[valid], B[valid], C[valid]
+    cos = np.clip((A**2 + B**2 - C**2) / (2.0 * A * B), -1, 1)
+    angles[roads[valid]] = np.degrees(np.arccos(cos))
+    return angles
 
-        A = distance.euclidean((l[0], l[1]), m)
-        B = distance.euclidean(n, m)
-        C = distance.euclidean((l[0], l[1]), n)
 
-        if A == 0 or B == 0:
-            return None
-        angle = math.degrees(math.acos((A**2 + B**2 - C**2) / (2.0 * A * B)))
-    return angle
+def euclidean(p1, p2):
+    """ row wise euclidean distance of two arrays of x, y points """
+    delta = p1 - p2
+    return np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
 
 
-def main(inter_to_color, id_to_road, color_to_name, o_dir, r, c):
+def main(inter_xy, inter_region, road_set, region_names, o_dir, r, c):
     changer = Name_Changer()
-    changer.give_names(id_to_road, color_to_name, inter_to_color)
+    changer.give_names(road_set, region_names, inter_xy, inter_region)
 
     name_to_road = compress_json.main(changer.name_to_road)
     name_to_road = [{'height': r, 'width': c}, name_to_road]
@@ -31,23 +31,25 @@ def dist(p1, p2):
     return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
 
 
-def perpendicular_distance(point, p1, p2):
+def perpendicular_distance(points, p1, p2):
     """
-    Calculates perpendicular distance between the point and a line
+    Calculates perpendicular distance between the points and a line
     segment formed by the points p1 and p2
-    :param point: the point lying on the either side of the line segment
+    :param points: array of the points lying on the either side of the
+            line segment, one per row
     :param p1: point 1 constituting the line segment
     :param p2: point 2 constituting the line segment
+    :return: array of the distance of every point
     """
-    point = [point[0], point[1]]
-    p1 = [p1[0], p1[1]]
-    p2 = [p2[0], p2[1]]
-    if (p1 == p2):
-        return dist(point, p1)
+    x = np.asarray(points[:, 0], dtype=np.int64)
+    y = np.asarray(points[:, 1], dtype=np.int64)
+    x1, y1 = int(p1[0]), int(p1[1])
+    x2, y2 = int(p2[0]), int(p2[1])
+    if (x1, y1) == (x2, y2):
+        return np.sqrt((x1 - x) ** 2 + (y1 - y) ** 2)
     else:
-        n = abs((p2[0] - p1[0]) * (p1[1] - point[1]) -
-                (p1[0] - point[0]) * (p2[1] - p1[1]))
-        d = math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
+        n = np.abs((x2 - x1) * (y1 - y) - (x1 - x) * (y2 - y1))
+        d = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
         return n / d
 
 
@@ -56,7 +58,7 @@ def minimize_line_iter(line, eps, mask):
     Iterative version of the Algorithm.
     Recursive version will result in a stack overflow.
 
-    :param line: list containing the list of points(x, y)
+    :param line: array containing the points(x, y), one per row,
             to be minimized
     :param eps: threshold distance between two points
             to be considered as skeleton.
@@ -70,11 +72,12 @@ def minimize_line_iter(line, eps, mask):
         start, end = stack.pop()
         dmax = 0.0
         index = start
-        for idx in range(start + 1, end):
-            d = perpendicular_distance(line[idx], line[start], line[end])
-            if d > dmax:
-                dmax = d
-                index = idx
+        if end - start > 1:
+            d = perpendicular_distance(
+                line[start + 1:end], line[start], line[end]
+            )
+            index = start + 1 + int(np.argmax(d))
+            dmax = d[index - start - 1]
         if dmax > eps:
             stack.append((start, index))
             stack.append((index, end))
@@ -85,14 +88,15 @@ def minimize_line_iter(line, eps, mask):
 def minimize(points, eps):
     """
     Recursive line minimization algorithm.
-    :param line: list containing the list of points(x, y)
+    :param line: array containing the points(x, y), one per row,
             to be minimized
     :param eps: threshold distance between two points
             to be considered as skeleton.
     """
+    points = np.asarray(points)
     mask = np.zeros((len(points)), dtype=np.uint8)
     minimize_line_iter(points, eps, mask)
-    return [points[idx] for idx, ival in enumerate(mask) if mask[idx] > 0]
+    return points[mask > 0].tolist()
 
 
 def main(name2road_js):
@@ -103,6 +107,5 @@ def main(name2road_js):
     roads = name2road_js
     newroads = {}
     for i in roads:
-        road = roads[i]
-        newroads[i] = minimize(road, epsilon)
+        newroads[i] = minimize(roads[i], epsilon)
     return newroads
@@ -10,14 +10,25 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import itertools
+from multiprocessing import Pool
 import numpy as np
-import random
+import os
 from scipy import sparse
-from sklearn.cluster import SpectralClustering
+from scipy.spatial import cKDTree
+from sklearn.cluster import SpectralClustering, k_means
+from sklearn.manifold import spectral_embedding
+try:
+    from sklearn.cluster._spectral import discretize
+except ImportError:
+    from sklearn.cluster.spectral import discretize
 
 
-def create_graph_inverse(id_to_road, pixel_to_id):
+EMBEDDING_FILE = 'spectral_embedding.npz'
+
+
+def create_graph_inverse(road_set, pixel_index):
     """ returns graph representation of roads as adjacency matrix
 
         Creates an undirected weighted graph where nodes are intersections and
@@ -25,60 +36,49 @@ def create_graph_inverse(id_to_road, pixel_to_id):
         weighted by the distance between the two intersections.
         Constructs supernodes by merging nearby interesections.
         When looking for intersections, we follow a single road and look in a
-        2x2 window around the pixel for any other roads in the window.
+        5x5 window around the pixel for any other roads in the window.
         The window is a safeguard against T junctions where one road is separated
         by a single pixel from the road it forms a junction with.
 
         Keyword arguments:
-        r -- rows in pixel image
-        c -- columns in pixel image
-        id_to_road -- dict which maps road ids to the pixels in the road
-        pixel_to_id -- dict which maps all road pixels to their ids
+        road_set -- road_set.RoadSet of all roads
+        pixel_index -- road_loader.PixelIndex of all road pixels
     """
 
-    seen_inter = {}  # maps a road to a set of roads that it intersects
     adj_list = {}  # list of edges for a particular intersection
     inter_to_id = {}  # maps the intersection to a unique node id
     counter = itertools.count(start=0, step=1)
 
-    for curr_id in id_to_road.keys():
-        seen_inter[int(curr_id)] = set()
-
-    for curr_id, curr_road in id_to_road.items():
-        prev = (curr_road[0][0], curr_road[0][1])
+    for pos in range(len(road_set)):
+        curr_id = road_set.ids[pos]
+        curr_road = road_set.road(pos)
+        prev = (int(curr_road[0][0]), int(curr_road[0][1]))
         if prev not in adj_list:
             adj_list[prev] = set()
         if prev not in inter_to_id:
             count = next(counter)
             inter_to_id[prev] = count
 
-        for pixel in curr_road:
-            for i in range(-2, 3):
-                for j in range(-2, 3):
-                    new_id = pixel_to_id.get(
-                        "(" + str(pixel[0] + i) + ", " + str(pixel[1] + j) + ")"
-                    )
-
-                    if new_id:
-                        new_id = int(new_id)
-
-                    if new_id not in [None, int(curr_id)]:
-                        seen_inter[int(curr_id)].add(int(new_id))
-                        seen_inter[int(new_id)].add(int(curr_id))
-                        if (pixel[0], pixel[1]) not in adj_list:
-                            adj_list[(pixel[0], pixel[1])] = set()
-                        if prev not in inter_to_id:
-                            count = next(counter)
-                            inter_to_id[(pixel[0], pixel[1])] = count
-
-                        adj_list[(pixel[0], pixel[1])].add(prev)
-                        adj_list[prev].add((pixel[0], pixel[1]))
-                        prev = (pixel[0], pixel[1])
-                        if prev not in inter_to_id:
-                            count = next(counter)
-                            inter_to_id[prev] = count
-
-    del seen_inter
+        # number of window pixels per road pixel that belong to other roads
+        window = pixel_index.window(curr_road[:, 0], curr_road[:, 1])
+        hits = np.sum((window != -1) & (window != int(curr_id)), axis=1)
+
+        for idx in np.flatnonzero(hits).tolist():
+            pixel = (int(curr_road[idx][0]), int(curr_road[idx][1]))
+            for _ in range(hits[idx]):
+                if pixel not in adj_list:
+                    adj_list[pixel] = set()
+                if prev not in inter_to_id:
+                    count = next(counter)
+                    inter_to_id[pixel] = count
+
+                adj_list[pixel].add(prev)
+                adj_list[prev].add(pixel)
+                prev = pixel
+                if prev not in inter_to_id:
+                    count = next(counter)
+                    inter_to_id[prev] = count
+
     blacklist = create_supernodes(adj_list, inter_to_id)
     return convert_to_adj_mat(inter_to_id, adj_list, blacklist)
 
@@ -94,8 +94,13 @@ def create_supernodes(adj_list, inter_to_id):
         set of points to remove from graph
     """
     blacklist = set()  # list for removal of unwanted nodes (create supernodes)
-    for node1 in adj_list.keys():
-        for node2 in adj_list.keys():
+    nodes = list(adj_list.keys())
+    if not nodes:
+        return blacklist
+    # only nodes closer than 7 pixels are merged, visit them in node order
+    near = cKDTree(np.array(nodes)).query_ball_point(nodes, 7)
+    for node1, candidates in zip(nodes, near):
+        for node2 in [nodes[pos] for pos in sorted(candidates)]:
             if node1 != node2 and adj_list[node1] and adj_list[node2]:
                 if ((node1[0] - node2[0])**2 +
                     (node1[1] - node2[1])**2)**.5 < 7:
@@ -122,6 +127,10 @@ def convert_to_adj_mat(inter_to_id, adj_list, blacklist):
         inter_to_id -- maps an intersection (x, y) to a unique id to label nodes
         adj_list -- adjacency list of graph (see comment in create_graph_inverse)
         blacklist -- set of nodes to remove from graph
+
+        Returns:
+        (adjacency matrix, inter_xy) where inter_xy holds the (x, y) pixel
+        of every node of the matrix
     """
     dim = len(adj_list)
     adj_mat = sparse.dok_matrix((dim, dim))
@@ -171,73 +180,179 @@ def convert_to_adj_mat(inter_to_id, adj_list, blacklist):
                 adj_mat[prev, curr] = dist
                 adj_mat[curr, prev] = dist
 
-    return adj_mat, id_to_inter2
+    inter_xy = np.array(
+        [id_to_inter2[node] for node in range(dim)], dtype=np.int32
+    ).reshape(-1, 2)
+    return adj_mat, inter_xy
 
 
-def color_graph(comps, id_to_road, id_to_inter, pixel_to_id):
-    """ colors graph based on intersection labels (comps)
+def shortest_edges(first, second, length, dim):
+    """ returns the symmetric adjacency matrix of a list of edges
 
-        colors each node graph and returns mapping of intersection to color given
-        along with dict that maps a color (region) to its average pixel
+        Keeps the shortest length when several edges join the same pair.
 
         Keyword arguments:
-        comps -- list of cluster labels for each graph node
-        id_to_road -- dict which maps road id to all points in the road
-        id_to_inter -- dict which maps an intersection key to the (x, y) value
-        pixel_to_id -- dict which maps (x, y) value to its intersection id
+        first -- array of node ids where the edges start
+        second -- array of node ids where the edges end
+        length -- array of edge lengths
+        dim -- number of nodes
+    """
+    rows = np.concatenate([first, second])
+    cols = np.concatenate([second, first])
+    length = np.concatenate([length, length])
+    order = np.lexsort((length, cols, rows))
+    rows, cols, length = rows[order], cols[order], length[order]
+    unique = np.ones(len(rows), dtype=bool)
+    unique[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return sparse.csr_matrix(
+        (length[unique], (rows[unique], cols[unique])), shape=(dim, dim)
+    )
 
-        Returns:
-        inter_to_color dict which maps (x, y) to color (label) and color_to_mean
-        dict which maps label to centroid (x, y) point
-    """
-    colors = set((0, 0, 0))
-    id_to_color = {}
-    inter_to_color = {}
-    color_to_points = {}
-    color_to_mean = {}
-
-    for value in set(comps):
-        color = (
-            random.randint(0, 255), random.randint(0, 255),
-            random.randint(0, 255)
-        )
-        while color in colors:
-            color = (
-                random.randint(0, 255), random.randint(0, 255),
-                random.randint(0, 255)
-            )
-        colors.add(color)
-        id_to_color[value] = color
-        color_to_points[color] = []
 
-    for inter_id, color_key in enumerate(comps):
-        point = id_to_inter.get(inter_id)
-        if point:
-            xn, yn = point
-            color = id_to_color[color_key]
-            color_to_points[color].append(point)
-            inter_to_color[point] = color
+def graph_from_junctions(junction_graph):
+    """ returns the adjacency matrix of the junction graph from road segmentor
+
+        Same contract as convert_to_adj_mat: edges are weighted by the road
+        length between two nodes (the shortest one if several roads join the
+        same pair) and only the largest connected component is kept.
+
+        Keyword arguments:
+        junction_graph -- dict with 'nodes' ([x, y] rows) and 'edges'
+                          ([from, to, length, road id] rows) arrays
+    """
+    nodes = junction_graph['nodes']
+    edges = junction_graph['edges']
+    first = edges[:, 0].astype(np.int64)
+    second = edges[:, 1].astype(np.int64)
+    keep = first != second
+    dim = len(nodes)
+    adj_mat = shortest_edges(first[keep], second[keep], edges[keep, 2], dim)
+
+    # only keep the largest connected comp so clustering converges
+    connected_comps = sparse.csgraph.connected_components(adj_mat)[1]
+    kept = np.flatnonzero(
+        connected_comps == np.argmax(np.bincount(connected_comps))
+    )
+    return adj_mat[kept][:, kept], nodes[kept]
+
+
+def contract_chains(adj_mat, min_nodes=0):
+    """ contracts chains of degree 2 nodes into single weighted edges
+
+        A node with exactly two neighbours only carries a road through and
+        adds nothing to the topology, but every one of them is a row of the
+        eigenproblem. Each chain of such nodes between two other nodes is
+        replaced by one edge weighted by the total length of the chain, the
+        same weight graph_from_junctions gives a road between two junctions.
+        Parallel edges keep the shortest length and chains that lead back to
+        the node they started from are dropped. Every contracted node takes
+        the label of the end of its chain that is closer along the road.
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+        min_nodes -- the graph is returned unchanged when contracting it
+                     would leave no more than this many nodes
 
-    for key, value in color_to_points.items():
-        color_to_mean[key] = np.mean(value, axis=0) / 10
+        Returns:
+        (reduced adjacency matrix, kept, reduced_of) where kept holds the
+        node id of every reduced node and reduced_of maps every node id to
+        the reduced node whose label it takes
+    """
+    dim = adj_mat.shape[0]
+    unchanged = adj_mat, np.arange(dim), np.arange(dim)
+    adj_mat = sparse.csr_matrix(
+        sparse.triu(adj_mat, k=1) + sparse.tril(adj_mat, k=-1)
+    )
+    adj_mat.eliminate_zeros()
+    indptr, indices, data = adj_mat.indptr, adj_mat.indices, adj_mat.data
+    chain = np.diff(indptr) == 2
+
+    anchor = np.arange(dim)
+    visited = ~chain
+    first, second, length = [], [], []
+    for start in np.flatnonzero(~chain).tolist():
+        for pos in range(indptr[start], indptr[start + 1]):
+            node, total = indices[pos], data[pos]
+            if not chain[node]:
+                if start < node:
+                    first.append(start)
+                    second.append(node)
+                    length.append(total)
+                continue
+            if visited[node]:
+                continue
+
+            # walk along the chain, recording the distance from start
+            prev, path, dist = start, [], []
+            while chain[node]:
+                visited[node] = True
+                path.append(node)
+                dist.append(total)
+                step = indptr[node]
+                if indices[step] == prev:
+                    step += 1
+                prev, node = node, indices[step]
+                total += data[step]
+
+            dist = np.array(dist)
+            anchor[path] = np.where(dist <= total - dist, start, node)
+            if start != node:
+                first.append(start)
+                second.append(node)
+                length.append(total)
+
+    # cycles made only of degree 2 nodes have nothing to contract into
+    cycles = sparse.triu(adj_mat[~visited][:, ~visited]).tocoo()
+    kept = np.flatnonzero(~chain | ~visited)
+    if len(kept) <= min_nodes:
+        return unchanged
+
+    reduced_of = np.full(dim, -1, dtype=np.int64)
+    reduced_of[kept] = np.arange(len(kept))
+    cycle_nodes = reduced_of[np.flatnonzero(~visited)]
+    reduced = shortest_edges(
+        np.concatenate([reduced_of[first], cycle_nodes[cycles.row]]),
+        np.concatenate([reduced_of[second], cycle_nodes[cycles.col]]),
+        np.concatenate([length, cycles.data]), len(kept)
+    )
+    return reduced, kept, reduced_of[anchor]
+
+
+def label_regions(comps, inter_xy):
+    """ numbers the regions and finds the centroid of each one
 
-    return inter_to_color, color_to_mean
+        Keyword arguments:
+        comps -- array of cluster labels for each graph node
+        inter_xy -- array of the (x, y) pixel of each graph node
 
+        Returns:
+        (inter_region, region_mean) where inter_region holds the region of
+        every node, numbered from 0 in the order of the cluster labels, and
+        region_mean the centroid (x, y) of every region divided by 10
+    """
+    inter_region = np.unique(comps, return_inverse=True)[1].ravel()
+    sizes = np.bincount(inter_region)
+    region_mean = np.stack([
+        np.bincount(inter_region, inter_xy[:, 0]),
+        np.bincount(inter_region, inter_xy[:, 1]),
+    ], axis=1) / sizes[:, None] / 10
+    return inter_region, region_mean
 
-def main(id_to_road, pixel_to_id, o_dir, c_mask=None):
-    coms = []
-    adj_mat, id_to_inter = create_graph_inverse(id_to_road, pixel_to_id)
-    k = int(len(id_to_road.keys()) // 88) + 1
 
-    affinity = 'precomputed'
+def spectral_labels(adj_mat, k):
+    """ clusters a precomputed affinity matrix into k labels
 
-    coms = SpectralClustering(
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+        k -- number of clusters
+    """
+    return SpectralClustering(
         n_clusters=k,
         eigen_solver=None,
         random_state=None,
         n_init=500,
         gamma=1,
-        affinity=affinity,
+        affinity='precomputed',
         n_neighbors=5,
         eigen_tol=0,
         assign_labels='discretize',
@@ -246,4 +361,263 @@ def main(id_to_road, pixel_to_id, o_dir, c_mask=None):
         kernel_params=None
     ).fit_predict(adj_mat)
 
-    return color_graph(coms, id_to_road, id_to_inter, pixel_to_id)
+
+def graph_fingerprint(adj_mat):
+    """ returns a digest identifying the structure and weights of a graph
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+    """
+    coo = sparse.coo_matrix(adj_mat)
+    order = np.lexsort((coo.col, coo.row))
+    digest = hashlib.sha1()
+    digest.update(np.asarray(coo.shape, dtype=np.int64).tobytes())
+    digest.update(coo.row[order].astype(np.int64).tobytes())
+    digest.update(coo.col[order].astype(np.int64).tobytes())
+    digest.update(coo.data[order].astype(np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def cached_embedding(adj_mat, n_components, o_dir):
+    """ returns the spectral embedding of the graph, computed at most once
+
+        The embedding (the relaxed normalized cut solution that
+        SpectralClustering computes internally) is stored in o_dir next to
+        the other outputs. It is reused as long as the graph is unchanged
+        and it holds at least n_components eigenvectors, so that sweeping
+        the region count only reruns the label assignment.
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+        n_components -- number of eigenvectors needed
+        o_dir -- directory the embedding is persisted in
+    """
+    fingerprint = graph_fingerprint(adj_mat)
+    path = os.path.join(o_dir, EMBEDDING_FILE)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if str(cached['fingerprint']) == fingerprint and \
+               cached['maps'].shape[1] >= n_components:
+                return cached['maps'][:, :n_components]
+
+    maps = spectral_embedding(
+        adj_mat,
+        n_components=n_components,
+        eigen_solver=None,
+        random_state=None,
+        eigen_tol=0,
+        drop_first=False
+    )
+    np.savez(path, maps=maps, fingerprint=np.array(fingerprint))
+    return maps
+
+
+def embedding_labels(maps, k, assign_labels='discretize'):
+    """ assigns k cluster labels from a precomputed spectral embedding
+
+        Keyword arguments:
+        maps -- spectral embedding with at least k columns
+        k -- number of clusters
+        assign_labels -- 'discretize' or 'kmeans', as in SpectralClustering
+    """
+    maps = maps[:, :k]
+    if assign_labels == 'kmeans':
+        return k_means(maps, k, random_state=None, n_init=500)[1]
+    return discretize(maps, random_state=None)
+
+
+def region_quality(adj_mat, labels):
+    """ returns the normalized cut and region size spread of a labelling
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+        labels -- array of cluster labels per node
+    """
+    coo = sparse.coo_matrix(adj_mat)
+    n_labels = int(np.max(labels)) + 1
+    volume = np.bincount(labels[coo.row], coo.data, n_labels)
+    crossing = labels[coo.row] != labels[coo.col]
+    cut = np.bincount(
+        labels[coo.row][crossing], coo.data[crossing], n_labels
+    )
+    sizes = np.bincount(labels, minlength=n_labels)
+    nonempty = volume > 0
+    return {
+        'ncut': float(np.sum(cut[nonempty] / volume[nonempty])),
+        'cut_fraction': float(cut.sum() / max(volume.sum(), 1e-12)),
+        'min_size': int(sizes.min()),
+        'max_size': int(sizes.max()),
+        'mean_size': float(sizes.mean()),
+    }
+
+
+def partition_nodes(inter_xy, block_size):
+    """ assigns every graph node to a square spatial block
+
+        Keyword arguments:
+        inter_xy -- array of the (x, y) pixel of each graph node
+        block_size -- side of a block in pixels
+
+        Returns:
+        list of node id arrays, one per non-empty block
+    """
+    keys = np.asarray(inter_xy, dtype=np.int64) // block_size
+    block_of = keys[:, 0] * (keys[:, 1].max() + 1) + keys[:, 1]
+    order = np.argsort(block_of, kind='mergesort')
+    splits = np.flatnonzero(np.diff(block_of[order])) + 1
+    return np.split(order, splits)
+
+
+def _cluster_block(task):
+    """ pool worker: clusters the subgraph induced by a single block """
+    sub_mat, k = task
+    dim = sub_mat.shape[0]
+    if dim <= k:
+        return np.arange(dim)
+    if k == 1:
+        return np.zeros(dim, dtype=int)
+    return spectral_labels(sub_mat, k)
+
+
+def reconcile_blocks(adj_mat, labels, node_block, region_size):
+    """ merges regions that were cut apart by block borders
+
+        A region which straddles a block border comes out of the per block
+        clustering as two fragments joined by the edges crossing the border.
+        Fragments are merged greedily, strongest border connection first, as
+        long as the merged region stays within 1.5 times the expected size.
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the full intersection graph
+        labels -- array of globally unique labels per node
+        node_block -- array of block index per node
+        region_size -- expected number of nodes in a region
+
+        Returns:
+        array of contiguous labels per node
+    """
+    coo = sparse.triu(adj_mat, k=1).tocoo()
+    cut = node_block[coo.row] != node_block[coo.col]
+    first = np.minimum(labels[coo.row][cut], labels[coo.col][cut])
+    second = np.maximum(labels[coo.row][cut], labels[coo.col][cut])
+    sizes = np.bincount(labels).tolist()
+    parent = list(range(len(sizes)))
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    pairs, counts = np.unique(
+        first * len(sizes) + second, return_counts=True
+    )
+    for idx in np.argsort(-counts, kind='mergesort'):
+        a = find(int(pairs[idx] // len(sizes)))
+        b = find(int(pairs[idx] % len(sizes)))
+        if a != b and sizes[a] + sizes[b] <= 1.5 * region_size:
+            parent[b] = a
+            sizes[a] += sizes[b]
+
+    roots = np.array([find(a) for a in range(len(parent))])
+    return np.unique(roots[labels], return_inverse=True)[1].ravel()
+
+
+def partitioned_labels(adj_mat, inter_xy, k, block_size, workers=None):
+    """ clusters the graph block by block in a process pool
+
+        The graph is split into square spatial blocks of block_size pixels,
+        each block receives a share of the k regions proportional to its
+        node count and is clustered independently. Regions straddling block
+        borders are then reconciled by reconcile_blocks.
+
+        Keyword arguments:
+        adj_mat -- sparse adjacency matrix of the intersection graph
+        inter_xy -- array of the (x, y) pixel of each graph node
+        k -- number of regions for the whole graph
+        block_size -- side of a block in pixels
+        workers -- number of worker processes (defaults to cpu count)
+    """
+    adj_mat = sparse.csr_matrix(adj_mat)
+    dim = adj_mat.shape[0]
+    blocks = partition_nodes(inter_xy, block_size)
+    tasks = [
+        (adj_mat[nodes][:, nodes], max(1, int(round(k * len(nodes) / dim))))
+        for nodes in blocks
+    ]
+
+    pool = Pool(workers)
+    try:
+        block_labels = pool.map(_cluster_block, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    labels = np.zeros(dim, dtype=int)
+    node_block = np.zeros(dim, dtype=int)
+    offset = 0
+    for block, (nodes, comps) in enumerate(zip(blocks, block_labels)):
+        labels[nodes] = np.asarray(comps) + offset
+        node_block[nodes] = block
+        offset += int(np.max(comps)) + 1
+
+    return reconcile_blocks(adj_mat, labels, node_block, dim / float(k))
+
+
+def default_region_count(road_set):
+    """ number of regions used when none is given, one per 88 roads """
+    return int(len(road_set) // 88) + 1
+
+
+def main(road_set, pixel_index, o_dir, c_mask=None, block_size=None,
+         workers=None, n_regions=None, junction_graph=None, contract=True,
+         logger=None):
+    """ clusters the intersection graph into regions
+
+        Keyword arguments:
+        road_set -- road_set.RoadSet of all roads
+        pixel_index -- road_loader.PixelIndex of all road pixels
+        o_dir -- output directory
+        c_mask -- mask to restrict region growing algorithm
+        block_size -- if set, cluster spatial blocks of this many pixels in
+                      parallel instead of the whole graph at once
+        workers -- number of worker processes for the partitioned mode
+        n_regions -- number of regions, defaults to default_region_count
+        junction_graph -- junction graph exported by road segmentor, used
+                          instead of rebuilding the graph from pixels
+        contract -- cluster the graph with its degree 2 chains contracted,
+                    see contract_chains
+        logger -- logger for the graph sizes, optional
+
+        Returns:
+        (inter_xy, inter_region, region_mean), see label_regions
+    """
+    if junction_graph is not None:
+        adj_mat, inter_xy = graph_from_junctions(junction_graph)
+    else:
+        adj_mat, inter_xy = create_graph_inverse(road_set, pixel_index)
+    k = n_regions or default_region_count(road_set)
+
+    dim = adj_mat.shape[0]
+    if contract:
+        reduced, kept, reduced_of = contract_chains(adj_mat, k)
+    else:
+        reduced, kept, reduced_of = adj_mat, np.arange(dim), np.arange(dim)
+    if logger:
+        logger.info(
+            'Intersection graph: %d nodes, %d edges; clustered: %d nodes, '
+            '%d edges', dim, adj_mat.nnz // 2,
+            reduced.shape[0], reduced.nnz // 2
+        )
+
+    if block_size:
+        coms = partitioned_labels(
+            reduced, inter_xy[kept], k, block_size, workers
+        )
+    else:
+        coms = embedding_labels(cached_embedding(reduced, k, o_dir), k)
+
+    # contracted nodes take the label of their chain end
+    coms = np.asarray(coms)[reduced_of]
+    inter_region, region_mean = label_regions(coms, inter_xy)
+    return inter_xy, inter_region, region_mean
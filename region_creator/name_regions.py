@@ -16,16 +16,16 @@ class Region_Namer:
     """ regions named according to AB, where A in (N,S,E,W), B in (A - Z) """
 
     def __init__(self, center_r, center_c):
-        self.color_to_name = {}  # maps a color(index) to a name
+        self.region_names = []  # name of every region label
         self.center_r = int(center_r / 10)
         self.center_c = int(center_c / 10)
 
-    def name(self, inter_to_color, color_to_mean):
+    def name(self, region_mean):
         """ names regions of mask image based on centroid orientation from
             the center
 
             Keyword arguments:
-            mask -- region image
+            region_mean -- centroid (x, y) of every region label divided by 10
         """
         first = 1
         cardinal = ["N", "S", "E", "W"]
@@ -36,12 +36,13 @@ class Region_Namer:
             ] for card in cardinal
         ]
 
+        self.region_names = [None] * len(region_mean)
         # sort the regions according to distance from center
-        for key, val in sorted(
-            color_to_mean.items(),
-            key=lambda t: dist((self.center_r, self.center_c), t[1])
+        for key in sorted(
+            range(len(region_mean)),
+            key=lambda t: dist((self.center_r, self.center_c), region_mean[t])
         ):
-            x, y = int(val[0]), int(val[1])
+            x, y = int(region_mean[key][0]), int(region_mean[key][1])
             # find the correct bucket for the current region
             card = nsew(x, y, self.center_r, self.center_c)
             if first:
@@ -54,7 +55,7 @@ class Region_Namer:
                     print("You've exceeded the number of possible regions.")
                     print("Try smaller area.")
                     raise
-            self.color_to_name[key] = name
+            self.region_names[key] = name
 
 
 def dist(p1, p2):
@@ -129,8 +130,7 @@ def get_angle(mp, p1, p2):
 def main(
     row,
     col,
-    inter_to_color,
-    color_to_mean,
+    region_mean,
     o_dir,
     center_r=None,
     center_c=None
@@ -139,6 +139,6 @@ def main(
         center_r, center_c = row // 2, col // 2
 
     r_namer = Region_Namer(int(center_r), int(center_c))
-    r_namer.name(inter_to_color, color_to_mean)
+    r_namer.name(region_mean)
 
-    return r_namer.color_to_name
+    return r_namer.region_names
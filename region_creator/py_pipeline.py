@@ -14,11 +14,13 @@ from __future__ import unicode_literals
 
 
 import argparse
-import json
 import logging
 from region_creator import create_regions
 from region_creator import name_regions
 from region_creator import change_names_ends
+from region_creator import region_map
+from region_creator import road_loader
+import resource
 import sys
 sys.path.insert(0,'../')
 
@@ -45,7 +47,21 @@ def create_logger(args):
     return logger
 
 
-def main(js_fn, o_dir, logger, center_r=None, center_c=None, c_mask=None):
+def log_memory(logger, stage):
+    """
+    Logs the peak resident set size of the process after a stage
+
+    :param logger: logger object for logging
+    :param stage: name of the stage that just finished
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024  # bytes on OS X, kilobytes on Linux
+    logger.info('Finished %s, peak RSS %.1f MB', stage, peak / 1024)
+
+
+def main(js_fn, o_dir, logger, center_r=None, center_c=None, c_mask=None,
+         block_size=None, workers=None, n_regions=None):
     """
     Main function that starts region creator
 
@@ -55,31 +71,44 @@ def main(js_fn, o_dir, logger, center_r=None, center_c=None, c_mask=None):
     :param center_r: row coordinate of center of city
     :param center_c: column coordinate of center of city
     :param c_mask: Mask to restrict region growing algorithm
+    :param block_size: side in pixels of the spatial blocks clustered in
+                       parallel, clusters the whole graph at once if None
+    :param workers: number of worker processes for block clustering
+    :param n_regions: number of regions, one per 88 roads if None
     :return: json that contains name to road info
     """
-    # Reading json
-    json_s = open(js_fn).read()
-    json_d = json.loads(json_s)
-
-    id_to_road_m = json_d['id_road']
-    pixel_to_id_m = json_d['pixel_road']
-    row_m, col_m = json_d['img_meta']['height'], json_d['img_meta']['width']
+    # Streaming json into compact arrays
+    road_set, pixel_index, img_meta, junction_graph = \
+        road_loader.load_roads(js_fn)
+    row_m, col_m = img_meta['height'], img_meta['width']
+    logger.info('Loaded %d roads, %d pixels in %.1f MB', len(road_set),
+                len(road_set.points), road_set.nbytes / 2.0**20)
+    log_memory(logger, 'loading ' + js_fn)
 
     logger.info('Beginning create_regions.py')
-    inter_to_color, color_to_mean = create_regions.main(
-        id_to_road_m, pixel_to_id_m, o_dir, c_mask
+    inter_xy, inter_region, region_mean = create_regions.main(
+        road_set, pixel_index, o_dir, c_mask, block_size, workers,
+        n_regions, junction_graph, logger=logger
     )
+    # the pixel index is only needed to build the intersection graph
+    del pixel_index, junction_graph
+    log_memory(logger, 'create_regions.py')
 
     logger.info('Beginning name_regions.py')
-    color_to_name = name_regions.main(
-        row_m, col_m, inter_to_color, color_to_mean, o_dir,
-        center_r, center_c
+    region_names = name_regions.main(
+        row_m, col_m, region_mean, o_dir, center_r, center_c
     )
+    del region_mean
+    region_map.RegionMap.build(
+        inter_xy, inter_region, region_names, (row_m, col_m)
+    ).save(o_dir)
+    log_memory(logger, 'name_regions.py')
 
     logger.info('Beginning change_names_ends.py')
     name_to_road = change_names_ends.main(
-        inter_to_color, id_to_road_m, color_to_name, o_dir, row_m, col_m
+        inter_xy, inter_region, road_set, region_names, o_dir, row_m, col_m
     )
+    log_memory(logger, 'change_names_ends.py')
 
     return name_to_road
 
@@ -107,6 +136,27 @@ if __name__ == "__main__":
     ap.add_argument(
         '-o_dir', '--out_dir', required=True, help='Directory to save output'
     )
+    ap.add_argument(
+        '-block_size',
+        '--block_size',
+        required=False,
+        type=int,
+        help='Cluster spatial blocks of this many pixels in parallel'
+    )
+    ap.add_argument(
+        '-workers',
+        '--workers',
+        required=False,
+        type=int,
+        help='Number of worker processes for block clustering'
+    )
+    ap.add_argument(
+        '-regions',
+        '--regions',
+        required=False,
+        type=int,
+        help='Number of regions, one per 88 roads by default'
+    )
     args = vars(ap.parse_args())
 
     o_dir = args['out_dir']
@@ -114,4 +164,6 @@ if __name__ == "__main__":
     center_r = args['center_row']
     center_c = args['center_col']
     logger = create_logger(args)
-    main(js_fn, o_dir, logger, center_r, center_c)
+    main(js_fn, o_dir, logger, center_r, center_c,
+         block_size=args['block_size'], workers=args['workers'],
+         n_regions=args['regions'])
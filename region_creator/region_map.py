@@ -0,0 +1,138 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Coarse raster of the regions, for point to region queries """
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import math
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+
+
+REGION_MAP_FILE = 'region_map.npz'
+CELL_SIZE = 4  # side of a raster cell in pixels
+ROW_CHUNK = 256
+
+
+class NearestRegion(object):
+    """ region of the intersection closest to a point
+
+        Intersections on the same pixel count once, with the region of the
+        last of them, and of several closest intersections the lowest
+        numbered one wins.
+    """
+
+    def __init__(self, inter_xy, inter_region):
+        inter_xy = np.asarray(inter_xy, dtype=np.int64).reshape(-1, 2)
+        keys = inter_xy[:, 0] * (inter_xy[:, 1].max() + 1) + inter_xy[:, 1] \
+            if len(inter_xy) else inter_xy[:, 0]
+        first = np.unique(keys, return_index=True)[1]
+        last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+        order = np.argsort(first)
+        self.pixels = inter_xy[first[order]]
+        # index len(pixels) stands for no intersection
+        self.regions = np.append(np.asarray(inter_region)[last[order]], -1)
+        self.tree = cKDTree(self.pixels) if len(self.pixels) else None
+
+    def __call__(self, points):
+        """ returns the region for an array of (x, y) points, -1 when there
+            are no intersections
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        count = len(self.pixels)
+        nearest = np.full(len(points), count, dtype=np.int64)
+        pending = np.arange(len(points) if count else 0)
+        k = 1
+        while len(pending):
+            k = min(2 * k, count)
+            dists, idx = self.tree.query(points[pending], k=k)
+            dists = dists.reshape(len(pending), -1)
+            idx = idx.reshape(len(pending), -1)
+            ties = dists == dists[:, :1]
+            nearest[pending] = np.where(ties, idx, count).min(axis=1)
+            # a tie may continue past the k candidates returned
+            pending = pending[ties[:, -1] & (k < count)]
+        return self.regions[nearest]
+
+
+class RegionMap(object):
+    """ region label of every cell of a coarse raster over the image
+
+        A cell takes the region of the intersection closest to its centre,
+        see NearestRegion, the rule that also places the roads in regions.
+    """
+
+    def __init__(self, labels, names, shape, cell_size):
+        self.labels = labels
+        self.names = list(names)
+        self.shape = tuple(shape)
+        self.cell_size = cell_size
+        # names indexed by label + 1, so that -1 maps to no name
+        self.label_names = np.array([''] + self.names, dtype=object)
+
+    @classmethod
+    def build(cls, inter_xy, inter_region, region_names, shape,
+              cell_size=CELL_SIZE):
+        """ rasterizes the regions of the clustered intersections
+
+            Keyword arguments:
+            inter_xy -- array of the (x, y) pixel of every intersection
+            inter_region -- array of the region label of every intersection
+            region_names -- name of every region label
+            shape -- (height, width) of the image in pixels
+            cell_size -- side of a raster cell in pixels
+        """
+        rows = int(math.ceil(shape[0] / cell_size))
+        cols = int(math.ceil(shape[1] / cell_size))
+        labels = np.full((rows, cols), -1, dtype=np.int16)
+        nearest_region = NearestRegion(inter_xy, inter_region)
+        y = (np.arange(cols) + 0.5) * cell_size
+        for start in range(0, rows, ROW_CHUNK):
+            x = (np.arange(start, min(start + ROW_CHUNK, rows)) + 0.5) \
+                * cell_size
+            centres = np.stack(np.meshgrid(x, y, indexing='ij'), axis=-1)
+            labels[start:start + len(x)] = nearest_region(
+                centres.reshape(-1, 2)
+            ).reshape(len(x), cols)
+        return cls(labels, region_names, shape, cell_size)
+
+    def save(self, o_dir):
+        np.savez_compressed(
+            os.path.join(o_dir, REGION_MAP_FILE), labels=self.labels,
+            names=np.array(self.names), shape=np.array(self.shape),
+            cell_size=np.array(self.cell_size)
+        )
+
+    @classmethod
+    def load(cls, o_dir):
+        with np.load(os.path.join(o_dir, REGION_MAP_FILE)) as stored:
+            return cls(stored['labels'], stored['names'].tolist(),
+                       stored['shape'].tolist(), int(stored['cell_size']))
+
+    def regions(self, x, y):
+        """ returns the region label of (x, y) pixel arrays, -1 outside of
+            the image
+        """
+        i = np.floor(np.asarray(x, dtype=np.float64) / self.cell_size)
+        j = np.floor(np.asarray(y, dtype=np.float64) / self.cell_size)
+        rows, cols = self.labels.shape
+        inside = (i >= 0) & (i < rows) & (j >= 0) & (j < cols)
+        i = np.where(inside, i, 0).astype(np.intp)
+        j = np.where(inside, j, 0).astype(np.intp)
+        return np.where(inside, self.labels[i, j], -1)
+
+    def region_names(self, x, y):
+        """ returns the region name of (x, y) pixel arrays, '' outside of
+            the image
+        """
+        return self.label_names[self.regions(x, y) + 1]
@@ -0,0 +1,220 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Incremental loader for the roads.json written by road segmentor """
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import io
+import json
+import numpy as np
+import re
+from region_creator.road_set import RoadSet
+
+
+CHUNK_SIZE = 1 << 22
+WHITESPACE = ' \t\n\r'
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+
+class JsonStream(object):
+    """ reads one json document from a file a chunk at a time
+
+        Only the part of the document that is currently being decoded is
+        kept in memory, so values can be consumed (or skipped) one by one
+        without ever holding the whole file as a string.
+    """
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """ drops the consumed prefix and reads the next chunk """
+        chunk = self.fp.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def peek(self):
+        """ returns the next non whitespace character without consuming it """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of json')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at json offset %d' % (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """ decodes and returns the next complete value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                end = None
+            # a value ending with the buffer may continue in the next chunk
+            if end is not None and (end < len(self.buf) or self.eof):
+                self.pos = end
+                return value
+            if not self.fill() and end is None:
+                raise ValueError('Malformed json at offset %d' % self.pos)
+
+    def skip(self):
+        """ skips the next value without decoding it """
+        if self.peek() not in '{[':
+            self.value()
+            return
+        depth = 0
+        while True:
+            for token in TOKEN.finditer(self.buf, self.pos):
+                if token.end() == len(self.buf) and not self.eof:
+                    break  # string token may be cut by the chunk boundary
+                self.pos = token.end()
+                if token.group() in '{[':
+                    depth += 1
+                elif token.group() in '}]':
+                    depth -= 1
+                    if depth == 0:
+                        return
+            if not self.fill():
+                raise ValueError('Unexpected end of json')
+
+    def items(self):
+        """ yields (key, stream) for every member of the next object,
+            the caller must consume each member's value before the next
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key, self
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+class PixelIndex(object):
+    """ sorted array replacement for the pixel_road dict
+
+        Keeps one int64 key and one int32 road id per road pixel and
+        answers window lookups for many pixels at once with searchsorted.
+    """
+
+    def __init__(self, xs, ys, ids):
+        self.stride = int(np.max(ys)) + 5 if len(ys) else 5
+        keys = self.key(xs, ys)
+        # as in pixel_road, the highest road id wins for shared pixels
+        order = np.lexsort((ids, keys))
+        keys, ids = keys[order], ids[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self.keys = keys[last]
+        self.ids = ids[last].astype(np.int32)
+
+    def key(self, xs, ys):
+        # offset by 2 so that window neighbours never wrap to another row
+        return (np.asarray(xs, dtype=np.int64) + 2) * self.stride + \
+            np.asarray(ys, dtype=np.int64) + 2
+
+    def lookup(self, xs, ys):
+        """ returns the road id at each (x, y) pixel, -1 where there is none
+        """
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        keys = self.key(xs, ys)
+        if not len(self.keys):
+            return np.full(keys.shape, -1, dtype=np.int32)
+        valid = (xs >= -2) & (ys >= -2) & (ys < self.stride - 2)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = valid & (self.keys[pos] == keys)
+        return np.where(found, self.ids[pos], -1)
+
+    def window(self, xs, ys, radius=2):
+        """ road ids in the (2 * radius + 1)^2 window around every pixel,
+            one row per pixel with the window in row major order
+        """
+        offsets = np.arange(-radius, radius + 1)
+        dx = np.repeat(offsets, len(offsets))
+        dy = np.tile(offsets, len(offsets))
+        return self.lookup(np.asarray(xs)[:, None] + dx,
+                           np.asarray(ys)[:, None] + dy)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.ids.nbytes
+
+
+def load_roads(js_fn):
+    """ streams roads.json into a RoadSet
+
+        pixel_road is skipped while reading and rebuilt as a PixelIndex from
+        the roads themselves, which is where most of the file size goes.
+        When the segmentor exported its junction graph the pixel index is not
+        needed at all and is not built.
+
+        :param js_fn: path to roads.json
+        :return: (road_set, pixel_index, img_meta, junction_graph) where
+                 road_set is a road_set.RoadSet of the roads in file order
+                 and junction_graph is None or a dict with 'nodes' ([x, y]
+                 rows) and 'edges' ([from, to, length, road] rows) arrays
+    """
+    ids = []
+    roads = []
+    img_meta = None
+    junction_graph = None
+    with io.open(js_fn, 'r', encoding='utf-8') as fp:
+        stream = JsonStream(fp)
+        for key, value in stream.items():
+            if key == 'id_road':
+                for rid, _ in value.items():
+                    ids.append(int(rid))
+                    roads.append(np.array(value.value(), dtype=np.int32))
+            elif key == 'img_meta':
+                img_meta = value.value()
+            elif key == 'junction_graph':
+                graph = value.value()
+                junction_graph = {
+                    'nodes': np.array(graph['nodes'], dtype=np.int32)
+                    .reshape(-1, 2),
+                    'edges': np.array(graph['edges'], dtype=np.float64)
+                    .reshape(-1, 4),
+                }
+            else:
+                value.skip()
+
+    road_set = RoadSet.from_roads(ids, roads)
+    del roads
+    if junction_graph is not None:
+        return road_set, None, img_meta, junction_graph
+
+    points = road_set.points
+    pixel_index = PixelIndex(
+        points[:, 0], points[:, 1],
+        road_set.ids[road_set.road_of_points()].astype(np.int32)
+    )
+    return road_set, pixel_index, img_meta, junction_graph
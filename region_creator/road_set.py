@@ -0,0 +1,81 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Array backed road model shared by the region creator stages """
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import numpy as np
+
+
+class RoadSet(object):
+    """ all roads of a tile in three flat arrays
+
+        Road number i has the id ids[i] and its ordered [x, y, d] pixels are
+        points[offsets[i]:offsets[i + 1]], so a road pixel costs 12 bytes
+        instead of a python list per pixel. Roads keep the order in which
+        they were added.
+    """
+
+    def __init__(self, ids, offsets, points):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.points = np.asarray(points, dtype=np.int32).reshape(-1, 3)
+
+    @classmethod
+    def from_roads(cls, ids, roads):
+        """ builds a RoadSet from a road id and a pixel array per road,
+            empty roads are left out
+        """
+        ids = [rid for rid, road in zip(ids, roads) if len(road)]
+        roads = [np.asarray(road, dtype=np.int32).reshape(-1, 3)
+                 for road in roads if len(road)]
+        offsets = np.zeros(len(roads) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(road) for road in roads])
+        if roads:
+            points = np.concatenate(roads)
+        else:
+            points = np.zeros((0, 3), dtype=np.int32)
+        return cls(ids, offsets, points)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def road(self, pos):
+        """ pixels of road number pos, a view into points """
+        return self.points[self.offsets[pos]:self.offsets[pos + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def point_at(self, index, roads=slice(None)):
+        """ pixel number index of the given roads (all by default), negative
+            counts from the end, the roads must be long enough to have it
+        """
+        if index < 0:
+            return self.points[self.offsets[1:][roads] + index]
+        return self.points[self.offsets[:-1][roads] + index]
+
+    def road_of_points(self):
+        """ road number of every pixel in points """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def means(self):
+        """ average [x, y, d] pixel of every road """
+        sums = np.add.reduceat(
+            self.points.astype(np.float64), self.offsets[:-1], axis=0
+        ) if len(self) else np.zeros((0, 3))
+        return sums / self.lengths[:, None]
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes + self.points.nbytes
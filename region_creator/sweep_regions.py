@@ -0,0 +1,106 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Sweeps region counts and label assignment over one spectral embedding """
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import argparse
+import json
+import numpy as np
+import time
+from region_creator import create_regions
+from region_creator import road_loader
+from region_creator.py_pipeline import create_logger
+
+
+def main(js_fn, o_dir, logger, ks=None, strategies=('discretize',)):
+    """
+    Clusters the intersection graph for every region count in ks and every
+    label assignment strategy, reusing the embedding cached in o_dir.
+
+    :param js_fn: path to roads.json written by the road segmentor
+    :param o_dir: output dir holding the cached embedding and the report
+    :param logger: logger object for logging
+    :param ks: region counts to try, defaults to the pipeline's count
+    :param strategies: label assignment strategies to try
+    :return: list of report rows, one per (k, strategy)
+    """
+    road_set, pixel_index, _, junction_graph = road_loader.load_roads(js_fn)
+    if junction_graph is not None:
+        adj_mat, _ = create_regions.graph_from_junctions(junction_graph)
+    else:
+        adj_mat, _ = create_regions.create_graph_inverse(
+            road_set, pixel_index
+        )
+    del pixel_index, junction_graph
+    if not ks:
+        ks = [create_regions.default_region_count(road_set)]
+
+    # cluster the same contracted graph as the pipeline, score the full one
+    reduced, _, reduced_of = create_regions.contract_chains(adj_mat, max(ks))
+    start = time.time()
+    maps = create_regions.cached_embedding(reduced, max(ks), o_dir)
+    logger.info('Spectral embedding of %d nodes (%d before contracting '
+                'chains) ready in %.2fs', reduced.shape[0], adj_mat.shape[0],
+                time.time() - start)
+
+    report = []
+    for k in sorted(ks):
+        for strategy in strategies:
+            start = time.time()
+            labels = create_regions.embedding_labels(maps, k, strategy)
+            labels = np.asarray(labels)[reduced_of]
+            row = {'k': k, 'assign_labels': strategy,
+                   'seconds': time.time() - start}
+            row.update(create_regions.region_quality(adj_mat, labels))
+            logger.info(
+                'k=%(k)d %(assign_labels)s: %(seconds).2fs ncut=%(ncut).3f '
+                'cut=%(cut_fraction).3f sizes=%(min_size)d..%(max_size)d',
+                row
+            )
+            report.append(row)
+
+    json.dump(report, open(o_dir + '/' + 'cluster_sweep.json', 'w'), indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-json',
+        '--json',
+        required=True,
+        help='Path to id_to_road/pixel_to_id (json)'
+    )
+    ap.add_argument(
+        '-o_dir', '--out_dir', required=True, help='Directory to save output'
+    )
+    ap.add_argument(
+        '-k',
+        '--k',
+        type=int,
+        nargs='+',
+        help='Region counts to evaluate'
+    )
+    ap.add_argument(
+        '-assign_labels',
+        '--assign_labels',
+        nargs='+',
+        default=['discretize'],
+        choices=['discretize', 'kmeans'],
+        help='Label assignment strategies to evaluate'
+    )
+    args = vars(ap.parse_args())
+
+    logger = create_logger(args)
+    main(args['json'], args['out_dir'], logger, args['k'],
+         args['assign_labels'])
@@ -0,0 +1,115 @@
+/*
+ *  Copyright (c) 2017, Facebook, Inc.
+ *  All rights reserved.
+ *
+ *  This file contains the block occupancy map used to skip the empty parts of road images.
+ */
+
+#include "road_segmentation.h"
+
+BlockMap::BlockMap(Size imageSize, int blockSize)
+    : imageSize(imageSize), blockSize(blockSize),
+      rows((imageSize.height + blockSize - 1) / blockSize), cols((imageSize.width + blockSize - 1) / blockSize),
+      flags(rows * cols, 0)
+{
+}
+
+Rect BlockMap::blockRect(int blockRow, int blockCol) const
+{
+    // Returns the image area of a block, blocks on the right and bottom edges may be smaller.
+
+    return Rect(blockCol * blockSize, blockRow * blockSize, blockSize, blockSize) & Rect(0, 0, imageSize.width, imageSize.height);
+}
+
+vector<Rect> BlockMap::flaggedRects() const
+{
+    // Returns the image areas of all flagged blocks in row major order.
+
+    vector<Rect> rects;
+    for (int blockRow = 0; blockRow < rows; blockRow++)
+    {
+        for (int blockCol = 0; blockCol < cols; blockCol++)
+        {
+            if (at(blockRow, blockCol))
+                rects.push_back(blockRect(blockRow, blockCol));
+        }
+    }
+    return rects;
+}
+
+BlockMap BlockMap::dilated() const
+{
+    // Returns a map that also flags the 8 neighbours of every flagged block, which covers
+    // the one pixel halo that 3x3 neighbourhood passes read around a block.
+
+    BlockMap result(imageSize, blockSize);
+    for (int blockRow = 0; blockRow < rows; blockRow++)
+    {
+        for (int blockCol = 0; blockCol < cols; blockCol++)
+        {
+            if (!at(blockRow, blockCol))
+                continue;
+
+            for (int i = max(blockRow - 1, 0); i <= min(blockRow + 1, rows - 1); i++)
+            {
+                for (int j = max(blockCol - 1, 0); j <= min(blockCol + 1, cols - 1); j++)
+                    result.set(i, j);
+            }
+        }
+    }
+    return result;
+}
+
+BlockMap BlockMap::unionWith(const BlockMap & other) const
+{
+    // Returns a map flagging the blocks flagged in either map.
+
+    BlockMap result(imageSize, blockSize);
+    for (int pos = 0; pos < flags.size(); pos++)
+        result.flags[pos] = flags[pos] | other.flags[pos];
+    return result;
+}
+
+int BlockMap::count() const
+{
+    // Returns the number of flagged blocks.
+
+    int flagged = 0;
+    for (int pos = 0; pos < flags.size(); pos++)
+        flagged += flags[pos] != 0;
+    return flagged;
+}
+
+class FindOccupiedBlocksBody : public ParallelLoopBody
+{
+    // Flags the blocks of a range of block rows that contain a non zero pixel.
+
+public:
+    FindOccupiedBlocksBody(const Mat & image, BlockMap & blocks) : image(image), blocks(blocks) {}
+
+    void operator()(const Range & range) const
+    {
+        for (int blockRow = range.start; blockRow < range.end; blockRow++)
+        {
+            for (int blockCol = 0; blockCol < blocks.cols; blockCol++)
+            {
+                if (countNonZero(image(blocks.blockRect(blockRow, blockCol))) > 0)
+                    blocks.set(blockRow, blockCol);
+            }
+        }
+    }
+
+private:
+    const Mat & image;
+    BlockMap & blocks;
+};
+
+BlockMap findOccupiedBlocks(Mat image, int blockSize)
+{
+    // Builds the block occupancy map of a single channel image, flagging
+    // every block that contains at least one non zero pixel.
+
+    BlockMap blocks(image.size(), blockSize);
+    parallel_for_(Range(0, blocks.rows), FindOccupiedBlocksBody(image, blocks));
+    return blocks;
+}
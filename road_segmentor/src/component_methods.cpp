@@ -0,0 +1,161 @@
+/*
+ *  Copyright (c) 2017, Facebook, Inc.
+ *  All rights reserved.
+ *
+ *  This file contains code for segmenting the road image, as a whole or one road component at a time.
+ */
+
+#include "road_segmentation.h"
+
+void segmentRoads(Mat image, BlockMap & blocks, vector<Point> & cornerVector)
+{
+    // Thins the filled binary road image, labels the roads and joins them across junctions.
+    // The roads are left in roadLabels and the junctions in cornerVector. The image is
+    // thinned in place.
+
+    //Convert to skeleton image
+    Mat zhangSuen = zhangSuenThinning(image, blocks);
+    Mat guoHall = guoHallThinning(zhangSuen, blocks);
+    Mat thinImage; guoHall.copyTo(thinImage);
+
+    //Assign road labels to individual road segments
+    Mat labelImage = constructInitialRoadLabels(thinImage, blocks);
+
+    //Bin Junction pixels along with the right road
+    labelImage = binJunctionPixels(thinImage, labelImage, blocks);
+
+    //Now fill the roadLabel array in ordered fashion
+    labelImage = constructOrderedRoadLabels(labelImage, blocks);
+
+    //Find corners in the image for connecting road segments
+    cornerVector = findImageCorners(thinImage, blocks);
+
+    //Connect roads across junctions and crossways
+    findContinuousRoads(labelImage, cornerVector);
+}
+
+int labelRoadComponents(Mat image, Mat & labels, vector<Rect> & boxes)
+{
+    // Labels the road components of the binary image, numbered from 1 in row major order of
+    // their first pixel. Road pixels within ROAD_COMPONENT_MARGIN of each other are joined
+    // first, and boxes holds the bounding box of every component grown by the margin.
+    // Returns the number of components.
+
+    Mat grown;
+    dilate(image, grown, getStructuringElement(MORPH_RECT, Size(2 * ROAD_COMPONENT_MARGIN + 1, 2 * ROAD_COMPONENT_MARGIN + 1)));
+
+    boxes.clear();
+#if CV_MAJOR_VERSION >= 3
+    Mat stats, centroids;
+    int count = connectedComponentsWithStats(grown, labels, stats, centroids, 8, CV_32S);
+    for (int label = 1; label < count; label++)
+    {
+        boxes.push_back(Rect(stats.at<int>(label, CC_STAT_LEFT), stats.at<int>(label, CC_STAT_TOP),
+                             stats.at<int>(label, CC_STAT_WIDTH), stats.at<int>(label, CC_STAT_HEIGHT)));
+    }
+#else
+    labels = Mat(image.size(), CV_32S, Scalar(0));
+    for (int i = 0; i < grown.rows; i++)
+    {
+        for (int j = 0; j < grown.cols; j++)
+        {
+            if (grown.at<uchar>(i,j) != 0 && labels.at<int>(i,j) == 0)
+            {
+                Rect box;
+                labelConnectedPixels(grown, labels, i, j, (int)boxes.size() + 1, box);
+                boxes.push_back(box);
+            }
+        }
+    }
+#endif
+    return (int)boxes.size();
+}
+
+class SegmentRoadComponentsBody : public ParallelLoopBody
+{
+    // Segments a range of road components. Every component is cut out of the image into
+    // its own image, and the road globals are thread local, so components are independent.
+    // The roads and junctions of each component are stored in image coordinates.
+
+public:
+    SegmentRoadComponentsBody(const Mat & image, const Mat & labels, const vector<Rect> & boxes, const vector<int> & order,
+                              vector<vector<vector<Point>>> & componentRoads, vector<vector<Point>> & componentCorners)
+        : image(image), labels(labels), boxes(boxes), order(order), componentRoads(componentRoads), componentCorners(componentCorners) {}
+
+    void operator()(const Range & range) const
+    {
+        for (int pos = range.start; pos < range.end; pos++)
+        {
+            int component = order[pos];
+            Rect box = boxes[component];
+
+            // Other components can reach into the box, keep only the pixels of this one
+            Mat componentImage(box.size(), CV_8U, Scalar(0));
+            image(box).copyTo(componentImage, labels(box) == component + 1);
+
+            BlockMap blocks = findOccupiedBlocks(componentImage);
+            vector<Point> corners;
+            segmentRoads(componentImage, blocks, corners);
+
+            // Move the roads to image coordinates, dropping the points writeJSON would drop
+            Rect bounds(0, 0, box.width, box.height);
+            vector<vector<Point>> & roads = componentRoads[component];
+            roads.resize(roadLabels.size());
+            for (int roadNum = 0; roadNum < roadLabels.size(); roadNum++)
+            {
+                for (int point = 0; point < roadLabels[roadNum].size(); point++)
+                {
+                    if (bounds.contains(roadLabels[roadNum][point]))
+                        roads[roadNum].push_back(roadLabels[roadNum][point] + box.tl());
+                }
+            }
+            for (int corner = 0; corner < corners.size(); corner++)
+                componentCorners[component].push_back(corners[corner] + box.tl());
+
+            // Free the memory of this thread's globals before the next component
+            roadLabels.clear();
+            roadIdImage.release();
+            sharedRoadPixels.clear();
+        }
+    }
+
+private:
+    const Mat & image;
+    const Mat & labels;
+    const vector<Rect> & boxes;
+    const vector<int> & order;
+    vector<vector<vector<Point>>> & componentRoads;
+    vector<vector<Point>> & componentCorners;
+};
+
+int segmentRoadComponents(Mat image, vector<Point> & cornerVector)
+{
+    // Segments every road component of the filled binary image on its own, in parallel,
+    // and merges the results into roadLabels and cornerVector. Road numbers are made unique
+    // by numbering the roads of each component after those of the components before it.
+    // Components never share a junction, so the roads are the same as when segmenting
+    // the whole image, up to their numbering. Returns the number of components.
+
+    Mat labels;
+    vector<Rect> boxes;
+    int count = labelRoadComponents(image, labels, boxes);
+
+    // Start with the largest components so that one of them does not finish last
+    vector<int> order(count);
+    for (int component = 0; component < count; component++)
+        order[component] = component;
+    sort(order.begin(), order.end(), [&](int a, int b) { return boxes[a].area() > boxes[b].area() || (boxes[a].area() == boxes[b].area() && a < b); });
+
+    vector<vector<vector<Point>>> componentRoads(count);
+    vector<vector<Point>> componentCorners(count);
+    parallel_for_(Range(0, count), SegmentRoadComponentsBody(image, labels, boxes, order, componentRoads, componentCorners), count);
+
+    roadLabels.clear();
+    cornerVector.clear();
+    for (int component = 0; component < count; component++)
+    {
+        move(componentRoads[component].begin(), componentRoads[component].end(), back_inserter(roadLabels));
+        cornerVector.insert(cornerVector.end(), componentCorners[component].begin(), componentCorners[component].end());
+    }
+    return count;
+}
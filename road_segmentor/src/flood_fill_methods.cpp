@@ -8,39 +8,67 @@
 
 #include "road_segmentation.h"
 
+struct FloodFillFrame
+{
+    int row, col, next;
+};
+
+// Neighbour order of the original recursive fills: the 4 connected neighbours first.
+static const int NEIGHBOUR_ROWS[8] = {1, -1, 0, 0, -1, -1, 1, 1};
+static const int NEIGHBOUR_COLS[8] = {0, 0, 1, -1, -1, 1, -1, 1};
+
+template <typename Visit>
+static void depthFirstFill(int row, int col, int neighbours, Visit visit)
+{
+    // Depth first traversal with an explicit stack, so that large roads and blobs do not
+    // overflow the call stack. visit(row, col) does the work of one recursive call and
+    // returns true when that call would go on to its neighbours. Pixels are visited in
+    // the same order as the recursion did.
+
+    vector<FloodFillFrame> stack;
+    if (visit(row, col))
+        stack.push_back({row, col, 0});
+
+    while (!stack.empty())
+    {
+        FloodFillFrame & top = stack.back();
+        if (top.next == neighbours)
+        {
+            stack.pop_back();
+            continue;
+        }
+
+        int nextRow = top.row + NEIGHBOUR_ROWS[top.next];
+        int nextCol = top.col + NEIGHBOUR_COLS[top.next];
+        top.next++;
+
+        if (visit(nextRow, nextCol))
+            stack.push_back({nextRow, nextCol, 0});
+    }
+}
+
 void roadFloodFill(Mat image, Mat marked, int row, int col, int roadNumber)
 {
     // This method performs a floodFill operation to traverse a specific road
     // until we reach a junction pixel. All the road points collected while traversal
     // are stored in teh roadLabels vector.
 
-    if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
-        return;
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
 
-    if (image.at<uchar>(row, col) == 0)
-        return;
+        if (image.at<uchar>(row, col) == 0)
+            return false;
 
-    if (marked.at<uchar>(row, col) == 255)
-        return;
+        if (marked.at<uchar>(row, col) == 255)
+            return false;
 
-    if (isJunction(image, row, col))
-    {
         roadLabels[roadNumber].push_back(Point(col,row));
         marked.at<uchar>(row,col) = 255;
-        return;
-    }
 
-    roadLabels[roadNumber].push_back(Point(col,row));
-    marked.at<uchar>(row,col) = 255;
-
-    roadFloodFill(image, marked, row + 1, col, roadNumber);
-    roadFloodFill(image, marked, row - 1, col, roadNumber);
-    roadFloodFill(image, marked, row, col + 1, roadNumber);
-    roadFloodFill(image, marked, row, col - 1, roadNumber);
-    roadFloodFill(image, marked, row - 1, col - 1, roadNumber);
-    roadFloodFill(image, marked, row - 1, col + 1, roadNumber);
-    roadFloodFill(image, marked, row + 1, col - 1, roadNumber);
-    roadFloodFill(image, marked, row + 1, col + 1, roadNumber);
+        return !isJunction(image, row, col);
+    });
 }
 
 void roadFloodFillColor(Mat colorImage, Mat marked, int row, int col, int color[3], int roadNumber)
@@ -49,19 +77,21 @@ void roadFloodFillColor(Mat colorImage, Mat marked, int row, int col, int color[
     // in an ordered fashion. New pixels are appended to the list either in front or at the end
     // based on their distance from the front and end of the vector.
 
-    if (row >= colorImage.rows || col >= colorImage.cols || row < 0 || col < 0)
-        return;
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if (row >= colorImage.rows || col >= colorImage.cols || row < 0 || col < 0)
+            return false;
 
-    if (colorImage.at<Vec3b>(row,col) == Vec3b(0,0,0))
-        return;
+        if (colorImage.at<Vec3b>(row,col) == Vec3b(0,0,0))
+            return false;
 
-    if (marked.at<uchar>(row,col) == 255)
-        return;
+        if (marked.at<uchar>(row,col) == 255)
+            return false;
+
+        if (colorImage.at<Vec3b>(row, col) != Vec3b(color[0], color[1], color[2]))
+            return false;
 
-    if (colorImage.at<Vec3b>(row, col) == Vec3b(color[0], color[1], color[2]))
-    {
         marked.at<uchar>(row, col) = 255;
-        //roadLabels[roadNumber].push_back(Point(col,row));
 
         if(roadLabels[roadNumber].empty())
             roadLabels[roadNumber].push_back(Point(col, row));
@@ -80,127 +110,121 @@ void roadFloodFillColor(Mat colorImage, Mat marked, int row, int col, int color[
                 roadLabels[roadNumber].push_back(Point(col, row));
             }
         }
-
-        roadFloodFillColor(colorImage, marked, row + 1, col, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row - 1, col, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row, col + 1, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row, col - 1, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row - 1, col - 1, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row - 1, col + 1, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row + 1, col - 1, color, roadNumber);
-        roadFloodFillColor(colorImage, marked, row + 1, col + 1, color, roadNumber);
-    }
+        return true;
+    });
 }
 
 void findContourPixels(Mat image, Mat marked, int row, int col, vector<Point> & contourPoints)
 {
     // Finds and stores all 8 connected pixels from a particular pixel at (row,col)
 
-    if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
-        return;
-
-    if (image.at<uchar>(row,col) == 0 || marked.at<uchar>(row, col) == 255)
-        return;
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
 
-    contourPoints.push_back(Point(col, row));
-    marked.at<uchar>(row, col) = 255;
+        if (image.at<uchar>(row,col) == 0 || marked.at<uchar>(row, col) == 255)
+            return false;
 
-    findContourPixels(image, marked, row + 1, col, contourPoints);
-    findContourPixels(image, marked, row - 1, col, contourPoints);
-    findContourPixels(image, marked, row, col + 1, contourPoints);
-    findContourPixels(image, marked, row, col - 1, contourPoints);
-    findContourPixels(image, marked, row - 1, col - 1, contourPoints);
-    findContourPixels(image, marked, row - 1, col + 1, contourPoints);
-    findContourPixels(image, marked, row + 1, col - 1, contourPoints);
-    findContourPixels(image, marked, row + 1, col + 1, contourPoints);
+        contourPoints.push_back(Point(col, row));
+        marked.at<uchar>(row, col) = 255;
+        return true;
+    });
 }
 
 void floodFillFindConnectedPixels(Mat image, int row, int col, vector<Point> * visited, Mat marked, int maxSize)
 {
     // Method to identify and store all 4 connected pixels to the input pixel at position (row, col)
 
-    if ((*visited).size() > maxSize + 10)
-        return;
-
-    if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
-        return;
+    depthFirstFill(row, col, 4, [&](int row, int col)
+    {
+        if ((*visited).size() > maxSize + 10)
+            return false;
 
-    if (image.at<uchar>(row, col) == 255)
-        return;
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
 
-    if (find((*visited).begin(), (*visited).end(), Point(col, row)) != (*visited).end())
-        return;
+        if (image.at<uchar>(row, col) == 255)
+            return false;
 
-    marked.at<uchar>(row, col) = 255;
-    (*visited).push_back(Point(col, row));
+        if (find((*visited).begin(), (*visited).end(), Point(col, row)) != (*visited).end())
+            return false;
 
-    floodFillFindConnectedPixels(image, row + 1, col, visited, marked, maxSize);
-    floodFillFindConnectedPixels(image, row - 1, col, visited, marked, maxSize);
-    floodFillFindConnectedPixels(image, row, col + 1, visited, marked, maxSize);
-    floodFillFindConnectedPixels(image, row, col - 1, visited, marked, maxSize);
+        marked.at<uchar>(row, col) = 255;
+        (*visited).push_back(Point(col, row));
+        return true;
+    });
 }
 
 void findSpikeLength(Mat image, int row, int col, vector<Point> * linePoints, int spikeLengthThresh)
 {
     // returns the constituent pixelsof a line which have a length < spikeLengthThreshold
 
-    if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
-        return;
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
 
-    if (image.at<uchar>(row, col) == 0)
-        return;
+        if (image.at<uchar>(row, col) == 0)
+            return false;
 
-    // If Point(col, row) exists in linePoints, return 0;
-    if (find((*linePoints).begin(), (*linePoints).end(), Point(col, row)) != (*linePoints).end())
-        return;
+        // If Point(col, row) exists in linePoints, return 0;
+        if (find((*linePoints).begin(), (*linePoints).end(), Point(col, row)) != (*linePoints).end())
+            return false;
 
-    if ((*linePoints).size() > 2 * spikeLengthThresh)
-        return;
+        if ((*linePoints).size() > 2 * spikeLengthThresh)
+            return false;
 
-    if (neighbourCount(image, row, col) > 3)
-    {
-        return;
-    }
+        if (neighbourCount(image, row, col) > 3)
+            return false;
+
+        if (image.at<uchar>(row, col) != 255)
+            return false;
 
-    if (image.at<uchar>(row, col) == 255 && find((*linePoints).begin(), (*linePoints).end(), Point(col, row)) == (*linePoints).end())
-    {
         (*linePoints).push_back(Point(col, row));
-        findSpikeLength(image, row + 1, col, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row - 1, col, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row, col + 1, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row, col - 1, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row - 1, col - 1, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row - 1, col + 1, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row + 1, col - 1, linePoints,spikeLengthThresh);
-        findSpikeLength(image, row + 1, col + 1, linePoints,spikeLengthThresh);
-    }
+        return true;
+    });
 }
 
 void connectedPixels(Mat image, int row, int col, vector<Point> * visited, Mat marked)
 {
     // Stores a list of pixels which are connected to the initial pixel at position (row,col)
 
-    if ((*visited).size() > 260)
-        return;
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if ((*visited).size() > 260)
+            return false;
+
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
+
+        if (image.at<uchar>(row, col) == 0)
+            return false;
 
-    if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
-        return;
+        if (find((*visited).begin(), (*visited).end(), Point(col, row)) != (*visited).end())
+            return false;
 
-    if (image.at<uchar>(row, col) == 0)
-        return;
+        marked.at<uchar>(row, col) = 255;
+        (*visited).push_back(Point(col, row));
+        return true;
+    });
+}
 
-    if (find((*visited).begin(), (*visited).end(), Point(col, row)) != (*visited).end())
-        return;
+void labelConnectedPixels(Mat image, Mat labels, int row, int col, int label, Rect & box)
+{
+    // Sets label in labels for all 8 connected pixels of the input pixel at position (row, col)
+    // and grows box to cover them.
+
+    depthFirstFill(row, col, 8, [&](int row, int col)
+    {
+        if (row >= image.rows || col >= image.cols || row < 0 || col < 0)
+            return false;
 
-    marked.at<uchar>(row, col) = 255;
-    (*visited).push_back(Point(col, row));
+        if (image.at<uchar>(row, col) == 0 || labels.at<int>(row, col) != 0)
+            return false;
 
-    connectedPixels(image, row + 1, col, visited, marked);
-    connectedPixels(image, row - 1, col, visited, marked);
-    connectedPixels(image, row, col + 1, visited, marked);
-    connectedPixels(image, row, col - 1, visited, marked);
-    connectedPixels(image, row - 1, col - 1, visited, marked);
-    connectedPixels(image, row - 1, col + 1, visited, marked);
-    connectedPixels(image, row + 1, col - 1, visited, marked);
-    connectedPixels(image, row + 1, col + 1, visited, marked);
+        labels.at<int>(row, col) = label;
+        box = box.area() > 0 ? box | Rect(col, row, 1, 1) : Rect(col, row, 1, 1);
+        return true;
+    });
 }
@@ -7,57 +7,115 @@
 
 #include "road_segmentation.h"
 
-int totalRoadCount = 500000;
-vector<Point> roadLabels[500000];
+thread_local vector<vector<Point>> roadLabels;
+thread_local Mat roadIdImage;
+thread_local map<int, set<int>> sharedRoadPixels;
 
-int main(int argc, const char * argv[])
+bool prepareImage(Mat & image, double & scale)
 {
-    string projectPath = argv[2];
-    string filePath = argv[1];
-
-    Mat image = imread(filePath, 0);
+    // Resizes the grayscale image by scale and thresholds it to a binary road mask. A scale
+    // of 0 is chosen from the road spacing and replaced by the chosen value. Returns false
+    // when the image is empty or too big to segment.
 
-    //Resize the image to 0.5, however, stop processing if image.size() > 2^31 (Integer Overflow)
+    //Resize the image by scale, however, stop processing if image.size() > 2^31 (Integer Overflow)
     if (image.size <= 0 || image.rows * image.cols > pow(2,30) || image.rows * image.cols <= 0)
-    {
-        cout << "Image size is either too big, or the image was not found. Terminating..." << endl;
-        return 0;
-    }
-    resize(image, image, Size(), 0.5, 0.5, CV_INTER_AREA);
-    threshold(image, image, 30, 255, CV_THRESH_BINARY);
+        return false;
+    if (scale == 0)
+        scale = chooseImageScale(image);
+    cout << "Segmenting at scale " << scale << endl;
+    if (scale != 1)
+        resize(image, image, Size(), scale, scale, CV_INTER_AREA);
+    threshold(image, image, ROAD_PIXEL_THRESHOLD, 255, CV_THRESH_BINARY);
     //imwrite(projectPath + "/1.ThreshTileImage.png", image);
+    return true;
+}
+
+void segmentImage(Mat & image, bool components, vector<Point> & cornerVector)
+{
+    // Segments the binary road mask made by prepareImage. The roads are left in roadLabels
+    // and the junctions in cornerVector, image is the filled and thinned mask afterwards.
+
+    //Find the blocks with road pixels, later passes skip the rest of the image
+    BlockMap roadBlocks = findOccupiedBlocks(image);
+    cout << roadBlocks.count() << " of " << roadBlocks.rows * roadBlocks.cols << " image blocks contain roads." << endl;
 
     //Fill empty spaces in the binary image.
     cout << "Preprocessing..." << endl;
-    image = fillGapsInBinaryImage(image, 60);
+    image = fillGapsInBinaryImage(image, 60, roadBlocks);
     //imwrite(projectPath + "/2.FillTileImage.png", image);
 
-    //Convert to skeleton image
-    cout << "Thinning Image";
-    Mat zhangSuen = zhangSuenThinning(image);
-    Mat guoHall = guoHallThinning(zhangSuen);
-    Mat thinImage; guoHall.copyTo(thinImage);
-    cout << endl; cout << "Thinning complete." << endl;
-    //imwrite(projectPath + "/3.ThinTileImage.png", thinImage);
+    //Thin the image, label the roads and connect them across junctions and crossways
+    cout << "Segmenting roads";
+    int64 start = getTickCount();
+    if (components)
+    {
+        int count = segmentRoadComponents(image, cornerVector);
+        cout << endl << count << " road components segmented separately.";
+    }
+    else
+        segmentRoads(image, roadBlocks, cornerVector);
+    cout << endl << "Connected " << roadLabels.size() << " roads across " << cornerVector.size() << " junctions in "
+         << (getTickCount() - start) / getTickFrequency() << "s" << endl;
+}
 
-    cout << "Beginning road segmentation" << endl;
-    //Assign road labels to individual road segments
-    Mat labelImage = constructInitialRoadLabels(thinImage);
+int main(int argc, const char * argv[])
+{
+    // Usage: RoadConnectionLabelling <image> <output dir> [--threads N] [--scale S|auto] [--components]
+    //        RoadConnectionLabelling --worker [--threads N] [--scale S|auto] [--components]
+    vector<string> positional;
+    int threads = 0;
+    double scale = DEFAULT_IMAGE_SCALE;
+    bool components = false;
+    bool worker = false;
+    bool validArgs = true;
+    for (int i = 1; i < argc; i++)
+    {
+        string arg = argv[i];
+        if (arg == "--threads" && i + 1 < argc)
+            threads = atoi(argv[++i]);
+        else if (arg == "--scale" && i + 1 < argc)
+            validArgs = parseImageScale(argv[++i], scale) && validArgs;
+        else if (arg == "--components")
+            components = true;
+        else if (arg == "--worker")
+            worker = true;
+        else
+            positional.push_back(arg);
+    }
+    if ((positional.size() < 2 && !worker) || !validArgs)
+    {
+        cout << "Usage: " << argv[0] << " <image> <output dir> [--threads N] [--scale S|auto] [--components]" << endl;
+        cout << "       " << argv[0] << " --worker [--threads N] [--scale S|auto] [--components]" << endl;
+        cout << "  S is the resize factor in (0, 1], auto picks it from the road spacing" << endl;
+        cout << "  --components segments the disconnected road components separately, in parallel" << endl;
+        cout << "  --worker segments the images sent on stdin until it is closed, see worker_methods.cpp" << endl;
+        return 1;
+    }
+
+    //Raster passes run on OpenCV's thread pool, which uses all cores by default
+    if (threads > 0)
+        setNumThreads(threads);
 
-    //Bin Junction pixels along with the right road
-    labelImage = binJunctionPixels(thinImage, labelImage);
+    if (worker)
+        return runWorker(scale, components);
 
-    //Now fill the roadLabel array in ordered fashion
-    labelImage = constructOrderedRoadLabels(labelImage);
+    string filePath = positional[0];
+    string projectPath = positional[1];
+
+    Mat image = imread(filePath, 0);
+    if (!prepareImage(image, scale))
+    {
+        cout << "Image size is either too big, or the image was not found. Terminating..." << endl;
+        return 0;
+    }
 
-    //Find corners in the image for connecting road segments
-    vector<Point> cornerVector = findImageCorners(thinImage);
+    vector<Point> cornerVector;
+    segmentImage(image, components, cornerVector);
 
-    //Connect roads across junctions and crossways
-    labelImage = findContinuousRoads(labelImage, cornerVector);
-    //imwrite(projectPath + "/4.RoadColorLabels.png", labelImage);
+    //Export the junction graph so region_creator can skip rebuilding it
+    json junctionGraph = buildJunctionGraph(image, cornerVector);
 
-    writeJSON(labelImage, roadLabels, projectPath + "/roads.json");
+    writeJSON(image, scale, roadLabels, junctionGraph, projectPath + "/roads.json");
 
     cout << "Finished" << endl;
 
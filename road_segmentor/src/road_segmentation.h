@@ -17,16 +17,61 @@
 #include <fstream>  //For writing json file
 #include "json.hpp" //For creating json
 #include <set>      //For set hash used in Thinning methods
+#include <map>      //For pixels shared by several roads
 
 using namespace std;
 using namespace cv;
 using json = nlohmann::json;
 
+// Block occupancy map. The image is split into blockSize x blockSize blocks and
+// raster passes only visit the flagged blocks, which for a road mask are the few
+// blocks that contain road pixels.
+const int BLOCK_SIZE = 64;
+
+class BlockMap
+{
+public:
+    BlockMap(Size imageSize, int blockSize = BLOCK_SIZE);
+
+    bool at(int blockRow, int blockCol) const { return flags[blockRow * cols + blockCol] != 0; }
+    void set(int blockRow, int blockCol) { flags[blockRow * cols + blockCol] = 1; }
+    bool containsPixel(int row, int col) const { return at(row / blockSize, col / blockSize); }
+    Rect blockRect(int blockRow, int blockCol) const;
+    vector<Rect> flaggedRects() const;
+    BlockMap dilated() const;
+    BlockMap unionWith(const BlockMap & other) const;
+    int count() const;
+
+    Size imageSize;
+    int blockSize, rows, cols;
+    vector<uchar> flags;
+};
+
+BlockMap findOccupiedBlocks(Mat image, int blockSize = BLOCK_SIZE);
+
+
+// Resolution at which the image is segmented. The default halves the input, the
+// automatic mode picks the coarsest level of the pyramid 1, 1/2, ..., MIN_IMAGE_SCALE
+// that keeps neighbouring roads MIN_ROAD_SPACING pixels apart.
+const double DEFAULT_IMAGE_SCALE = 0.5;
+const double MIN_IMAGE_SCALE = 0.125;
+const int MIN_ROAD_SPACING = 12;
+const int MAX_ROAD_SPACING = 4096;
+const double ROAD_SPACING_PERCENTILE = 5;
+const int ROAD_PIXEL_THRESHOLD = 30;
+
+double measureRoadSpacing(Mat image, double percentile);
+double chooseImageScale(Mat image);
+bool parseImageScale(string value, double & scale);
+
+
 // Methods for Thinning
-Mat zhangSuenThinning(Mat im);
-void thinningZhangSuenIteration(Mat & im, int iter);
-Mat guoHallThinning(Mat im);
-void thinningGuoHallIteration(Mat & im, int iter);
+Mat zhangSuenThinning(Mat im, BlockMap & blocks);
+BlockMap thinningZhangSuenIteration(Mat & im, Mat & marker, int iter, const BlockMap & active);
+Mat guoHallThinning(Mat im, BlockMap & blocks);
+BlockMap thinningGuoHallIteration(Mat & im, Mat & marker, int iter, const BlockMap & active);
+BlockMap removeMarkedPixels(Mat & im, Mat & marker, const vector<Rect> & blocks);
+void thinImageBorder(Mat & im, BlockMap & blocks);
 
 
 // Flood Fill algorithms
@@ -36,29 +81,62 @@ void findContourPixels(Mat image, Mat marked, int row, int col, vector<Point> &
 void floodFillFindConnectedPixels(Mat image, int row, int col, vector<Point> * visited, Mat marked, int maxSize);
 void findSpikeLength(Mat image, int row, int col, vector<Point> * linePoints, int spikeLengthThresh);
 void connectedPixels(Mat image, int row, int col, vector<Point> * visited, Mat marked);
+void labelConnectedPixels(Mat image, Mat labels, int row, int col, int label, Rect & box);
 
 
 // Methods for road segmentation
 bool isJunction(Mat thinImage, int row, int col);
 int returnRoadNumber(Point roadPoint);
+void indexRoadLabels(Size size);
+void addRoadPixel(Point roadPoint, int roadNumber);
+void removeRoadPixel(Point roadPoint, int roadNumber);
+void appendRoad(Mat labelImage, int firstRoadNumber, int secondRoadNumber);
 void sortIntersections(vector<Point> intersections, Point center, vector<Point> * startPoints, vector<Point> * endPoints, vector<int> * angles);
 float pixelDist(Point a, Point b);
 int neighbourCount(Mat image, int row, int col);
-Mat fillGapsInBinaryImage(Mat bw, int size);
-void writeJSON(Mat image, vector<Point> roadLabelsPoints[], string filename);
-Mat constructOrderedRoadLabels(Mat labelImage);
-Mat binJunctionPixels(Mat thinImage, Mat labelImage);
-Mat constructInitialRoadLabels(Mat thinImage);
+Mat fillGapsInBinaryImage(Mat bw, int size, BlockMap & blocks);
+void writeJSON(Mat image, double scale, const vector<vector<Point>> & roadLabelsPoints, json junctionGraph, string filename);
+json buildJunctionGraph(Mat labelImage, vector<Point> cornerVector);
+Mat constructOrderedRoadLabels(Mat labelImage, const BlockMap & blocks);
+Mat binJunctionPixels(Mat thinImage, Mat labelImage, const BlockMap & blocks);
+Mat constructInitialRoadLabels(Mat thinImage, const BlockMap & blocks);
 Mat constructLabelImageFromRoadLabels(Mat thinImage);
-vector<Point> findImageCorners(Mat thinImage);
+vector<Point> findImageCorners(Mat thinImage, const BlockMap & blocks);
+vector<pair<Point, Point>> findJunctionRoadPairs(Mat labelImage, Point corner);
+void connectJunctionRoads(Mat labelImage, Point firstRoadPoint, Point secondRoadPoint, Mat newRoadPixels);
 Mat findContinuousRoads(Mat labelImage, vector<Point> cornerVector);
 Mat removeSpikes(Mat thinImage, int length);
 Mat removeSmallPixels(Mat bw);
 
 
-// Global variables for counting roads
-extern int totalRoadCount;
-extern vector<Point> roadLabels[500000];
+// Methods for segmenting each road component on its own. Components that come within
+// 2 * ROAD_COMPONENT_MARGIN + 1 pixels of each other are treated as one, as junction
+// merging looks up to 11 pixels around a junction.
+const int ROAD_COMPONENT_MARGIN = 6;
+void segmentRoads(Mat image, BlockMap & blocks, vector<Point> & cornerVector);
+int labelRoadComponents(Mat image, Mat & labels, vector<Rect> & boxes);
+int segmentRoadComponents(Mat image, vector<Point> & cornerVector);
+
+
+// Segmenting one image, shared by the command line and the persistent worker mode. In
+// worker mode images are read from stdin and the roads are written to stdout, in the
+// binary layout described in worker_methods.cpp. WORKER_MAX_PIXELS matches the limit
+// of prepareImage.
+const int WORKER_OK = 0;
+const int WORKER_BAD_IMAGE = 1;
+const int64 WORKER_MAX_PIXELS = 1 << 30;
+bool prepareImage(Mat & image, double & scale);
+void segmentImage(Mat & image, bool components, vector<Point> & cornerVector);
+int runWorker(double scale, bool components);
+
+
+// Global variables for storing roads. roadIdImage holds the road number of every road
+// pixel, -1 for background and SHARED_ROAD_PIXEL for pixels listed in sharedRoadPixels.
+// They are thread local so that road components can be segmented concurrently.
+const int SHARED_ROAD_PIXEL = -2;
+extern thread_local vector<vector<Point>> roadLabels;
+extern thread_local Mat roadIdImage;
+extern thread_local map<int, set<int>> sharedRoadPixels;
 
 
 #endif
@@ -0,0 +1,86 @@
+/*
+ *  Copyright (c) 2017, Facebook, Inc.
+ *  All rights reserved.
+ *
+ *  This file contains code for choosing the resolution at which road images are segmented.
+ */
+
+#include "road_segmentation.h"
+
+double measureRoadSpacing(Mat image, double percentile)
+{
+    // Returns the distance between neighbouring roads that only the given percentile
+    // of the background is closer than. Gaps are measured along rows and columns
+    // between two road pixels, and every gap is weighted by its length so that the
+    // small holes left inside roads barely count. Returns -1 for an image with no gaps.
+
+    vector<int64> histogram(MAX_ROAD_SPACING + 1, 0);
+    vector<int> lastRoadRow(image.cols, -1);
+
+    for (int i = 0; i < image.rows; i++)
+    {
+        const uchar * row = image.ptr<uchar>(i);
+        int lastRoadCol = -1;
+
+        for (int j = 0; j < image.cols; j++)
+        {
+            if (row[j] <= ROAD_PIXEL_THRESHOLD)
+                continue;
+
+            int rowGap = j - lastRoadCol - 1;
+            if (lastRoadCol >= 0 && rowGap > 0)
+                histogram[min(rowGap, MAX_ROAD_SPACING)] += rowGap;
+
+            int colGap = i - lastRoadRow[j] - 1;
+            if (lastRoadRow[j] >= 0 && colGap > 0)
+                histogram[min(colGap, MAX_ROAD_SPACING)] += colGap;
+
+            lastRoadCol = j;
+            lastRoadRow[j] = i;
+        }
+    }
+
+    int64 total = 0;
+    for (int gap = 0; gap <= MAX_ROAD_SPACING; gap++)
+        total += histogram[gap];
+    if (total == 0)
+        return -1;
+
+    int64 seen = 0;
+    for (int gap = 1; gap <= MAX_ROAD_SPACING; gap++)
+    {
+        seen += histogram[gap];
+        if (seen >= total * percentile / 100)
+            return gap;
+    }
+    return MAX_ROAD_SPACING;
+}
+
+double chooseImageScale(Mat image)
+{
+    // Picks the coarsest level of the scale pyramid (1, 1/2, 1/4, ...) at which
+    // neighbouring roads are still at least MIN_ROAD_SPACING pixels apart, so they
+    // are not merged by the resize, gap filling and junction search.
+
+    double spacing = measureRoadSpacing(image, ROAD_SPACING_PERCENTILE);
+    cout << "Measured road spacing: " << spacing << " pixels" << endl;
+
+    double scale = 1.0;
+    while (scale / 2 >= MIN_IMAGE_SCALE && (spacing < 0 || spacing * scale / 2 >= MIN_ROAD_SPACING))
+        scale /= 2;
+    return scale;
+}
+
+bool parseImageScale(string value, double & scale)
+{
+    // Reads the --scale argument, a factor in (0, 1] or "auto". Auto is returned as 0.
+
+    if (value == "auto")
+    {
+        scale = 0;
+        return true;
+    }
+    char * end;
+    scale = strtod(value.c_str(), &end);
+    return *end == '\0' && scale > 0 && scale <= 1;
+}
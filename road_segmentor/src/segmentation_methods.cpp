@@ -27,16 +27,104 @@ bool isJunction(Mat thinImage, int row, int col)
 int returnRoadNumber(Point roadPoint)
 {
     // retuns the index of the roadLabel vector which
-    // contains the roadPoint Point.
+    // contains the roadPoint Point. When several roads contain
+    // the point, the lowest road number is returned.
 
-    for (int i = 0; i < totalRoadCount; i++)
+    if (roadPoint.x < 0 || roadPoint.y < 0 || roadPoint.y >= roadIdImage.rows || roadPoint.x >= roadIdImage.cols)
+        return -1;
+
+    int roadNumber = roadIdImage.at<int>(roadPoint.y, roadPoint.x);
+    if (roadNumber == SHARED_ROAD_PIXEL)
+        return *sharedRoadPixels[roadPoint.y * roadIdImage.cols + roadPoint.x].begin();
+    return roadNumber;
+}
+
+void indexRoadLabels(Size size)
+{
+    // Rebuilds roadIdImage and sharedRoadPixels from the roadLabels vector.
+
+    roadIdImage.create(size, CV_32S);
+    roadIdImage.setTo(Scalar(-1));
+    sharedRoadPixels.clear();
+
+    for (int roadNum = 0; roadNum < roadLabels.size(); roadNum++)
+    {
+        for (int pos = 0; pos < roadLabels[roadNum].size(); pos++)
+            addRoadPixel(roadLabels[roadNum][pos], roadNum);
+    }
+}
+
+void addRoadPixel(Point roadPoint, int roadNumber)
+{
+    // Records in roadIdImage that roadNumber contains roadPoint.
+
+    if (roadPoint.x < 0 || roadPoint.y < 0 || roadPoint.y >= roadIdImage.rows || roadPoint.x >= roadIdImage.cols)
+        return;
+
+    int & current = roadIdImage.at<int>(roadPoint.y, roadPoint.x);
+    if (current == -1)
+    {
+        current = roadNumber;
+    }
+    else if (current == SHARED_ROAD_PIXEL)
+    {
+        sharedRoadPixels[roadPoint.y * roadIdImage.cols + roadPoint.x].insert(roadNumber);
+    }
+    else if (current != roadNumber)
     {
-        if (find(roadLabels[i].begin(), roadLabels[i].end(), roadPoint) != roadLabels[i].end()) // if roadPoint found
+        set<int> & roads = sharedRoadPixels[roadPoint.y * roadIdImage.cols + roadPoint.x];
+        roads.insert(current);
+        roads.insert(roadNumber);
+        current = SHARED_ROAD_PIXEL;
+    }
+}
+
+void removeRoadPixel(Point roadPoint, int roadNumber)
+{
+    // Records in roadIdImage that roadNumber no longer contains roadPoint.
+
+    if (roadPoint.x < 0 || roadPoint.y < 0 || roadPoint.y >= roadIdImage.rows || roadPoint.x >= roadIdImage.cols)
+        return;
+
+    int & current = roadIdImage.at<int>(roadPoint.y, roadPoint.x);
+    if (current == roadNumber)
+    {
+        current = -1;
+    }
+    else if (current == SHARED_ROAD_PIXEL)
+    {
+        int key = roadPoint.y * roadIdImage.cols + roadPoint.x;
+        set<int> & roads = sharedRoadPixels[key];
+        roads.erase(roadNumber);
+        if (roads.size() == 1)
         {
-            return i; //return road number
+            current = *roads.begin();
+            sharedRoadPixels.erase(key);
         }
     }
-    return -1;
+}
+
+void appendRoad(Mat labelImage, int firstRoadNumber, int secondRoadNumber)
+{
+    // Joins the end of road firstRoadNumber to the start of road secondRoadNumber with a
+    // straight line and moves all points of secondRoadNumber to firstRoadNumber.
+    // roadIdImage is updated along with the roadLabels vector.
+
+    LineIterator lineIt(labelImage, roadLabels[firstRoadNumber].back(), roadLabels[secondRoadNumber].front(), 8);
+    for (int i = 0; i < lineIt.count; i++, ++lineIt)
+    {
+        roadLabels[firstRoadNumber].push_back(lineIt.pos());
+        addRoadPixel(lineIt.pos(), firstRoadNumber);
+    }
+
+    for (int pos = 0; pos < roadLabels[secondRoadNumber].size(); pos++)
+    {
+        removeRoadPixel(roadLabels[secondRoadNumber][pos], secondRoadNumber);
+        addRoadPixel(roadLabels[secondRoadNumber][pos], firstRoadNumber);
+    }
+
+    move(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end(), back_inserter(roadLabels[firstRoadNumber]));
+    roadLabels[secondRoadNumber].clear();
 }
 
 Mat constructLabelImageFromRoadLabels(Mat thinImage)
@@ -46,7 +134,7 @@ Mat constructLabelImageFromRoadLabels(Mat thinImage)
 
     srand((int)time(NULL));
     Mat labelImage(thinImage.size(), CV_8UC3, Scalar(0,0,0));
-    for (int roadNum = 0; roadNum < totalRoadCount; roadNum++)
+    for (int roadNum = 0; roadNum < roadLabels.size(); roadNum++)
     {
         int color[3] = {rand() % 200 + 50, rand() % 200 + 50, rand() % 200 + 50};
 
@@ -61,109 +149,202 @@ Mat constructLabelImageFromRoadLabels(Mat thinImage)
     return labelImage;
 }
 
-Mat constructInitialRoadLabels(Mat thinImage)
+Mat constructInitialRoadLabels(Mat thinImage, const BlockMap & blocks)
 {
     // From a binary thinImage, we are constructing the roadLabels vector.
     // Each vector in the roadLabels vector contains a list of all points in the road.
+    // The image is scanned in row major order, skipping the blocks without road pixels.
 
+    roadLabels.clear();
     int roadNumber = 0;
     Mat marked(thinImage.size(), CV_8U, Scalar(0));
 
     for (int i=0; i<thinImage.rows; i++)
     {
-        for (int j=0; j<thinImage.cols; j++)
+        for (int blockCol = 0; blockCol < blocks.cols; blockCol++)
         {
-            if (thinImage.at<uchar>(i,j) == 255 && marked.at<uchar>(i,j) == 0)
+            Rect block = blocks.blockRect(i / blocks.blockSize, blockCol);
+            if (!blocks.at(i / blocks.blockSize, blockCol))
+                continue;
+
+            for (int j=block.x; j<block.x + block.width; j++)
             {
-                roadFloodFill(thinImage, marked, i, j, roadNumber);
-                roadNumber++;
+                if (thinImage.at<uchar>(i,j) == 255 && marked.at<uchar>(i,j) == 0)
+                {
+                    roadLabels.push_back(vector<Point>());
+                    roadFloodFill(thinImage, marked, i, j, roadNumber);
+                    roadNumber++;
+                }
             }
         }
     }
     return constructLabelImageFromRoadLabels(thinImage);
 }
 
-Mat binJunctionPixels(Mat thinImage, Mat labelImage)
+class BinJunctionPixelsBody : public ParallelLoopBody
 {
-    // Each junction position contains a group of 8 connected junction pixels. This method identifies
-    // and assigns the extra junction pixels to different roads.
-    // labelImage contains the pixels that have already been binned into specific roads, while thinImage
-    // contains all road pixels.
+    // Bins the junction pixels of a range of blocks. Each pixel only writes its own
+    // output pixel, so blocks are independent.
 
-    // Superimpose label image on thin image and identify missing pixels. Pixels with value 255 are missing.
-    Mat superimposedThinLabelImage(thinImage.size(), CV_8UC3, Scalar(0,0,0));
+public:
+    BinJunctionPixelsBody(const Mat & thinImage, const Mat & labelImage, Mat & superimposed, const vector<Rect> & blocks)
+        : thinImage(thinImage), labelImage(labelImage), superimposed(superimposed), blocks(blocks) {}
 
-    for (int i=0; i<superimposedThinLabelImage.rows; i++)
+    void operator()(const Range & range) const
     {
-        for (int j=0; j<superimposedThinLabelImage.cols; j++)
+        const Vec3b black(0,0,0);
+        for (int pos = range.start; pos < range.end; pos++)
         {
-            if (labelImage.at<Vec3b>(i,j) != Vec3b(0,0,0))
-            {
-                superimposedThinLabelImage.at<Vec3b>(i,j) = labelImage.at<Vec3b>(i,j);
-            }
-            else if (thinImage.at<uchar>(i,j) == 255)
+            for (int i = blocks[pos].y; i < blocks[pos].y + blocks[pos].height; i++)
             {
-                int colorSet = 0;
+                const uchar * thinRow = thinImage.ptr<uchar>(i);
+                const Vec3b * labelRow = labelImage.ptr<Vec3b>(i);
+                Vec3b * outRow = superimposed.ptr<Vec3b>(i);
 
-                // Scan through 4 neighbours -> neighbours with dist = 1, and set
-                for (int tRow = i-1; tRow <= i+1; tRow++)
+                for (int j = blocks[pos].x; j < blocks[pos].x + blocks[pos].width; j++)
                 {
-                    for (int tCol = j-1; tCol <= j+1; tCol++)
+                    if (labelRow[j] != black)
                     {
-                        if (labelImage.at<Vec3b>(tRow,tCol) != Vec3b(0,0,0) && pixelDist(Point(tRow,tCol), Point(i,j)) == 1)
+                        outRow[j] = labelRow[j];
+                    }
+                    else if (thinRow[j] == 255)
+                    {
+                        int colorSet = 0;
+
+                        // Scan through 4 neighbours -> neighbours with dist = 1, and set
+                        for (int tRow = max(i-1, 0); tRow <= min(i+1, labelImage.rows-1); tRow++)
                         {
-                            superimposedThinLabelImage.at<Vec3b>(i,j) = labelImage.at<Vec3b>(tRow, tCol);
-                            colorSet = 1;
+                            const Vec3b * neighbourRow = labelImage.ptr<Vec3b>(tRow);
+                            for (int tCol = max(j-1, 0); tCol <= min(j+1, labelImage.cols-1); tCol++)
+                            {
+                                if (neighbourRow[tCol] != black && (tRow == i || tCol == j))
+                                {
+                                    outRow[j] = neighbourRow[tCol];
+                                    colorSet = 1;
+                                }
+                            }
                         }
-                    }
-                }
 
-                // Scan through remaining neighbours with Dist > 1
-                for (int tRow = i-1; tRow <= i+1; tRow++)
-                {
-                    for (int tCol = j-1; tCol <= j+1; tCol++)
-                    {
-                        if (colorSet == 0 && labelImage.at<Vec3b>(tRow,tCol) != Vec3b(0,0,0) && pixelDist(Point(tRow,tCol), Point(i,j)) > 1)
+                        // Scan through remaining neighbours with Dist > 1
+                        for (int tRow = max(i-1, 0); tRow <= min(i+1, labelImage.rows-1) && colorSet == 0; tRow++)
                         {
-                            superimposedThinLabelImage.at<Vec3b>(i,j) = labelImage.at<Vec3b>(tRow, tCol);
-                            colorSet = 1;
+                            const Vec3b * neighbourRow = labelImage.ptr<Vec3b>(tRow);
+                            for (int tCol = max(j-1, 0); tCol <= min(j+1, labelImage.cols-1) && colorSet == 0; tCol++)
+                            {
+                                if (neighbourRow[tCol] != black && tRow != i && tCol != j)
+                                {
+                                    outRow[j] = neighbourRow[tCol];
+                                    colorSet = 1;
+                                }
+                            }
                         }
                     }
                 }
             }
         }
     }
+
+private:
+    const Mat & thinImage;
+    const Mat & labelImage;
+    Mat & superimposed;
+    const vector<Rect> & blocks;
+};
+
+Mat binJunctionPixels(Mat thinImage, Mat labelImage, const BlockMap & blocks)
+{
+    // Each junction position contains a group of 8 connected junction pixels. This method identifies
+    // and assigns the extra junction pixels to different roads.
+    // labelImage contains the pixels that have already been binned into specific roads, while thinImage
+    // contains all road pixels.
+
+    // Superimpose label image on thin image and identify missing pixels. Pixels with value 255 are missing.
+    Mat superimposedThinLabelImage(thinImage.size(), CV_8UC3, Scalar(0,0,0));
+    vector<Rect> rects = blocks.flaggedRects();
+    parallel_for_(Range(0, (int)rects.size()), BinJunctionPixelsBody(thinImage, labelImage, superimposedThinLabelImage, rects));
     return superimposedThinLabelImage;
 }
 
-Mat constructOrderedRoadLabels(Mat labelImage)
+Mat constructOrderedRoadLabels(Mat labelImage, const BlockMap & blocks)
 {
     // Using the labelImage RGB image, fill the roadLabel vector with road points in an ordered fashion.
     // This method utilizes the roadFloodFillColor method for filling the roadLabel vector.
+    // The image is scanned in row major order, skipping the blocks without road pixels.
 
-    for (int i=0; i<totalRoadCount; i++)
-    {
-        roadLabels[i].clear();
-    }
+    roadLabels.clear();
 
     Mat marked(labelImage.size(), CV_8U, Scalar(0));
     int roadNumber = 0;
     for (int i=0; i<labelImage.rows; i++)
     {
-        for (int j=0; j<labelImage.cols; j++)
+        for (int blockCol = 0; blockCol < blocks.cols; blockCol++)
         {
-            if (labelImage.at<Vec3b>(i,j) != Vec3b(0,0,0) && marked.at<uchar>(i,j) == 0)
+            Rect block = blocks.blockRect(i / blocks.blockSize, blockCol);
+            if (!blocks.at(i / blocks.blockSize, blockCol))
+                continue;
+
+            for (int j=block.x; j<block.x + block.width; j++)
             {
-                int color[3] = {labelImage.at<Vec3b>(i,j)[0], labelImage.at<Vec3b>(i,j)[1], labelImage.at<Vec3b>(i,j)[2] };
-                roadFloodFillColor(labelImage, marked, i, j, color, roadNumber);
-                roadNumber++;
+                if (labelImage.at<Vec3b>(i,j) != Vec3b(0,0,0) && marked.at<uchar>(i,j) == 0)
+                {
+                    int color[3] = {labelImage.at<Vec3b>(i,j)[0], labelImage.at<Vec3b>(i,j)[1], labelImage.at<Vec3b>(i,j)[2] };
+                    roadLabels.push_back(vector<Point>());
+                    roadFloodFillColor(labelImage, marked, i, j, color, roadNumber);
+                    roadNumber++;
+                }
             }
         }
     }
     return constructLabelImageFromRoadLabels(labelImage);
 }
 
-vector<Point> findImageCorners(Mat thinImage)
+class FindJunctionsBody : public ParallelLoopBody
+{
+    // Marks the junction pixels of a range of blocks, same test as isJunction().
+
+public:
+    FindJunctionsBody(const Mat & thinImage, Mat & junctionImage, const vector<Rect> & blocks)
+        : thinImage(thinImage), junctionImage(junctionImage), blocks(blocks) {}
+
+    void operator()(const Range & range) const
+    {
+        for (int pos = range.start; pos < range.end; pos++)
+        {
+            for (int i = blocks[pos].y; i < blocks[pos].y + blocks[pos].height; i++)
+            {
+                const uchar * row = thinImage.ptr<uchar>(i);
+                uchar * out = junctionImage.ptr<uchar>(i);
+
+                for (int j = blocks[pos].x; j < blocks[pos].x + blocks[pos].width; j++)
+                {
+                    if (row[j] != 255)
+                        continue;
+
+                    // isJunction() skips the first row and column of the image
+                    int count = 0;
+                    for (int tRow = max(i-1, 1); tRow <= min(i+1, thinImage.rows-1); tRow++)
+                    {
+                        const uchar * neighbourRow = thinImage.ptr<uchar>(tRow);
+                        for (int tCol = max(j-1, 1); tCol <= min(j+1, thinImage.cols-1); tCol++)
+                        {
+                            if (neighbourRow[tCol] == 255)
+                                count++;
+                        }
+                    }
+                    if (count > 3)
+                        out[j] = 255;
+                }
+            }
+        }
+    }
+
+private:
+    const Mat & thinImage;
+    Mat & junctionImage;
+    const vector<Rect> & blocks;
+};
+
+vector<Point> findImageCorners(Mat thinImage, const BlockMap & blocks)
 {
     // The method finds all the junctions in the image using isJunction() method
     // and then further combine junctions that are very near to each other into a single
@@ -171,18 +352,21 @@ vector<Point> findImageCorners(Mat thinImage)
 
     //find junctions in the image
     Mat junctionImage(thinImage.size(), CV_8U, Scalar(0));
-    for (int i=0; i<thinImage.rows; i++)
+    vector<Rect> rects = blocks.flaggedRects();
+    parallel_for_(Range(0, (int)rects.size()), FindJunctionsBody(thinImage, junctionImage, rects));
+
+    //find best corners from the junctions across which to draw circles. Blurring spreads
+    //the junctions by 3 pixels at most, so only the blocks next to road blocks are needed.
+    BlockMap cornerBlocks = blocks.dilated();
+    vector<Rect> cornerRects = cornerBlocks.flaggedRects();
+    Mat blurredImage(thinImage.size(), CV_8U, Scalar(0));
+    for (int pos = 0; pos < cornerRects.size(); pos++)
     {
-        for (int j=0; j<thinImage.cols; j++)
-        {
-            if (thinImage.at<uchar>(i,j) == 255 && isJunction(thinImage, i, j))
-                junctionImage.at<uchar>(i,j) = 255;
-        }
+        Mat blurredBlock = blurredImage(cornerRects[pos]);
+        blur(junctionImage(cornerRects[pos]), blurredBlock, Size(7,7));
+        threshold(blurredBlock, blurredBlock, 1, 255, CV_THRESH_BINARY);
     }
-
-    //find best corners from the junctions across which to draw circles
-    blur(junctionImage, junctionImage, Size(7,7));
-    threshold(junctionImage, junctionImage, 1, 255, CV_THRESH_BINARY);
+    junctionImage = blurredImage;
 
     struct circleProps
     {
@@ -194,20 +378,27 @@ vector<Point> findImageCorners(Mat thinImage)
     Mat marked(junctionImage.size(), CV_8U, Scalar(0));
     for (int i=0; i<junctionImage.rows; i++)
     {
-        for (int j=0; j<junctionImage.cols; j++)
+        for (int blockCol = 0; blockCol < cornerBlocks.cols; blockCol++)
         {
-            if (junctionImage.at<uchar>(i,j) == 255 && marked.at<uchar>(i,j) == 0)
-            {
-                vector<Point> contourPixels;
-                findContourPixels(junctionImage, marked, i, j, contourPixels);
+            Rect block = cornerBlocks.blockRect(i / cornerBlocks.blockSize, blockCol);
+            if (!cornerBlocks.at(i / cornerBlocks.blockSize, blockCol))
+                continue;
 
-                int circle_center_row = 0, circle_center_col = 0;
-                for (int pos=0; pos<contourPixels.size(); pos++)
+            for (int j=block.x; j<block.x + block.width; j++)
+            {
+                if (junctionImage.at<uchar>(i,j) == 255 && marked.at<uchar>(i,j) == 0)
                 {
-                    circle_center_row += contourPixels[pos].y;
-                    circle_center_col += contourPixels[pos].x;
+                    vector<Point> contourPixels;
+                    findContourPixels(junctionImage, marked, i, j, contourPixels);
+
+                    int circle_center_row = 0, circle_center_col = 0;
+                    for (int pos=0; pos<contourPixels.size(); pos++)
+                    {
+                        circle_center_row += contourPixels[pos].y;
+                        circle_center_col += contourPixels[pos].x;
+                    }
+                    cornerVector.push_back(Point(circle_center_col/contourPixels.size(), circle_center_row/contourPixels.size()));
                 }
-                cornerVector.push_back(Point(circle_center_col/contourPixels.size(), circle_center_row/contourPixels.size()));
             }
         }
     }
@@ -220,6 +411,16 @@ void sortIntersections(vector<Point> intersections, Point center, vector<Point>
     // this code finds the angle subtended by each intersection point with every other intersection point in the list.
     // This angle subtended at the junction point (Point center).
     // The method sorts all the subtended angles in descending order along with the corresponding interstion points.
+    // Equal angles keep the order of the intersections.
+
+    vector<int> roadAngle;
+    for (int i = 0; i < intersections.size(); i++)
+    {
+        int pointAngle = atan2((floor)(intersections[i].y - center.y)*(-1), (floor)(intersections[i].x - center.x)) * 180 / CV_PI;
+        if (pointAngle < 0)
+            pointAngle = pointAngle + 360;
+        roadAngle.push_back(pointAngle);
+    }
 
     vector<int> angle;
     vector<Point> maxAngleWith;
@@ -230,21 +431,9 @@ void sortIntersections(vector<Point> intersections, Point center, vector<Point>
         //For each Point, find its angle with remaining points
         for (int j = 0; j < intersections.size(); j++)
         {
-            Point firstRoadPoint = intersections[i];
-            Point secondRoadPoint = intersections[j];
-            int firstRoadAngle = atan2((floor)(firstRoadPoint.y - center.y)*(-1), (floor)(firstRoadPoint.x - center.x)) * 180 / CV_PI;
-            int secondRoadAngle = atan2((floor)(secondRoadPoint.y - center.y)*(-1), (floor)(secondRoadPoint.x - center.x)) * 180 / CV_PI;
-
-            if (firstRoadAngle < 0)
-                firstRoadAngle = firstRoadAngle + 360;
-            if (secondRoadAngle < 0)
-                secondRoadAngle = secondRoadAngle + 360;
-
-            int diffAngle = secondRoadAngle - firstRoadAngle;
-            if (abs(diffAngle) >= 180)
-                diffAngle = 360 - abs(diffAngle);
-            else if (abs(diffAngle) < 180)
-                diffAngle = abs(diffAngle);
+            int diffAngle = abs(roadAngle[j] - roadAngle[i]);
+            if (diffAngle >= 180)
+                diffAngle = 360 - diffAngle;
 
             if (diffAngle > maxAngle)
             {
@@ -258,33 +447,18 @@ void sortIntersections(vector<Point> intersections, Point center, vector<Point>
     }
 
     //Sort angle and intersection vectors
-    for (int i = 0; i < intersections.size(); i++)
+    vector<int> order(intersections.size());
+    for (int i = 0; i < order.size(); i++)
+        order[i] = i;
+    sort(order.begin(), order.end(), [&](int a, int b) { return angle[a] > angle[b] || (angle[a] == angle[b] && a < b); });
+
+    startPoints->clear(); endPoints->clear(); angles->clear();
+    for (int i = 0; i < order.size(); i++)
     {
-        for (int j = i; j < intersections.size(); j++)
-        {
-            if (angle[i] < angle[j])
-            {
-                //Swap inside angle vector
-                int tempAngle = angle[i];
-                angle[i] = angle[j];
-                angle[j] = tempAngle;
-
-                //Swap inside intersection vector
-                Point tempPoint = intersections[i];
-                intersections[i] = intersections[j];
-                intersections[j] = tempPoint;
-
-                //Swap inside maxAngleWith vector
-                Point maxAngleWithTemp = maxAngleWith[i];
-                maxAngleWith[i] = maxAngleWith[j];
-                maxAngleWith[j] = maxAngleWithTemp;
-            }
-        }
+        startPoints->push_back(intersections[order[i]]);
+        endPoints->push_back(maxAngleWith[order[i]]);
+        angles->push_back(angle[order[i]]);
     }
-
-    *startPoints = intersections;
-    *endPoints = maxAngleWith;
-    *angles = angle;
 }
 
 float pixelDist(Point a, Point b)
@@ -327,31 +501,121 @@ int neighbourCount(Mat image, int row, int col)
     return count;
 }
 
-Mat fillGapsInBinaryImage(Mat bw, int size)
+Mat fillGapsInBinaryImage(Mat bw, int size, BlockMap & blocks)
 {
     // Method for filling empty areas in the input road image
     // which have contour area less than input size (Arg-2)
+    // A block without road pixels belongs to an empty area at least as large as the
+    // block, so only the road blocks (and edge blocks smaller than size) can hold gaps.
+    // Blocks in which gaps were filled are flagged in blocks.
 
-    Mat marked(bw.size(), CV_8U, Scalar(0));
-    for (int i=0; i< bw.rows; i++)
+    BlockMap gapBlocks = blocks;
+    for (int blockRow = 0; blockRow < gapBlocks.rows; blockRow++)
     {
-        for (int j=0; j < bw.cols; j++)
+        for (int blockCol = 0; blockCol < gapBlocks.cols; blockCol++)
         {
-            if (marked.at<uchar>(i,j) == 0 && bw.at<uchar>(i,j) == 0)
+            if (gapBlocks.blockRect(blockRow, blockCol).area() <= size)
+                gapBlocks.set(blockRow, blockCol);
+        }
+    }
+
+#if CV_MAJOR_VERSION >= 3
+    // A gap can only spread over 4 connected gap blocks. Label the empty areas of
+    // each group of such blocks in one pass and fill the small ones.
+    vector<uchar> grouped(gapBlocks.flags.size(), 0);
+    for (int start = 0; start < gapBlocks.flags.size(); start++)
+    {
+        if (!gapBlocks.flags[start] || grouped[start])
+            continue;
+
+        vector<int> group(1, start);
+        grouped[start] = 1;
+        Rect box = gapBlocks.blockRect(start / gapBlocks.cols, start % gapBlocks.cols);
+        for (int pos = 0; pos < group.size(); pos++)
+        {
+            int blockRow = group[pos] / gapBlocks.cols, blockCol = group[pos] % gapBlocks.cols;
+            box = box | gapBlocks.blockRect(blockRow, blockCol);
+
+            int neighbours[4][2] = {{blockRow - 1, blockCol}, {blockRow + 1, blockCol}, {blockRow, blockCol - 1}, {blockRow, blockCol + 1}};
+            for (int k = 0; k < 4; k++)
             {
-                vector<Point> pixelVector;
-                floodFillFindConnectedPixels(bw, i, j, &pixelVector, marked, size);
+                int nRow = neighbours[k][0], nCol = neighbours[k][1];
+                int index = nRow * gapBlocks.cols + nCol;
+                if (nRow >= 0 && nCol >= 0 && nRow < gapBlocks.rows && nCol < gapBlocks.cols && gapBlocks.flags[index] && !grouped[index])
+                {
+                    grouped[index] = 1;
+                    group.push_back(index);
+                }
+            }
+        }
 
-                if (pixelVector.size() <= size)
+        // The window is one pixel larger than the group, the pixels around it are in empty
+        // blocks outside the group. An empty area reaching one of them continues into that
+        // block, so it is larger than size whatever its area inside the window.
+        Rect window = Rect(box.x - 1, box.y - 1, box.width + 2, box.height + 2) & Rect(0, 0, bw.cols, bw.rows);
+        Mat empty = (bw(window) == 0);
+        Mat labels, stats, centroids;
+        int count = connectedComponentsWithStats(empty, labels, stats, centroids, 4, CV_32S);
+
+        vector<uchar> fill(count, 0);
+        for (int label = 1; label < count; label++)
+            fill[label] = stats.at<int>(label, CC_STAT_AREA) <= size;
+        for (int i = 0; i < labels.rows; i++)
+        {
+            const int * labelRow = labels.ptr<int>(i);
+            bool outsideRow = i + window.y < box.y || i + window.y >= box.y + box.height;
+            for (int j = 0; j < labels.cols; j++)
+            {
+                if (outsideRow || j + window.x < box.x || j + window.x >= box.x + box.width)
+                    fill[labelRow[j]] = 0;
+            }
+        }
+
+        for (int pos = 0; pos < group.size(); pos++)
+        {
+            Rect block = gapBlocks.blockRect(group[pos] / gapBlocks.cols, group[pos] % gapBlocks.cols);
+            for (int i = block.y; i < block.y + block.height; i++)
+            {
+                const int * labelRow = labels.ptr<int>(i - window.y);
+                uchar * bwRow = bw.ptr<uchar>(i);
+                for (int j = block.x; j < block.x + block.width; j++)
                 {
-                    for (int pos=0; pos<pixelVector.size(); pos++)
+                    if (fill[labelRow[j - window.x]])
                     {
-                        bw.at<uchar>(pixelVector[pos].y, pixelVector[pos].x) = 255;
+                        bwRow[j] = 255;
+                        blocks.set(i / blocks.blockSize, j / blocks.blockSize);
                     }
                 }
             }
         }
     }
+#else
+    Mat marked(bw.size(), CV_8U, Scalar(0));
+    vector<Rect> rects = gapBlocks.flaggedRects();
+    for (int pos = 0; pos < rects.size(); pos++)
+    {
+        for (int i = rects[pos].y; i < rects[pos].y + rects[pos].height; i++)
+        {
+            for (int j = rects[pos].x; j < rects[pos].x + rects[pos].width; j++)
+            {
+                if (marked.at<uchar>(i,j) == 0 && bw.at<uchar>(i,j) == 0)
+                {
+                    vector<Point> pixelVector;
+                    floodFillFindConnectedPixels(bw, i, j, &pixelVector, marked, size);
+
+                    if (pixelVector.size() <= size)
+                    {
+                        for (int k=0; k<pixelVector.size(); k++)
+                        {
+                            bw.at<uchar>(pixelVector[k].y, pixelVector[k].x) = 255;
+                            blocks.set(pixelVector[k].y / blocks.blockSize, pixelVector[k].x / blocks.blockSize);
+                        }
+                    }
+                }
+            }
+        }
+    }
+#endif
     return bw;
 }
 
@@ -389,6 +653,27 @@ Mat removeSpikes(Mat thinImage, int length)
 
 Mat removeSmallPixels(Mat bw)
 {
+    // Removes 8 connected groups of road pixels smaller than 250 pixels.
+
+#if CV_MAJOR_VERSION >= 3
+    Mat labels, stats, centroids;
+    int count = connectedComponentsWithStats(bw == 255, labels, stats, centroids, 8, CV_32S);
+
+    vector<uchar> remove(count, 0);
+    for (int label = 1; label < count; label++)
+        remove[label] = stats.at<int>(label, CC_STAT_AREA) < 250;
+
+    for (int i=0; i< bw.rows; i++)
+    {
+        const int * labelRow = labels.ptr<int>(i);
+        uchar * bwRow = bw.ptr<uchar>(i);
+        for (int j=0; j < bw.cols; j++)
+        {
+            if (remove[labelRow[j]])
+                bwRow[j] = 0;
+        }
+    }
+#else
     Mat marked(bw.size(), CV_8U, Scalar(0));
     for (int i=0; i< bw.rows; i++)
     {
@@ -409,181 +694,302 @@ Mat removeSmallPixels(Mat bw)
             }
         }
     }
+#endif
     return bw;
 }
 
-Mat findContinuousRoads(Mat labelImage, vector<Point> cornerVector)
+struct CircleOffsets
 {
-    // Method detects whether 2 roads are continuous using angle segmented by
-    // 2 roads at the junction point.
-    // Arg 1: Mat labelImage - This is the input RGB road image.
-    // Arg 2: vector<Point> cornerVector - A vector of all corner junction pixel locations for the labelImage.
-
-    int lastPercetage = 0;
-    for (int pos=0; pos<cornerVector.size(); pos++)
-    {
-        int radius = 10;
+    // Offsets of the points of a circle at every degree, so that they are not
+    // recomputed for every corner.
 
-        vector<Point> intersections; //store circle intersections
+    double rows[360], cols[360];
 
-        //Draw a circle and find intersections.
+    CircleOffsets(int radius)
+    {
         for (int angle=0; angle<360; angle++)
         {
-            int boundary_row = cornerVector[pos].y + radius*sin(angle * CV_PI/(float)180);
-            int boundary_col = cornerVector[pos].x + radius*cos(angle * CV_PI/(float)180);
+            rows[angle] = radius*sin(angle * CV_PI/(float)180);
+            cols[angle] = radius*cos(angle * CV_PI/(float)180);
+        }
+    }
+};
+
+vector<pair<Point, Point>> findJunctionRoadPairs(Mat labelImage, Point corner)
+{
+    // Finds the pairs of roads that continue across the junction at corner. A circle is drawn
+    // around the corner and the roads crossing it are paired up when they subtend an angle of
+    // 130 degrees or more at the corner. Every pair is returned as one point on each road.
+
+    const int radius = 10;
+    static const CircleOffsets circleOffsets(radius);
+
+    vector<Point> intersections; //store circle intersections
+    set<int> found;
 
-            for (int iBoundaryRow = boundary_row-1; iBoundaryRow <= boundary_row+1; iBoundaryRow ++)
+    //Draw a circle and find intersections.
+    for (int angle=0; angle<360; angle++)
+    {
+        int boundary_row = corner.y + circleOffsets.rows[angle];
+        int boundary_col = corner.x + circleOffsets.cols[angle];
+
+        for (int iBoundaryRow = boundary_row-1; iBoundaryRow <= boundary_row+1; iBoundaryRow ++)
+        {
+            for (int iBoundaryCol = boundary_col-1; iBoundaryCol <= boundary_col+1; iBoundaryCol ++)
             {
-                for (int iBoundaryCol = boundary_col-1; iBoundaryCol <= boundary_col+1; iBoundaryCol ++)
-                {
 
-                    if (iBoundaryCol >= 0 && iBoundaryRow >= 0 && iBoundaryRow < labelImage.rows && iBoundaryCol < labelImage.cols &&
-                        labelImage.at<Vec3b>(iBoundaryRow, iBoundaryCol) != Vec3b(0,0,0) &&
-                        find(intersections.begin(), intersections.end(), Point(iBoundaryCol, iBoundaryRow)) == intersections.end())
-                    {
-                        intersections.push_back(Point(iBoundaryCol, iBoundaryRow));
-                        angle = angle + 30;
-                        goto NEXTANGLE;
-                    }
+                if (iBoundaryCol >= 0 && iBoundaryRow >= 0 && iBoundaryRow < labelImage.rows && iBoundaryCol < labelImage.cols &&
+                    labelImage.at<Vec3b>(iBoundaryRow, iBoundaryCol) != Vec3b(0,0,0) &&
+                    found.insert(iBoundaryRow * labelImage.cols + iBoundaryCol).second)
+                {
+                    intersections.push_back(Point(iBoundaryCol, iBoundaryRow));
+                    angle = angle + 30;
+                    goto NEXTANGLE;
                 }
             }
-        NEXTANGLE: ;
         }
+    NEXTANGLE: ;
+    }
 
-        //Iterate through the sorted intersections
-        vector<Point> startPoints, endPoints; vector<int> angles;
-        sortIntersections(intersections, cornerVector[pos], &startPoints, &endPoints, &angles);
+    //Iterate through the sorted intersections
+    vector<Point> startPoints, endPoints; vector<int> angles;
+    sortIntersections(intersections, corner, &startPoints, &endPoints, &angles);
 
-        //Color lines that have an angle of 130 +
-        vector<Point> covered;
-        for (int iter = 0; iter < intersections.size(); iter++)
+    //Pair roads that have an angle of 130 +
+    vector<pair<Point, Point>> roadPairs;
+    set<int> covered;
+    for (int iter = 0; iter < intersections.size(); iter++)
+    {
+        int minAngleGap = 130;
+        int startKey = startPoints[iter].y * labelImage.cols + startPoints[iter].x;
+        int endKey = endPoints[iter].y * labelImage.cols + endPoints[iter].x;
+
+        if (angles[iter] >= minAngleGap && covered.count(startKey) == 0 && covered.count(endKey) == 0)
         {
-            int minAngleGap = 130;
+            roadPairs.push_back(make_pair(startPoints[iter], endPoints[iter]));
+            covered.insert(startKey); covered.insert(endKey);
+        }
+    }
+    return roadPairs;
+}
 
-            int first_row, first_col, second_row, second_col;
-            if (angles[iter] >= minAngleGap &&
-                find(covered.begin(), covered.end(), startPoints[iter]) == covered.end() &&
-                find(covered.begin(), covered.end(), endPoints[iter]) == covered.end())
-            {
-                Point firstRoadPoint = startPoints[iter];
-                Point secondRoadPoint = endPoints[iter];
-                first_row = firstRoadPoint.y; first_col = firstRoadPoint.x;
-                second_row = secondRoadPoint.y; second_col = secondRoadPoint.x;
+class FindJunctionRoadPairsBody : public ParallelLoopBody
+{
+    // Runs findJunctionRoadPairs for a range of corners. Each corner only writes its own
+    // entry of roadPairs.
 
-                // Find color at the first point
-                int firstColor[3] = { labelImage.at<Vec3b>(first_row, first_col)[0], labelImage.at<Vec3b>(first_row, first_col)[1], labelImage.at<Vec3b>(first_row, first_col)[2] };
-                int firstRoadNumber = returnRoadNumber(Point(first_col, first_row));
+public:
+    FindJunctionRoadPairsBody(const Mat & labelImage, const vector<Point> & cornerVector, vector<vector<pair<Point, Point>>> & roadPairs)
+        : labelImage(labelImage), cornerVector(cornerVector), roadPairs(roadPairs) {}
 
-                // Find color at second point
-                int secondColor[3] = { labelImage.at<Vec3b>(second_row, second_col)[0], labelImage.at<Vec3b>(second_row, second_col)[1], labelImage.at<Vec3b>(second_row, second_col)[2] };
-                int secondRoadNumber = returnRoadNumber(Point(second_col, second_row));
+    void operator()(const Range & range) const
+    {
+        for (int pos = range.start; pos < range.end; pos++)
+            roadPairs[pos] = findJunctionRoadPairs(labelImage, cornerVector[pos]);
+    }
 
-                //Move all points in secondRoadNumber to points in firstRoadNumber
-                if (firstRoadNumber != secondRoadNumber)
-                {
-                    Point one_front = roadLabels[firstRoadNumber].front();
-                    Point one_last = roadLabels[firstRoadNumber].back();
-                    Point two_front = roadLabels[secondRoadNumber].front();
-                    Point two_last = roadLabels[secondRoadNumber].back();
+private:
+    const Mat & labelImage;
+    const vector<Point> & cornerVector;
+    vector<vector<pair<Point, Point>>> & roadPairs;
+};
 
-                    int min = INT_MAX; int pos_one = 0; int pos_two = 0;
+void connectJunctionRoads(Mat labelImage, Point firstRoadPoint, Point secondRoadPoint, Mat newRoadPixels)
+{
+    // Joins the roads at firstRoadPoint and secondRoadPoint into the first road, when their
+    // closest ends are near enough, and recolors the first road. Road pixels that were
+    // black in labelImage before are marked in newRoadPixels.
 
-                    if (pixelDist(one_front, two_front) < min)
-                    {
-                        pos_one = 0; pos_two = 0;
-                        min = pixelDist(one_front, two_front);
-                    }
-                    if (pixelDist(one_front, two_last) < min)
-                    {
-                        pos_one = 0; pos_two = (int)roadLabels[secondRoadNumber].size() - 1;
-                        min = pixelDist(one_front, two_last);
-                    }
-                    if (pixelDist(one_last, two_front) < min)
-                    {
-                        pos_one = (int)roadLabels[firstRoadNumber].size() - 1; pos_two = 0;
-                        min = pixelDist(one_last, two_front);
-                    }
-                    if (pixelDist(one_last, two_last) < min)
-                    {
-                        pos_one = (int)roadLabels[firstRoadNumber].size() - 1; pos_two = (int)roadLabels[secondRoadNumber].size() - 1;
-                        min = pixelDist(one_last, two_last);
-                    }
+    int first_row = firstRoadPoint.y, first_col = firstRoadPoint.x;
+    int second_row = secondRoadPoint.y, second_col = secondRoadPoint.x;
 
-                    if (min > 20)
-                        goto EXIT1;
+    // Find color at the first point
+    int firstColor[3] = { labelImage.at<Vec3b>(first_row, first_col)[0], labelImage.at<Vec3b>(first_row, first_col)[1], labelImage.at<Vec3b>(first_row, first_col)[2] };
+    int firstRoadNumber = returnRoadNumber(Point(first_col, first_row));
+    int secondRoadNumber = returnRoadNumber(Point(second_col, second_row));
 
-                    if (pos_one == 0 && pos_two == 0)
-                    {
-                        reverse(roadLabels[firstRoadNumber].begin(), roadLabels[firstRoadNumber].end());
+    //Move all points in secondRoadNumber to points in firstRoadNumber
+    if (firstRoadNumber != secondRoadNumber)
+    {
+        Point one_front = roadLabels[firstRoadNumber].front();
+        Point one_last = roadLabels[firstRoadNumber].back();
+        Point two_front = roadLabels[secondRoadNumber].front();
+        Point two_last = roadLabels[secondRoadNumber].back();
 
-                        LineIterator lineIt(labelImage, roadLabels[firstRoadNumber].back(), roadLabels[secondRoadNumber].front(), 8);
-                        for (int i = 0; i < lineIt.count; i++, ++lineIt)
-                            roadLabels[firstRoadNumber].push_back(lineIt.pos());
+        int min = INT_MAX; int pos_one = 0; int pos_two = 0;
 
-                        move(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end(), back_inserter(roadLabels[firstRoadNumber]));
-                        roadLabels[secondRoadNumber].clear();
-                    }
-                    else if (pos_one == 0 && pos_two == roadLabels[secondRoadNumber].size() - 1)
-                    {
-                        reverse(roadLabels[firstRoadNumber].begin(), roadLabels[firstRoadNumber].end());
-                        reverse(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end());
+        if (pixelDist(one_front, two_front) < min)
+        {
+            pos_one = 0; pos_two = 0;
+            min = pixelDist(one_front, two_front);
+        }
+        if (pixelDist(one_front, two_last) < min)
+        {
+            pos_one = 0; pos_two = (int)roadLabels[secondRoadNumber].size() - 1;
+            min = pixelDist(one_front, two_last);
+        }
+        if (pixelDist(one_last, two_front) < min)
+        {
+            pos_one = (int)roadLabels[firstRoadNumber].size() - 1; pos_two = 0;
+            min = pixelDist(one_last, two_front);
+        }
+        if (pixelDist(one_last, two_last) < min)
+        {
+            pos_one = (int)roadLabels[firstRoadNumber].size() - 1; pos_two = (int)roadLabels[secondRoadNumber].size() - 1;
+            min = pixelDist(one_last, two_last);
+        }
 
-                        LineIterator lineIt(labelImage, roadLabels[firstRoadNumber].back(), roadLabels[secondRoadNumber].front(), 8);
-                        for (int i = 0; i < lineIt.count; i++, ++lineIt)
-                            roadLabels[firstRoadNumber].push_back(lineIt.pos());
+        if (min <= 20)
+        {
+            if (pos_one == 0 && pos_two == 0)
+            {
+                reverse(roadLabels[firstRoadNumber].begin(), roadLabels[firstRoadNumber].end());
+                appendRoad(labelImage, firstRoadNumber, secondRoadNumber);
+            }
+            else if (pos_one == 0 && pos_two == roadLabels[secondRoadNumber].size() - 1)
+            {
+                reverse(roadLabels[firstRoadNumber].begin(), roadLabels[firstRoadNumber].end());
+                reverse(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end());
+                appendRoad(labelImage, firstRoadNumber, secondRoadNumber);
+            }
+            else if (pos_one == roadLabels[firstRoadNumber].size() - 1 && pos_two == 0)
+            {
+                appendRoad(labelImage, firstRoadNumber, secondRoadNumber);
+            }
+            else if (pos_one == roadLabels[firstRoadNumber].size() - 1 && pos_two == roadLabels[secondRoadNumber].size() - 1)
+            {
+                reverse(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end());
+                appendRoad(labelImage, firstRoadNumber, secondRoadNumber);
+            }
+        }
+    }
 
-                        move(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end(), back_inserter(roadLabels[firstRoadNumber]));
-                        roadLabels[secondRoadNumber].clear();
-                    }
-                    else if (pos_one == roadLabels[firstRoadNumber].size() - 1 && pos_two == 0)
-                    {
+    //Color all pixels for the specific roadNumber
+    for (int pos_t = 0; pos_t < roadLabels[firstRoadNumber].size(); pos_t++)
+    {
+        Point point = roadLabels[firstRoadNumber][pos_t];
+        if (point.y < labelImage.rows && point.x < labelImage.cols)
+        {
+            if (labelImage.at<Vec3b>(point.y, point.x) == Vec3b(0,0,0))
+                newRoadPixels.at<uchar>(point.y, point.x) = 255;
+            labelImage.at<Vec3b>(point.y, point.x) = Vec3b(firstColor[0], firstColor[1], firstColor[2]);
+        }
+    }
+}
+
+Mat findContinuousRoads(Mat labelImage, vector<Point> cornerVector)
+{
+    // Method detects whether 2 roads are continuous using angle segmented by
+    // 2 roads at the junction point.
+    // Arg 1: Mat labelImage - This is the input RGB road image.
+    // Arg 2: vector<Point> cornerVector - A vector of all corner junction pixel locations for the labelImage.
+    // The road pairs of all corners are found in parallel first, then the roads are joined
+    // corner by corner. A corner whose circle is crossed by a line drawn while joining the
+    // roads of an earlier corner is looked at again, so the result is the same as joining
+    // roads right after finding the pairs of each corner.
 
-                        LineIterator lineIt(labelImage, roadLabels[firstRoadNumber].back(), roadLabels[secondRoadNumber].front(), 8);
-                        for (int i = 0; i < lineIt.count; i++, ++lineIt)
-                            roadLabels[firstRoadNumber].push_back(lineIt.pos());
+    indexRoadLabels(labelImage.size());
 
-                        move(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end(), back_inserter(roadLabels[firstRoadNumber]));
-                        roadLabels[secondRoadNumber].clear();
-                    }
-                    else if (pos_one == roadLabels[firstRoadNumber].size() - 1 && pos_two == roadLabels[secondRoadNumber].size() - 1)
-                    {
-                        reverse(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end());
+    vector<vector<pair<Point, Point>>> roadPairs(cornerVector.size());
+    parallel_for_(Range(0, (int)cornerVector.size()), FindJunctionRoadPairsBody(labelImage, cornerVector, roadPairs));
 
-                        LineIterator lineIt(labelImage, roadLabels[firstRoadNumber].back(), roadLabels[secondRoadNumber].front(), 8);
-                        for (int i = 0; i < lineIt.count; i++, ++lineIt)
-                            roadLabels[firstRoadNumber].push_back(lineIt.pos());
+    // findJunctionRoadPairs only looks at pixels within radius + 1 of the corner
+    int reach = 11;
+    Mat newRoadPixels(labelImage.size(), CV_8U, Scalar(0));
+    for (int pos=0; pos<cornerVector.size(); pos++)
+    {
+        Rect window = Rect(cornerVector[pos].x - reach, cornerVector[pos].y - reach, 2 * reach + 1, 2 * reach + 1) & Rect(0, 0, labelImage.cols, labelImage.rows);
+        if (window.area() > 0 && countNonZero(newRoadPixels(window)) > 0)
+            roadPairs[pos] = findJunctionRoadPairs(labelImage, cornerVector[pos]);
 
-                        move(roadLabels[secondRoadNumber].begin(), roadLabels[secondRoadNumber].end(), back_inserter(roadLabels[firstRoadNumber]));
-                        roadLabels[secondRoadNumber].clear();
-                    }
-                }
+        for (int iter = 0; iter < roadPairs[pos].size(); iter++)
+            connectJunctionRoads(labelImage, roadPairs[pos][iter].first, roadPairs[pos][iter].second, newRoadPixels);
+    }
+    return labelImage;
+}
+
+json buildJunctionGraph(Mat labelImage, vector<Point> cornerVector)
+{
+    // Builds the intersection graph of the final roads so that region_creator does not
+    // have to rediscover it. Nodes are the junction corners followed by the dead ends of
+    // roads, stored as [row, col]. Every road is walked pixel by pixel and each stretch
+    // between two consecutive nodes becomes an edge [from, to, length, roadNumber], where
+    // length is the pixel path length measured from the border of the junction area.
+
+    int junctionRadius = 5;
+    Mat junctionIds(labelImage.size(), CV_32S, Scalar(-1));
+    vector<vector<int>> nodes;
+    for (int pos = 0; pos < cornerVector.size(); pos++)
+    {
+        circle(junctionIds, cornerVector[pos], junctionRadius, Scalar(pos), -1);
+        nodes.push_back({cornerVector[pos].y, cornerVector[pos].x});
+    }
 
-            EXIT1:
-                //Color all pixels for the specific roadNumber
-                for (int pos_t = 0; pos_t < roadLabels[firstRoadNumber].size(); pos_t++)
+    json edges = json::array();
+    for (int i = 0; i < roadLabels.size(); i++)
+    {
+        int currentNode = -1;
+        float length = 0;
+        Point last;
+        for (int pos = 0; pos < roadLabels[i].size(); pos++)
+        {
+            Point point = roadLabels[i][pos];
+
+            // Skip the same out of image points that writeJSON drops
+            if (point.y >= labelImage.rows || point.x >= labelImage.cols || point.y < 0 || point.x < 0)
+                continue;
+
+            int junction = junctionIds.at<int>(point.y, point.x);
+            if (currentNode == -1)
+            {
+                if (junction < 0)
                 {
-                    if (roadLabels[firstRoadNumber][pos_t].y < labelImage.rows && roadLabels[firstRoadNumber][pos_t].x < labelImage.cols)
-                    {
-                        labelImage.at<Vec3b>(roadLabels[firstRoadNumber][pos_t].y, roadLabels[firstRoadNumber][pos_t].x) = Vec3b(firstColor[0], firstColor[1], firstColor[2]);
-                    }
+                    junction = (int)nodes.size();
+                    nodes.push_back({point.y, point.x});
+                }
+                currentNode = junction;
+            }
+            else
+            {
+                length += pixelDist(last, point);
+                if (junction == currentNode)
+                {
+                    length = 0;
+                }
+                else if (junction >= 0)
+                {
+                    edges.push_back({currentNode, junction, length, i});
+                    currentNode = junction;
+                    length = 0;
                 }
-                covered.push_back(startPoints[iter]); covered.push_back(endPoints[iter]);
             }
+            last = point;
         }
 
+        // Road ends away from any junction
+        if (currentNode != -1 && length > 0)
+        {
+            edges.push_back({currentNode, (int)nodes.size(), length, i});
+            nodes.push_back({last.y, last.x});
+        }
     }
-    return labelImage;
+
+    json junctionGraph;
+    junctionGraph["nodes"] = nodes;
+    junctionGraph["edges"] = edges;
+    return junctionGraph;
 }
 
-void writeJSON(Mat image, vector<Point> roadLabelsPoints[], string filename)
+void writeJSON(Mat image, double scale, const vector<vector<Point>> & roadLabelsPoints, json junctionGraph, string filename)
 {
     // Method for creating the JSON from the roadLabelsPoints vector arg.
-    // The JSON is saved with filename as specified by the third argument.
-    // The image resolution is saved in the JSON using the image input.
+    // The JSON is saved with filename as specified by the last argument.
+    // The image resolution is saved in the JSON using the image input, together with
+    // the scale it was resized by, along with the junction graph built by buildJunctionGraph.
 
-    vector<vector<int>> roadLabelsNew[500000];
+    vector<vector<vector<int>>> roadLabelsNew(roadLabelsPoints.size());
 
-    for (int i = 0; i < totalRoadCount; i++)
+    for (int i = 0; i < roadLabelsPoints.size(); i++)
     {
         for (int pos = 0; pos < roadLabelsPoints[i].size(); pos++)
         {
@@ -605,14 +1011,14 @@ void writeJSON(Mat image, vector<Point> roadLabelsPoints[], string filename)
     //Create id_to_road json first and store in vector<vector<int>>
 
     json id_to_road;
-    for (int i = 0; i < totalRoadCount; i++)
+    for (int i = 0; i < roadLabelsNew.size(); i++)
     {
         if (roadLabelsNew[i].size() > 0)
             id_to_road[to_string(i)] = roadLabelsNew[i];
     }
 
     json pixel_to_id;
-    for (int i = 0; i < totalRoadCount; i++)
+    for (int i = 0; i < roadLabelsNew.size(); i++)
     {
         for (int pos = 0; pos < roadLabelsNew[i].size(); pos++)
         {
@@ -625,10 +1031,12 @@ void writeJSON(Mat image, vector<Point> roadLabelsPoints[], string filename)
     json image_meta;
     image_meta["width"] = image.cols;
     image_meta["height"] = image.rows;
+    image_meta["scale"] = scale;
 
     jsonNew["id_road"] = id_to_road;
     jsonNew["pixel_road"] = pixel_to_id;
     jsonNew["img_meta"] = image_meta;
+    jsonNew["junction_graph"] = junctionGraph;
 
     string outputJsonFilename = filename;
     ofstream o(outputJsonFilename);
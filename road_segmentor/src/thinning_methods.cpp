@@ -7,69 +7,142 @@
 
 #include "road_segmentation.h"
 
-void thinningGuoHallIteration(Mat & im, int iter)
+class GuoHallIteration : public ParallelLoopBody
 {
-    // Method called while performing a specific
-    // iteration of the Guo Hall thinning.
+    // Computes the Guo Hall deletion marker for a range of blocks. The image is only
+    // read here, so blocks can run concurrently and the result does not depend on
+    // how the blocks are split.
 
-    Mat marker = Mat::zeros(im.size(), CV_8UC1);
+public:
+    GuoHallIteration(const Mat & im, Mat & marker, const vector<Rect> & blocks, int iter)
+        : im(im), marker(marker), blocks(blocks), iter(iter) {}
 
-    for (int i = 1; i < im.rows - 1; i++)
+    void operator()(const Range & range) const
     {
-        for (int j = 1; j < im.cols - 1; j++)
+        for (int pos = range.start; pos < range.end; pos++)
         {
-            uchar p2 = im.at<uchar>(i - 1, j);
-            uchar p3 = im.at<uchar>(i - 1, j + 1);
-            uchar p4 = im.at<uchar>(i, j + 1);
-            uchar p5 = im.at<uchar>(i + 1, j + 1);
-            uchar p6 = im.at<uchar>(i + 1, j);
-            uchar p7 = im.at<uchar>(i + 1, j - 1);
-            uchar p8 = im.at<uchar>(i, j - 1);
-            uchar p9 = im.at<uchar>(i - 1, j - 1);
-
-            int C = ((!p2) & (p3 | p4)) +
-            ((!p4) & (p5 | p6)) +
-            ((!p6) & (p7 | p8)) +
-            ((!p8) & (p9 | p2));
-            int N1 = (p9 | p2) + (p3 | p4) + (p5 | p6) + (p7 | p8);
-            int N2 = (p2 | p3) + (p4 | p5) + (p6 | p7) + (p8 | p9);
-            int N = N1 < N2 ? N1 : N2;
-            int m = iter == 0 ? ((p6 | p7 | !p9) & p8) : ((p2 | p3 | !p5) & p4);
-
-            if (C == 1 && (N >= 2 && N <= 3) && m == 0)
-                marker.at<uchar>(i, j) = 1;
+            // The outermost rows and columns of the image are never removed
+            int rowEnd = min(blocks[pos].y + blocks[pos].height, im.rows - 1);
+            int colEnd = min(blocks[pos].x + blocks[pos].width, im.cols - 1);
+
+            for (int i = max(blocks[pos].y, 1); i < rowEnd; i++)
+            {
+                const uchar * above = im.ptr<uchar>(i - 1);
+                const uchar * row = im.ptr<uchar>(i);
+                const uchar * below = im.ptr<uchar>(i + 1);
+                uchar * mark = marker.ptr<uchar>(i);
+
+                for (int j = max(blocks[pos].x, 1); j < colEnd; j++)
+                {
+                    // Background pixels are never removed
+                    if (row[j] == 0)
+                        continue;
+
+                    uchar p2 = above[j];
+                    uchar p3 = above[j + 1];
+                    uchar p4 = row[j + 1];
+                    uchar p5 = below[j + 1];
+                    uchar p6 = below[j];
+                    uchar p7 = below[j - 1];
+                    uchar p8 = row[j - 1];
+                    uchar p9 = above[j - 1];
+
+                    int C = ((!p2) & (p3 | p4)) +
+                    ((!p4) & (p5 | p6)) +
+                    ((!p6) & (p7 | p8)) +
+                    ((!p8) & (p9 | p2));
+                    int N1 = (p9 | p2) + (p3 | p4) + (p5 | p6) + (p7 | p8);
+                    int N2 = (p2 | p3) + (p4 | p5) + (p6 | p7) + (p8 | p9);
+                    int N = N1 < N2 ? N1 : N2;
+                    int m = iter == 0 ? ((p6 | p7 | !p9) & p8) : ((p2 | p3 | !p5) & p4);
+
+                    if (C == 1 && (N >= 2 && N <= 3) && m == 0)
+                        mark[j] = 1;
+                }
+            }
         }
     }
-    im &= ~marker;
-}
 
-Mat guoHallThinning(Mat im)
+private:
+    const Mat & im;
+    Mat & marker;
+    const vector<Rect> & blocks;
+    int iter;
+};
+
+class RemoveMarkedPixelsBody : public ParallelLoopBody
 {
-    // Method returns a thin skeletonized image from a given input image.
+    // Clears the marked pixels of a range of blocks from the image, resets the marker
+    // and flags the blocks in which a pixel was removed.
 
-    //Convert to grayscale
-    if (im.channels() > 1)
-        cvtColor(im, im, CV_BGR2GRAY);
+public:
+    RemoveMarkedPixelsBody(Mat & im, Mat & marker, const vector<Rect> & blocks, BlockMap & changed)
+        : im(im), marker(marker), blocks(blocks), changed(changed) {}
 
-    im /= 255;
+    void operator()(const Range & range) const
+    {
+        for (int pos = range.start; pos < range.end; pos++)
+        {
+            bool removed = false;
+            for (int i = blocks[pos].y; i < blocks[pos].y + blocks[pos].height; i++)
+            {
+                uchar * row = im.ptr<uchar>(i);
+                uchar * mark = marker.ptr<uchar>(i);
 
-    cv::Mat prev = cv::Mat::zeros(im.size(), CV_8UC1);
-    cv::Mat diff;
+                for (int j = blocks[pos].x; j < blocks[pos].x + blocks[pos].width; j++)
+                {
+                    if (mark[j])
+                    {
+                        row[j] = 0;
+                        mark[j] = 0;
+                        removed = true;
+                    }
+                }
+            }
+            if (removed)
+                changed.set(blocks[pos].y / changed.blockSize, blocks[pos].x / changed.blockSize);
+        }
+    }
 
-    int count = 0;
-    do {
-        thinningGuoHallIteration(im, 0);
-        thinningGuoHallIteration(im, 1);
-        cv::absdiff(im, prev, diff);
-        im.copyTo(prev);
-        cout << "." ;
-    } while (cv::countNonZero(diff) > 0);
+private:
+    Mat & im;
+    Mat & marker;
+    const vector<Rect> & blocks;
+    BlockMap & changed;
+};
 
-    im *= 255;
+BlockMap removeMarkedPixels(Mat & im, Mat & marker, const vector<Rect> & blocks)
+{
+    // Removes the pixels marked by a thinning iteration and returns the blocks that changed.
+
+    BlockMap changed(im.size());
+    parallel_for_(Range(0, (int)blocks.size()), RemoveMarkedPixelsBody(im, marker, blocks, changed));
+    return changed;
+}
+
+BlockMap thinningGuoHallIteration(Mat & im, Mat & marker, int iter, const BlockMap & active)
+{
+    // Method called while performing a specific
+    // iteration of the Guo Hall thinning. Only the active blocks are
+    // visited and the blocks in which pixels were removed are returned.
+
+    vector<Rect> blocks = active.flaggedRects();
+    if (im.rows > 2)
+        parallel_for_(Range(0, (int)blocks.size()), GuoHallIteration(im, marker, blocks, iter));
+    return removeMarkedPixels(im, marker, blocks);
+}
+
+void thinImageBorder(Mat & im, BlockMap & blocks)
+{
+    // Clears the outermost rows and columns of a thinned image, except where the road
+    // continues from the pixel next to it. Only the border pixels are visited, in the
+    // same order as a scan over the whole image. Blocks that gain a road pixel are
+    // flagged in blocks.
 
     for (int i = 0; i < im.rows; i++)
     {
-        for (int j = 0; j < im.cols; j++)
+        int step = (i == 0 || i == im.rows - 1) ? 1 : max(im.cols - 1, 1);
+        for (int j = 0; j < im.cols; j += step)
         {
             if (i == 0 || j == 0 || i == im.rows - 1 || j == im.cols - 1)
                 im.at<uchar>(i, j) = 0;
@@ -85,49 +158,120 @@ Mat guoHallThinning(Mat im)
 
             if (j == im.cols - 1 && im.at<uchar>(i, j - 1) == 255) //Right col
                 im.at<uchar>(i, j) = 255;
+
+            if (im.at<uchar>(i, j) == 255)
+                blocks.set(i / blocks.blockSize, j / blocks.blockSize);
         }
     }
-    return im;
 }
 
-void thinningZhangSuenIteration(Mat & im, int iter)
+Mat guoHallThinning(Mat im, BlockMap & blocks)
 {
-    // Method called while performing a specific
-    // iteration of the Zhang Suen thinning.
+    // Method returns a thin skeletonized image from a given input image.
+    // blocks must flag every block with a road pixel and is kept up to date for the
+    // thinned image. A pixel can only be removed when its neighbourhood changed since
+    // the last iteration of the same kind, so each iteration only visits the blocks
+    // around the changes of the last two iterations.
+
+    //Convert to grayscale
+    if (im.channels() > 1)
+        cvtColor(im, im, CV_BGR2GRAY);
+
+    im /= 255;
 
     Mat marker = Mat::zeros(im.size(), CV_8UC1);
+    BlockMap changed[2] = {blocks, blocks};
 
-    for (int i = 1; i < im.rows - 1; i++)
+    do {
+        for (int iter = 0; iter < 2; iter++)
+        {
+            BlockMap active = changed[0].unionWith(changed[1]).dilated();
+            changed[iter] = thinningGuoHallIteration(im, marker, iter, active);
+        }
+        cout << "." ;
+    } while (changed[0].count() > 0 || changed[1].count() > 0);
+
+    im *= 255;
+
+    thinImageBorder(im, blocks);
+    return im;
+}
+
+class ZhangSuenIteration : public ParallelLoopBody
+{
+    // Computes the Zhang Suen deletion marker for a range of blocks, see GuoHallIteration.
+
+public:
+    ZhangSuenIteration(const Mat & im, Mat & marker, const vector<Rect> & blocks, int iter)
+        : im(im), marker(marker), blocks(blocks), iter(iter) {}
+
+    void operator()(const Range & range) const
     {
-        for (int j = 1; j < im.cols - 1; j++)
+        for (int pos = range.start; pos < range.end; pos++)
         {
-            uchar p2 = im.at<uchar>(i - 1, j);
-            uchar p3 = im.at<uchar>(i - 1, j + 1);
-            uchar p4 = im.at<uchar>(i, j + 1);
-            uchar p5 = im.at<uchar>(i + 1, j + 1);
-            uchar p6 = im.at<uchar>(i + 1, j);
-            uchar p7 = im.at<uchar>(i + 1, j - 1);
-            uchar p8 = im.at<uchar>(i, j - 1);
-            uchar p9 = im.at<uchar>(i - 1, j - 1);
-
-            int A = (p2 == 0 && p3 == 1) + (p3 == 0 && p4 == 1) +
-            (p4 == 0 && p5 == 1) + (p5 == 0 && p6 == 1) +
-            (p6 == 0 && p7 == 1) + (p7 == 0 && p8 == 1) +
-            (p8 == 0 && p9 == 1) + (p9 == 0 && p2 == 1);
-            int B = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9;
-            int m1 = iter == 0 ? (p2 * p4 * p6) : (p2 * p4 * p8);
-            int m2 = iter == 0 ? (p4 * p6 * p8) : (p2 * p6 * p8);
-
-            if (A == 1 && (B >= 2 && B <= 6) && m1 == 0 && m2 == 0)
-                marker.at<uchar>(i, j) = 1;
+            // The outermost rows and columns of the image are never removed
+            int rowEnd = min(blocks[pos].y + blocks[pos].height, im.rows - 1);
+            int colEnd = min(blocks[pos].x + blocks[pos].width, im.cols - 1);
+
+            for (int i = max(blocks[pos].y, 1); i < rowEnd; i++)
+            {
+                const uchar * above = im.ptr<uchar>(i - 1);
+                const uchar * row = im.ptr<uchar>(i);
+                const uchar * below = im.ptr<uchar>(i + 1);
+                uchar * mark = marker.ptr<uchar>(i);
+
+                for (int j = max(blocks[pos].x, 1); j < colEnd; j++)
+                {
+                    // Background pixels are never removed
+                    if (row[j] == 0)
+                        continue;
+
+                    uchar p2 = above[j];
+                    uchar p3 = above[j + 1];
+                    uchar p4 = row[j + 1];
+                    uchar p5 = below[j + 1];
+                    uchar p6 = below[j];
+                    uchar p7 = below[j - 1];
+                    uchar p8 = row[j - 1];
+                    uchar p9 = above[j - 1];
+
+                    int A = (p2 == 0 && p3 == 1) + (p3 == 0 && p4 == 1) +
+                    (p4 == 0 && p5 == 1) + (p5 == 0 && p6 == 1) +
+                    (p6 == 0 && p7 == 1) + (p7 == 0 && p8 == 1) +
+                    (p8 == 0 && p9 == 1) + (p9 == 0 && p2 == 1);
+                    int B = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9;
+                    int m1 = iter == 0 ? (p2 * p4 * p6) : (p2 * p4 * p8);
+                    int m2 = iter == 0 ? (p4 * p6 * p8) : (p2 * p6 * p8);
+
+                    if (A == 1 && (B >= 2 && B <= 6) && m1 == 0 && m2 == 0)
+                        mark[j] = 1;
+                }
+            }
         }
     }
-    im &= ~marker;
+
+private:
+    const Mat & im;
+    Mat & marker;
+    const vector<Rect> & blocks;
+    int iter;
+};
+
+BlockMap thinningZhangSuenIteration(Mat & im, Mat & marker, int iter, const BlockMap & active)
+{
+    // Method called while performing a specific
+    // iteration of the Zhang Suen thinning, see thinningGuoHallIteration.
+
+    vector<Rect> blocks = active.flaggedRects();
+    if (im.rows > 2)
+        parallel_for_(Range(0, (int)blocks.size()), ZhangSuenIteration(im, marker, blocks, iter));
+    return removeMarkedPixels(im, marker, blocks);
 }
 
-Mat zhangSuenThinning(Mat im)
+Mat zhangSuenThinning(Mat im, BlockMap & blocks)
 {
     // Zhang Suen Thinning Method for perfoming image skeletonization.
+    // Changed blocks are tracked as in guoHallThinning.
 
     //Convert to grayscale
     if (im.channels() > 1)
@@ -135,46 +279,20 @@ Mat zhangSuenThinning(Mat im)
 
     im /= 255;
 
-    Mat prev = Mat::zeros(im.size(), CV_8UC1);
-    Mat diff;
+    Mat marker = Mat::zeros(im.size(), CV_8UC1);
+    BlockMap changed[2] = {blocks, blocks};
 
-    int count = 0;
     do {
-        thinningZhangSuenIteration(im, 0);
-        thinningZhangSuenIteration(im, 1);
-        cv::absdiff(im, prev, diff);
-        im.copyTo(prev);
+        for (int iter = 0; iter < 2; iter++)
+        {
+            BlockMap active = changed[0].unionWith(changed[1]).dilated();
+            changed[iter] = thinningZhangSuenIteration(im, marker, iter, active);
+        }
         cout << ".";
-    } while (cv::countNonZero(diff) > 0);
+    } while (changed[0].count() > 0 || changed[1].count() > 0);
 
     im *= 255;
 
-    for (int i = 0; i < im.rows; i++)
-    {
-        for (int j = 0; j < im.cols; j++)
-        {
-            if (i == 0 || j == 0 || i == im.rows - 1 || j == im.cols - 1)
-            {
-                im.at<uchar>(i, j) = 0;
-            }
-
-            if (i == 0 && im.at<uchar>(i+1,j) == 255) //Top Row
-            {
-                im.at<uchar>(i, j) = 255;
-            }
-            if (i == im.rows - 1 && im.at<uchar>(i-1, j) == 255) // Last row
-            {
-                im.at<uchar>(i, j) = 255;
-            }
-            if (j == 0 && im.at<uchar>(i, j + 1) == 255) // Left col
-            {
-                im.at<uchar>(i, j) = 255;
-            }
-            if (j == im.cols - 1 && im.at<uchar>(i, j - 1) == 255) //Right col
-            {
-                im.at<uchar>(i, j) = 255;
-            }
-        }
-    }
+    thinImageBorder(im, blocks);
     return im;
 }
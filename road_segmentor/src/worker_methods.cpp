@@ -0,0 +1,146 @@
+/*
+ *  Copyright (c) 2017, Facebook, Inc.
+ *  All rights reserved.
+ *
+ *  This file contains the persistent worker mode, which segments any number of images
+ *  sent over stdin without starting a new process or touching the disk for each one.
+ *
+ *  Job:    int32 rows, int32 cols, then rows * cols uint8 grayscale pixels in row major
+ *          order. A job of 0 rows, or closing stdin, stops the worker.
+ *  Result: int32 status, rows, cols, roads, points, nodes, edges and float64 scale, then
+ *          int32 point count of every road, int32 [row, col] of every road point,
+ *          int32 [row, col] of every junction graph node and float64 [from, to, length,
+ *          road] of every junction graph edge.
+ *
+ *  Everything is in native byte order. rows, cols and scale describe the segmented image
+ *  and the roads hold the points writeJSON would write, so a result carries the content
+ *  of roads.json. When status is WORKER_BAD_IMAGE all counts are 0.
+ */
+
+#include "road_segmentation.h"
+#include <cstdio>   //For fread and fwrite on stdin and stdout
+#include <cstdint>  //For int32_t
+
+bool readBytes(void * data, size_t size)
+{
+    return fread(data, 1, size, stdin) == size;
+}
+
+bool skipBytes(int64 size)
+{
+    // Consumes the pixels of a job that is not segmented, so the next job can be read.
+
+    char buffer[1 << 16];
+    while (size > 0)
+    {
+        size_t part = (size_t)min<int64>(size, sizeof(buffer));
+        if (!readBytes(buffer, part))
+            return false;
+        size -= part;
+    }
+    return true;
+}
+
+template <typename T>
+void writeValues(const vector<T> & values)
+{
+    if (!values.empty())
+        fwrite(values.data(), sizeof(T), values.size(), stdout);
+}
+
+int runWorker(double scale, bool components)
+{
+    // Segments images read from stdin until it is closed or a job of 0 rows arrives, and
+    // writes one result per job to stdout. Returns 1 when a job is cut short.
+
+    // Progress messages go to stderr, stdout only carries results
+    streambuf * coutBuffer = cout.rdbuf(cerr.rdbuf());
+    int status = 0;
+    int32_t size[2];
+    while (readBytes(size, sizeof(size)) && size[0] > 0)
+    {
+        int64 pixels = (int64)size[0] * max(size[1], (int32_t)0);
+        vector<int32_t> header(7, 0);
+        header[0] = WORKER_BAD_IMAGE;
+        double jobScale = scale;
+        vector<int32_t> counts, points, nodes;
+        vector<double> edges;
+
+        if (pixels <= 0 || pixels > WORKER_MAX_PIXELS)
+        {
+            cout << "Image size is either too big, or the image is empty. Skipping..." << endl;
+            if (!skipBytes(pixels))
+            {
+                status = 1;
+                break;
+            }
+        }
+        else
+        {
+            vector<uchar> data((size_t)pixels);
+            if (!readBytes(data.data(), data.size()))
+            {
+                status = 1;
+                break;
+            }
+            Mat image(size[0], size[1], CV_8U, data.data());
+            vector<Point> cornerVector;
+            if (prepareImage(image, jobScale))
+            {
+                segmentImage(image, components, cornerVector);
+                json junctionGraph = buildJunctionGraph(image, cornerVector);
+
+                // Keep the same points as writeJSON
+                Rect bounds(0, 0, image.cols, image.rows);
+                for (int i = 0; i < roadLabels.size(); i++)
+                {
+                    int count = 0;
+                    for (int pos = 0; pos < roadLabels[i].size(); pos++)
+                    {
+                        if (bounds.contains(roadLabels[i][pos]))
+                        {
+                            points.push_back(roadLabels[i][pos].y);
+                            points.push_back(roadLabels[i][pos].x);
+                            count++;
+                        }
+                    }
+                    counts.push_back(count);
+                }
+                for (auto & node : junctionGraph["nodes"])
+                {
+                    nodes.push_back(node[0].get<int32_t>());
+                    nodes.push_back(node[1].get<int32_t>());
+                }
+                for (auto & edge : junctionGraph["edges"])
+                {
+                    for (int value = 0; value < 4; value++)
+                        edges.push_back(edge[value].get<double>());
+                }
+
+                header[0] = WORKER_OK;
+                header[1] = image.rows;
+                header[2] = image.cols;
+                header[3] = (int32_t)counts.size();
+                header[4] = (int32_t)(points.size() / 2);
+                header[5] = (int32_t)(nodes.size() / 2);
+                header[6] = (int32_t)(edges.size() / 4);
+            }
+
+            // Free the memory of the roads before the next job
+            roadLabels.clear();
+            roadIdImage.release();
+            sharedRoadPixels.clear();
+        }
+
+        writeValues(header);
+        fwrite(&jobScale, sizeof(jobScale), 1, stdout);
+        writeValues(counts);
+        writeValues(points);
+        writeValues(nodes);
+        writeValues(edges);
+        fflush(stdout);
+    }
+
+    cout.rdbuf(coutBuffer);
+    return status;
+}
@@ -15,12 +15,14 @@ from __future__ import unicode_literals
 
 import argparse
 import logging
+from multiprocessing import cpu_count
 from os import makedirs
 from os.path import exists
 import sys
 from util import generate_osm_rtree
 from util import safal_functions
 from util import osm2geotiff
+from util import planner
 
 
 ALLOWED_EXTENSIONS_INPUT = set(['tif', 'tiff'])
@@ -58,7 +60,8 @@ def create_logger(args):
     return logger
 
 
-def osm_rtree_generator(ntr_json, gps, out_dir, logger):
+def osm_rtree_generator(ntr_json, gps, out_dir, logger,
+                        lookup_cell_size=None):
     """
     Generates OSM and Rtree data
 
@@ -66,10 +69,80 @@ def osm_rtree_generator(ntr_json, gps, out_dir, logger):
     :param gps: lat and lon bounding box info of input
     :param out_dir: directory to save results
     :param logger: logger object for logging
+    :param lookup_cell_size: cell size in meters of the forward geocode
+                             lookup grid, no grid is built if None
     """
     logger.info('Generating Roads OSM file')
     generate_osm_rtree.main(ntr_json, out_dir,
-                            gps[0], gps[1], gps[2], gps[3], logger)
+                            gps[0], gps[1], gps[2], gps[3], logger,
+                            lookup_cell_size)
+
+
+def resources(args):
+    """
+    Memory budget and cores a run may use
+
+    :param args: input arguments
+    :return: (budget in bytes, cores)
+    """
+    budget = args['memory_budget'] * 2**30 if args['memory_budget'] \
+        else planner.memory_budget()
+    return budget, args['cores'] or cpu_count()
+
+
+def scale_type(value):
+    """
+    argparse type of --scale
+
+    :param value: auto or a resize factor in (0, 1]
+    :return: 'auto' or the factor
+    """
+    if value == 'auto':
+        return value
+    try:
+        factor = float(value)
+    except ValueError:
+        factor = None
+    if factor is None or not 0 < factor <= 1:
+        raise argparse.ArgumentTypeError(
+            'expected auto or a factor in (0, 1], got %r' % value)
+    return factor
+
+
+def apply_plan(args, plan, logger):
+    """
+    Logs a plan and fills in the settings that were not given. The run
+    stops on the problems of the plan only when the memory budget was
+    given and --force was not, as the estimates are rough.
+
+    :param args: input arguments, updated with the planned settings
+    :param plan: util.planner.Plan
+    :param logger: logger object for logging
+    """
+    strict = args['memory_budget'] is not None and not args['force']
+    plan.log(logger, strict)
+    for key, value in plan.settings.items():
+        if args.get(key) is None:
+            args[key] = value
+    if not plan.feasible and strict:
+        logger.error('The run does not fit its resources, lower the '
+                     'settings or run it anyway with --force')
+        sys.exit(-1)
+
+
+def plan_segmentation(args, info, logger):
+    """
+    Plans segmenting and clustering a road raster, see apply_plan
+
+    :param args: input arguments, updated with the planned settings
+    :param info: the raster as returned by util.planner.inspect_raster
+    :param logger: logger object for logging
+    """
+    budget, cores = resources(args)
+    apply_plan(args, planner.plan_raster(
+        info, budget, cores, args['scale'], args['threads'],
+        args['cluster_block_size'], args['workers']
+    ), logger)
 
 
 def main(args, out_fn, logger):
@@ -83,6 +156,12 @@ def main(args, out_fn, logger):
     out_dir = args['out_dir']
     if not exists(out_dir):
         makedirs(out_dir)
+    # Planning the segmentation and clustering for the road raster
+    raster = args['input_tiff'] if args['input_tiff'] is not None else out_fn
+    plan_segmentation(args, planner.inspect_raster(raster), logger)
+    if args['plan_only']:
+        return
+
     # Creating a safal object
     safal_layers = safal_functions.SAFAL(args, out_fn, out_dir, logger)
 
@@ -96,7 +175,8 @@ def main(args, out_fn, logger):
 
     # Get bounding box info
     gps = safal_layers.cal_gps()
-    osm_rtree_generator(ntr_json, gps, out_dir, logger)
+    osm_rtree_generator(ntr_json, gps, out_dir, logger,
+                        args.get('lookup_cell_size'))
 
 
 if __name__ == '__main__':
@@ -106,7 +186,7 @@ if __name__ == '__main__':
         help='Path to input geotiff tile')
     parser.add_argument(
         '--xml', default=None, type=str,
-        help='Path to input Osm file')
+        help='Path to input Osm file, .osm or .osm.pbf')
     parser.add_argument(
         '--out_dir', required=True, type=str,
         help='Output dir where all results will be written')
@@ -115,10 +195,50 @@ if __name__ == '__main__':
         help='Binary for road segmentation')
     parser.add_argument(
         '--centre_row', required=False, type=int,
-        help='Row dimension of city center')
+        help='Row dimension of city center in the segmented image')
     parser.add_argument(
         '--centre_col', required=False, type=int,
-        help='Column dimension of city center')
+        help='Column dimension of city center in the segmented image')
+    parser.add_argument(
+        '--threads', required=False, type=int,
+        help='Threads used by the road segmentor, defaults to all cores')
+    parser.add_argument(
+        '--scale', required=False, type=scale_type,
+        help='Resize factor in (0, 1] applied by the road segmentor, '
+             'defaults to 0.5. auto picks the coarsest factor that keeps '
+             'neighbouring roads apart')
+    parser.add_argument(
+        '--components', action='store_true',
+        help='Segment disconnected road networks separately, in parallel')
+    parser.add_argument(
+        '--pixels_per_degree', required=False, type=float,
+        help='Resolution of the geotiff drawn from an Osm file, defaults to '
+             'about half a metre per pixel, lowered to fit the segmentor')
+    parser.add_argument(
+        '--cluster_block_size', required=False, type=int,
+        help='Cluster spatial blocks of this many pixels in parallel')
+    parser.add_argument(
+        '--workers', required=False, type=int,
+        help='Number of worker processes, defaults to the cpu count')
+    parser.add_argument(
+        '--lookup_cell_size', required=False, type=float,
+        help='Also build a forward geocode lookup grid with cells of this '
+             'many meters, e.g. 10')
+    parser.add_argument(
+        '--memory_budget', required=False, type=float,
+        help='Gigabytes of memory the run may use, defaults to the physical '
+             'memory. Settings that are not given are chosen to fit it. '
+             'When given, a run that does not fit stops unless --force')
+    parser.add_argument(
+        '--cores', required=False, type=int,
+        help='Cores the run may use, defaults to the cpu count')
+    parser.add_argument(
+        '--plan_only', action='store_true',
+        help='Log the estimated time and memory of every stage and the '
+             'chosen settings, and stop before road segmentation')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Run even when the estimates exceed the memory budget')
     args = vars(parser.parse_args())
 
     # getting logger object
@@ -139,8 +259,22 @@ if __name__ == '__main__':
         filename = args['xml'].split('/')[-1].split('.')[0]
         logger.info('Reading OSM file')
         filepath = args['out_dir'] + '/' + filename + '.tif'
+        budget, cores = resources(args)
+        osm_info = planner.inspect_osm(args['xml'])
+        apply_plan(args, planner.plan_osm(
+            osm_info, budget, cores, args['pixels_per_degree'],
+            osm2geotiff.PIXELS_PER_DEGREE, args['scale']
+        ), logger)
+        if args['plan_only']:
+            # the raster is estimated at the planned resolution, not drawn
+            if osm_info['bounds'] is not None:
+                plan_segmentation(args, planner.estimate_raster(
+                    osm_info, args['pixels_per_degree']
+                ), logger)
+            sys.exit(0)
         # Converting OSM to geotiff image
-        osm2geotiff.main(args['xml'], filepath)
+        osm2geotiff.main(args['xml'], filepath, args['pixels_per_degree'],
+                         args['workers'])
         out_fn = filepath
         logger.info('Running end2end with OSM as input')
         main(args, out_fn, logger)
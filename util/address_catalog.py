@@ -0,0 +1,122 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Catalog of every robocode of a city with its lat lon
+
+    Every street of name_to_road gets a row per meter and block letter,
+    holding the point gen_robocode.get_lat_lon returns for that robocode.
+    The rows are computed in chunks of whole streets with the vectorized
+    reverse geocoder of round_trip, which walks every street once, and are
+    written to one memory mapped .npy file per column.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import numpy as np
+import os
+from util.round_trip import Reverse, py2_round
+
+
+CATALOG_DIR = 'address_catalog'
+BLOCKS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+CHUNK = 1 << 20  # rows per chunk, streets are not split
+COLUMNS = [('street', np.int32), ('meter', np.int32), ('block', np.uint8),
+           ('lat', np.float64), ('lon', np.float64)]
+
+
+def export(name_to_road, geo, o_dir, blocks=BLOCKS, chunk=CHUNK):
+    """ writes the catalog of a city to o_dir/address_catalog and returns
+        the number of streets, skipped streets and rows
+
+        Keyword arguments:
+        name_to_road -- dict of street name to road pixels
+        geo -- GeoTransform between the road pixels and lat lon
+        o_dir -- output directory
+        blocks -- block letters to list for every meter
+        chunk -- rows computed at a time
+    """
+    reverse = Reverse(name_to_road, geo)
+    # the largest meter get_address_city gives on each street, see round_trip
+    total = reverse.walked[reverse.last]
+    meters = (2 * py2_round(total / 2) + 2).astype(np.int64)
+    # get_lat_lon cannot walk a road of a single point
+    meters[reverse.first == reverse.last] = 0
+    rows = meters * len(blocks)
+    block_codes = np.array([ord(block) for block in blocks], dtype=np.int64)
+
+    catalog_dir = os.path.join(o_dir, CATALOG_DIR)
+    if not os.path.exists(catalog_dir):
+        os.makedirs(catalog_dir)
+    count = int(rows.sum())
+    columns = dict((name, np.lib.format.open_memmap(
+        os.path.join(catalog_dir, name + '.npy'), mode='w+', dtype=dtype,
+        shape=(count,)
+    )) for name, dtype in COLUMNS)
+
+    # chunks of whole streets
+    ends = np.cumsum(rows)
+    starts = ends - rows
+    street = 0
+    while street < len(rows):
+        last = max(int(np.searchsorted(ends, starts[street] + chunk,
+                                       side='right')), street + 1)
+        numbers = np.arange(street, last)
+        start, stop = int(starts[street]), int(ends[last - 1])
+        row_street = np.repeat(numbers, rows[numbers])
+        row = np.arange(start, stop) - starts[row_street]
+        meter = row // len(blocks)
+        block = block_codes[row % len(blocks)]
+        lat, lon = reverse(row_street, meter, block)
+
+        columns['street'][start:stop] = row_street
+        columns['meter'][start:stop] = meter
+        columns['block'][start:stop] = block
+        columns['lat'][start:stop] = lat
+        columns['lon'][start:stop] = lon
+        street = last
+    for column in columns.values():
+        column.flush()
+
+    stats = {'streets': int((meters > 0).sum()),
+             'skipped': int((meters == 0).sum()), 'rows': count}
+    with open(os.path.join(catalog_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(stats, names=reverse.names, blocks=blocks,
+                       bounds=list(geo.bounds)), f)
+    return stats
+
+
+class AddressCatalog(object):
+    """ memory mapped catalog of one city, see export """
+
+    def __init__(self, catalog_dir):
+        meta = json.load(open(os.path.join(catalog_dir, 'meta.json')))
+        self.names = meta['names']
+        self.blocks = meta['blocks']
+        for name, _ in COLUMNS:
+            setattr(self, name, np.load(
+                os.path.join(catalog_dir, name + '.npy'), mmap_mode='r'
+            ))
+
+    def __len__(self):
+        return len(self.street)
+
+    def codes(self, start, stop, city):
+        """ robocodes of rows start to stop """
+        return [str(meter) + chr(block) + '.' + self.names[street] + '.' +
+                city for street, meter, block in zip(
+                    self.street[start:stop].tolist(),
+                    self.meter[start:stop].tolist(),
+                    self.block[start:stop].tolist())]
+
+
+def load(path):
+    """ returns the catalog stored under path """
+    return AddressCatalog(os.path.join(path, CATALOG_DIR))
@@ -0,0 +1,181 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Vectorized area and nearest street queries over R-tree edges
+
+    The functions take edges in the form stored in the R-tree, that is
+    ((lat1, lon1), (lat2, lon2), meters along the street, street name), and
+    work on all of them in a few numpy calls. They treat lat lon as a
+    plane, which holds at street distances.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+from util.utils import EARTH_RADIUS
+
+
+METER = 5  # meters per robocode meter
+
+
+def edge_table(edges):
+    """ returns an (E, 5) array of lat1, lon1, lat2, lon2, meters and the
+        list of street names of the edges
+    """
+    table = np.array(
+        [edge[0] + edge[1] + (edge[2],) for edge in edges], dtype=np.float64
+    ).reshape(-1, 5)
+    return table, [edge[3] for edge in edges]
+
+
+def haversines(lat1, lon1, lat2, lon2):
+    """ utils.haversine of arrays of points """
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) \
+        * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS
+
+
+def line_feet(lat, lon, lat1, lon1, lat2, lon2):
+    """ returns (lat, lon, on) arrays of the foot of the perpendicular from
+        every point to the line through its edge as utils.get_closest_point
+        computes it, in degrees, and whether utils.on_segment holds for it
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = (lon2 - lon1) / (lat2 - lat1)
+        m2 = -1 / m1
+        x = (m1 * lat1 - m2 * lat + lon - lon1) / (m1 - m2)
+        y = m2 * (x - lat) + lon
+    x = np.where(lat1 == lat2, lat1, np.where(lon1 == lon2, lat, x))
+    y = np.where(lat1 == lat2, lon, np.where(lon1 == lon2, lon1, y))
+    on = (np.minimum(lat1, lat2) < x) & (x < np.maximum(lat1, lat2))
+    return x, y, on
+
+
+def closest_points(lat, lon, lat1, lon1, lat2, lon2):
+    """ utils.get_closest_point of arrays of points and edges, returns
+        (close_lat, close_lon) arrays
+    """
+    x, y, on = line_feet(lat, lon, lat1, lon1, lat2, lon2)
+    far = haversines(lat1, lon1, lat, lon) > haversines(lat2, lon2, lat, lon)
+    # off the segment, the result is (lat2, lon2), or (lat1, lon2) when the
+    # first end is the farther one
+    return np.where(on, x, np.where(far, lat1, lat2)), np.where(on, y, lon2)
+
+
+def polygon_intervals(table, polygon):
+    """ returns (edge, t0, t1) arrays of the parts of the edges inside the
+        polygon, where the part of edge e from t0 to t1 runs from
+        lat1 + t0 * (lat2 - lat1) to lat1 + t1 * (lat2 - lat1), and likewise
+        for lon
+
+        Keyword arguments:
+        table -- edge table, see edge_table
+        polygon -- list of (lat, lon) corners, the last one joins the first
+    """
+    corners = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    p1, p2 = corners, np.roll(corners, -1, axis=0)
+    a, b = table[:, None, 0:2], table[:, None, 2:4]
+    d, s = b - a, (p2 - p1)[None]
+    # t and u of the crossing a + t * d == p1 + u * s of every edge and side
+    denom = d[..., 0] * s[..., 1] - d[..., 1] * s[..., 0]
+    diff = p1[None] - a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (diff[..., 0] * s[..., 1] - diff[..., 1] * s[..., 0]) / denom
+        u = (diff[..., 0] * d[..., 1] - diff[..., 1] * d[..., 0]) / denom
+    crossing = (denom != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+
+    # every edge splits at its crossings, each piece is inside or outside
+    count = len(table)
+    edge = np.concatenate([np.arange(count), np.arange(count),
+                           np.nonzero(crossing)[0]])
+    cut = np.concatenate([np.zeros(count), np.ones(count), t[crossing]])
+    order = np.lexsort((cut, edge))
+    edge, cut = edge[order], cut[order]
+    piece = np.nonzero((edge[1:] == edge[:-1]) & (cut[1:] > cut[:-1]))[0]
+    edge, t0, t1 = edge[piece], cut[piece], cut[piece + 1]
+
+    begin = table[edge, 0:2]
+    mid = begin + ((t0 + t1) / 2)[:, None] * (table[edge, 2:4] - begin)
+    inside = inside_polygon(mid[:, 0], mid[:, 1], corners)
+    return edge[inside], t0[inside], t1[inside]
+
+
+def inside_polygon(lat, lon, corners):
+    """ even-odd rule test of lat lon arrays against polygon corners """
+    p1, p2 = corners[None], np.roll(corners, -1, axis=0)[None]
+    lat, lon = lat[:, None], lon[:, None]
+    spans = (p1[..., 0] > lat) != (p2[..., 0] > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross_lon = p1[..., 1] + (lat - p1[..., 0]) \
+            * (p2[..., 1] - p1[..., 1]) / (p2[..., 0] - p1[..., 0])
+    return (np.count_nonzero(spans & (lon < cross_lon), axis=1) % 2) == 1
+
+
+def street_ranges(table, names, edge, t0, t1):
+    """ returns (street, side, first meter, last meter) tuples of the meter
+        ranges covered by parts of edges, in street order
+
+        Parts of a street that follow each other form one range. The even
+        meters are on the left of the street's direction and the odd ones
+        on its right, rounded as gen_robocode rounds them.
+    """
+    if not len(edge):
+        return []
+    length = haversines(table[edge, 0], table[edge, 1], table[edge, 2],
+                        table[edge, 3])
+    start = (table[edge, 4] + t0 * length) / METER
+    end = (table[edge, 4] + t1 * length) / METER
+    street = np.array([names[e] for e in edge.tolist()], dtype=object)
+    order = np.lexsort((start, street))
+    street, start, end = street[order], start[order], end[order]
+
+    # a new range starts at a new street or after a gap in meters, the
+    # parts of a street never overlap
+    new = np.ones(len(street), dtype=bool)
+    new[1:] = (street[1:] != street[:-1]) | (start[1:] > end[:-1] + 1e-6)
+    first = np.nonzero(new)[0]
+    start = start[first]
+    end = end[np.append(first[1:], len(street)) - 1]
+
+    # meters are rounded half up to an even number, odd ones are one more
+    even_first = 2 * np.floor(start / 2 + 0.5)
+    even_last = 2 * np.floor(end / 2 + 0.5)
+    ranges = []
+    for name, lo, hi in zip(street[first].tolist(), even_first.tolist(),
+                            even_last.tolist()):
+        ranges.append((name, 'even', int(lo), int(hi)))
+        ranges.append((name, 'odd', int(lo) + 1, int(hi) + 1))
+    return ranges
+
+
+def street_distances(table, names, lat, lon):
+    """ returns (meters, edge) arrays of the closest edge of every street to
+        lat lon, closest street first. Distances are measured to the point
+        utils.get_closest_point picks, as the addresses are.
+
+        Keyword arguments:
+        table -- edge table, see edge_table
+        names -- street name of every edge
+        lat -- latitude (float)
+        lon -- longitude (float)
+    """
+    close_lat, close_lon = closest_points(lat, lon, table[:, 0], table[:, 1],
+                                          table[:, 2], table[:, 3])
+    dist = haversines(close_lat, close_lon, lat, lon)
+
+    street = np.array(names, dtype=object)
+    # closest edge of every street, ties go to the first edge, in R-tree
+    # order as with gen_robocode.closest_address
+    order = np.lexsort((np.arange(len(dist)), dist, street))
+    first = order[np.append(True, street[order][1:] != street[order][:-1])] \
+        if len(order) else order
+    first = first[np.lexsort((first, dist[first]))]
+    return dist[first], first
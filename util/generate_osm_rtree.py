@@ -14,19 +14,25 @@ import argparse
 import json
 from lxml import etree
 import math
+import numpy as np
 from pickle import dump
 from rtree import index
 import random
 import sys
-from util.utils import convert, haversine, bbox, parse_roads, rtree_for_way_edges
+from util import lookup_grid
+from util import name_index
+from util.utils import GeoTransform, haversine, bbox, parse_roads, \
+    rtree_for_way_edges, rtree_order, way_edges
 
 
 REGION_LIST = ['residential', 'industrial', 'greenfield', 'farm',
                     'recreation_ground', 'allotments', 'cemetery']
 
 
-def main(dim_name_road, o_dir, minlat, maxlat, minlon, maxlon, logger):
-    """ creates and saves osm file and rtree (.dat, .idx) files from json
+def main(dim_name_road, o_dir, minlat, maxlat, minlon, maxlon, logger,
+         lookup_cell_size=None):
+    """ creates and saves osm file, rtree (.dat, .idx) and name index files
+        from json
 
         Keyword arguments:
         dim_name_road -- json of dimensions of pixel image and name_to_road json
@@ -36,12 +42,21 @@ def main(dim_name_road, o_dir, minlat, maxlat, minlon, maxlon, logger):
         minlon -- minimum longitude
         maxlon -- maximum longitude
         logger -- logger
+        lookup_cell_size -- if set, also build a lookup_grid with cells of
+                            this many meters for fast forward geocoding
     """
 
     row, col = dim_name_road[0]["height"], dim_name_road[0]["width"]
     ntr = dim_name_road[1]
 
-    convert(minlat, minlon, maxlat, maxlon, row, col)
+    geo = GeoTransform(minlat, minlon, maxlat, maxlon, row, col)
+    roads = list(ntr.items())
+    points = np.array(
+        [point[:2] for name, road in roads for point in road], dtype=np.int64
+    ).reshape(-1, 2)
+    lats, lons = geo.pixel_to_latlon(points[:, 0], points[:, 1])
+    lats, lons = iter(lats.tolist()), iter(lons.tolist())
+
     root = etree.Element("osm", version="0.6", generator="JOSM")
     etree.SubElement(root, "bounds", minlat=str(minlat),
                         minlon=str(minlon),
@@ -49,13 +64,10 @@ def main(dim_name_road, o_dir, minlat, maxlat, minlon, maxlon, logger):
                         maxlon=str(maxlon))
     i = 1
     id_list = []
-    for name, road in ntr.items():
+    for name, road in roads:
         id_list.append([name])
-        length = len(road) - 1
-        for index, point in enumerate(road):
-            x, y, d = point
-
-            _lat, _lon = convert.x_to_lat(x), convert.y_to_lon(y)
+        for point in road:
+            _lat, _lon = next(lats), next(lons)
             etree.SubElement(root, "node", id=str(i),
                                 lat=str(_lat), lon=str(_lon),
                                 version="1")
@@ -80,5 +92,16 @@ def main(dim_name_road, o_dir, minlat, maxlat, minlon, maxlon, logger):
     logger.info('OSM file written successfully at: ' + osm_path)
 
     nodes, ways = parse_roads(root)
-    rtree_for_way_edges(ways, nodes, o_dir)
+    rtree_idx = rtree_for_way_edges(ways, nodes, o_dir)
+    logger.info('Name index written with %(streets)d streets in %(regions)d '
+                'regions', name_index.build(ways, nodes, o_dir))
+    if lookup_cell_size:
+        stats = lookup_grid.build(
+            [edge for _, edge in way_edges(ways, nodes)], geo, o_dir,
+            lookup_cell_size, ranks=rtree_order(rtree_idx)
+        )
+        logger.info('Lookup grid written with %(cells)d cells: %(served)d '
+                    'served (%(single)d by a single edge), %(empty)d empty, '
+                    '%(fallback)d R-tree fallbacks, %(stored_blocks)d of '
+                    '%(blocks)d blocks stored', stats)
     logger.info('All processes finished successfully!')
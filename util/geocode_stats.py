@@ -0,0 +1,176 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Counters and timing histograms of the geocoding hot paths
+
+    Every query of get_address_city, TraceMatcher and get_lat_lon is
+    counted, along with whether it missed and its number of candidates:
+    the edges the closest one is picked from, or for get_lat_lon the points
+    of the street that is walked. The clock is only read for one query in
+    SAMPLE_EVERY, whose index query and geometry times go to power of two
+    histograms, which keeps the overhead small at a high query rate. Loads
+    of the data of a city are rare and always timed. The stats of a process
+    are kept in STATS and can be read with snapshot or written as json with
+    dump.
+
+    The counters are not locked, queries on several threads may lose a few
+    counts.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import json
+from timeit import default_timer as timer
+
+
+SAMPLE_EVERY = 16  # queries per timed query
+BUCKETS = 32  # histogram buckets, the last one holds everything larger
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Histogram(object):
+    """ counts of non negative integers in power of two buckets, bucket i
+        holds the values below 2 ** i that are not in bucket i - 1, the last
+        bucket all values from 2 ** (BUCKETS - 2) on
+    """
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        value = int(value)
+        self.buckets[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q quantile """
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= q * self.count:
+                if i == BUCKETS - 1:
+                    return self.max
+                return min((1 << i) - 1, self.max)
+        return 0
+
+    @staticmethod
+    def label(i):
+        """ name of bucket i """
+        if i == BUCKETS - 1:
+            return '>=%d' % (1 << (BUCKETS - 2))
+        return '<%d' % (1 << i)
+
+    def summary(self):
+        """ dict with the count, mean, max, quantile bounds and the counts
+            of the non empty buckets keyed by their bounds
+        """
+        summary = {'count': self.count, 'max': self.max,
+                   'mean': self.total / self.count if self.count else 0.0,
+                   'buckets': dict((self.label(i), count) for i, count in
+                                   enumerate(self.buckets) if count)}
+        for q in QUANTILES:
+            summary['p%d' % round(q * 100)] = self.quantile(q)
+        return summary
+
+
+class GeocodeStats(object):
+    """ counters, histograms and load times of the geocoding queries
+
+        Timings are kept in microseconds.
+    """
+
+    def __init__(self, sample_every=SAMPLE_EVERY):
+        """
+        Keyword arguments:
+        sample_every -- queries per timed query, 1 times all of them and 0
+                        none
+        """
+        self.sample_every = sample_every
+        self.reset()
+
+    def reset(self):
+        self.started = timer()
+        self.ticks = 0
+        self.counters = defaultdict(int)
+        self.candidates = defaultdict(Histogram)
+        self.timings = defaultdict(Histogram)
+        self.loads = defaultdict(lambda: [0, 0.0])
+
+    def sample(self):
+        """ True for the queries whose time is measured """
+        self.ticks += 1
+        return self.sample_every > 0 and self.ticks % self.sample_every == 0
+
+    def count(self, name):
+        """ counts an event of name """
+        self.counters[name] += 1
+
+    def query(self, name, candidates=None, miss=False):
+        """ counts a query of name, its number of candidate edges and
+            whether it found no address
+        """
+        self.counters[name] += 1
+        if miss:
+            self.counters[name + '_miss'] += 1
+        if candidates is not None:
+            self.candidates[name].add(candidates)
+
+    def time(self, name, start, end):
+        """ adds the time between the timer readings start and end to the
+            histogram of name
+        """
+        self.timings[name].add((end - start) * 1e6)
+
+    def load(self, path, kind, start):
+        """ adds the time since the timer reading start to the loads of
+            kind of the city under path
+        """
+        seconds = timer() - start
+        load = self.loads[(path, kind)]
+        load[0] += 1
+        load[1] += seconds
+
+    def snapshot(self):
+        """ returns the stats as a json serializable dict """
+        loads = defaultdict(dict)
+        for (path, kind), (count, seconds) in list(self.loads.items()):
+            loads[path][kind] = {'count': count, 'seconds': seconds}
+        return {
+            'seconds': timer() - self.started,
+            'sample_every': self.sample_every,
+            'counters': dict(self.counters),
+            'candidates': dict((name, histogram.summary()) for name, histogram
+                               in list(self.candidates.items())),
+            'timings_us': dict((name, histogram.summary()) for name, histogram
+                               in list(self.timings.items())),
+            'loads': dict(loads),
+        }
+
+    def dump(self, path):
+        """ writes the snapshot to path as json """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+
+STATS = GeocodeStats()
+
+
+def snapshot():
+    """ stats of the geocoding queries of this process, see
+        GeocodeStats.snapshot
+    """
+    return STATS.snapshot()
@@ -0,0 +1,408 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Precomputed lookup grid for forward geocoding without the R-tree
+
+    The city bounds are split into square cells of a few meters. Every cell
+    stores the short list of road edges that can be closest to a point in
+    the cell, so a query is an array index plus a closest point evaluation
+    per listed edge, usually just one. Cells with no road in reach of the
+    R-tree query answer "No address" and cells whose answer would need more
+    candidates fall back to the R-tree. The grid is kept in blocks, blocks
+    with a single answer are stored as that answer only, and all arrays are
+    memory mapped when loaded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import math
+import numpy as np
+import os
+from timeit import default_timer as timer
+from util import geocode_stats
+from util.edge_query import haversines, line_feet
+from util.utils import GeoTransform
+
+
+GRID_DIR = 'lookup_grid'
+CELL_SIZE = 10  # side of a cell in meters
+MAX_CANDIDATES = 8
+BLOCK_SIZE = 64  # side of a stored block in cells
+SEARCH_RADIUS = 130  # meters, half side of utils.get_bounding_box
+# slack for the R-tree box and the distances, which are measured on a plane
+SEARCH_SLACK = 0.1
+DIST_SLACK = 0.01
+PAIR_CHUNK = 1 << 20  # cell and edge pairs evaluated at a time
+
+EMPTY = -1  # no address
+FALLBACK = -2  # ask the R-tree
+
+_grids = {}
+
+
+def segment_distance(north, east, n1, e1, n2, e2):
+    """ distance in meters of points to line segments, all arrays in local
+        meters of the same shape
+    """
+    dn, de = n2 - n1, e2 - e1
+    length = dn * dn + de * de
+    t = ((north - n1) * dn + (east - e1) * de) / np.where(length, length, 1)
+    t = np.clip(t, 0, 1)
+    return np.hypot(north - n1 - t * dn, east - e1 - t * de)
+
+
+def cell_boxes(edges, cells, reach):
+    """ returns (first_i, first_j, width, count) arrays of the cells whose
+        centre is within reach meters of the bounding box of every edge, the
+        cells of an edge are count cells in rows of width starting at
+        first_i, first_j
+
+        Keyword arguments:
+        edges -- (n, 4) array of north1, east1, north2, east2 in meters
+        cells -- (rows, cols, cell size) of the grid
+        reach -- distance from the edge boxes in meters
+    """
+    rows, cols, size = cells
+    lo_n = np.minimum(edges[:, 0], edges[:, 2]) - reach
+    hi_n = np.maximum(edges[:, 0], edges[:, 2]) + reach
+    lo_e = np.minimum(edges[:, 1], edges[:, 3]) - reach
+    hi_e = np.maximum(edges[:, 1], edges[:, 3]) + reach
+    # cells whose centre lies in the grown box
+    first_i = np.maximum(np.ceil(lo_n / size - 0.5), 0).astype(np.int64)
+    last_i = np.minimum(np.floor(hi_n / size - 0.5), rows - 1) \
+        .astype(np.int64)
+    first_j = np.maximum(np.ceil(lo_e / size - 0.5), 0).astype(np.int64)
+    last_j = np.minimum(np.floor(hi_e / size - 0.5), cols - 1) \
+        .astype(np.int64)
+    width = np.maximum(last_j - first_j + 1, 0)
+    return first_i, first_j, width, np.maximum(last_i - first_i + 1, 0) * width
+
+
+def pair_chunks(counts, pairs=PAIR_CHUNK):
+    """ yields (start, stop) ranges of edges with about pairs cells in all,
+        an edge with more cells is a range of its own
+    """
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        stop = max(int(np.searchsorted(ends, ends[start] - counts[start] +
+                                       pairs, side='right')), start + 1)
+        yield start, stop
+        start = stop
+
+
+def cell_edge_pairs(boxes, start, stop):
+    """ returns (i, j, edge) arrays of the cells of edges start to stop,
+        see cell_boxes
+    """
+    first_i, first_j, width, counts = [box[start:stop] for box in boxes]
+    edge = np.repeat(np.arange(start, stop), counts)
+    step = np.arange(len(edge)) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    return first_i[edge - start] + step // width[edge - start], \
+        first_j[edge - start] + step % width[edge - start], edge
+
+
+def pair_lower(local, i, j, edge, size):
+    """ returns a lower bound in meters of the distance
+        gen_robocode.closest_address measures from the points of cell i, j
+        to its closest point of edge
+
+        utils.get_closest_point gives the foot of the perpendicular in
+        degrees when utils.on_segment holds for it, else the second end of
+        the edge or the corner (lat1, lon2) of its bounding box. The
+        distance is therefore at least that to the edge or to the corner.
+    """
+    n1, e1, n2, e2 = [local[edge, k] for k in range(4)]
+    north, east = (i + 0.5) * size, (j + 0.5) * size
+    return np.minimum(segment_distance(north, east, n1, e1, n2, e2),
+                      np.hypot(north - n1, east - e2)) - \
+        size * math.sqrt(2) / 2
+
+
+def pair_upper(table, i, j, edge, geo, size):
+    """ returns an upper bound in meters of the distance measured as in
+        pair_lower
+
+        Over a cell where the foot is always on the segment the distance is
+        convex, and otherwise below the largest distance to the ends and the
+        corner, which is convex too. Both reach their largest value at a
+        corner of the cell.
+    """
+    lat1, lon1, lat2, lon2 = [table[edge, k] for k in range(4)]
+    on_all = np.ones(len(edge), dtype=bool)
+    foot = np.zeros(len(edge))
+    ends = np.zeros(len(edge))
+    for corner_i, corner_j in [(i, j), (i + 1, j), (i, j + 1),
+                               (i + 1, j + 1)]:
+        lat, lon = geo.local_to_latlon(corner_i * size, corner_j * size)
+        x, y, on = line_feet(lat, lon, lat1, lon1, lat2, lon2)
+        on_all &= on
+        foot = np.maximum(foot, haversines(lat, lon, x, y))
+        ends = np.maximum.reduce([ends, haversines(lat, lon, lat1, lon1),
+                                  haversines(lat, lon, lat2, lon2),
+                                  haversines(lat, lon, lat1, lon2)])
+    return np.where(on_all, foot, ends)
+
+
+def build(edges, geo, o_dir, cell_size=CELL_SIZE,
+          max_candidates=MAX_CANDIDATES, ranks=None):
+    """ rasterizes the lookup grid of a city and saves it in o_dir
+
+        A cell lists every edge that can be closest to some point of the
+        cell: edges whose lower distance bound over the cell is below the
+        smallest upper bound of any edge, see pair_lower and pair_upper.
+        The list is in the order the R-tree returns the edges, so ties go to
+        the same edge as with the R-tree.
+
+        Keyword arguments:
+        edges -- list of (lat1, lon1), (lat2, lon2), meters, name edges in
+                 R-tree id order, see utils.way_edges
+        geo -- GeoTransform of the city
+        o_dir -- output directory, the grid is written to o_dir/lookup_grid
+        cell_size -- side of a cell in meters
+        max_candidates -- cells needing more candidates fall back to the R-tree
+        ranks -- position of every edge in the order the R-tree returns
+                 them, see utils.rtree_order, defaults to id order
+
+        Returns:
+        dict of grid statistics
+    """
+    table = np.array(
+        [item[0] + item[1] + (item[2],) for item in edges], dtype=np.float64
+    ).reshape(-1, 5)
+    north1, east1 = geo.latlon_to_local(table[:, 0], table[:, 1])
+    north2, east2 = geo.latlon_to_local(table[:, 2], table[:, 3])
+    local = np.stack([north1, east1, north2, east2], axis=1)
+    ranks = np.arange(len(table)) if ranks is None else np.asarray(ranks)
+
+    height, width = geo.latlon_to_local(geo.maxlat, geo.maxlon)
+    rows = max(int(math.ceil(height / cell_size)), 1)
+    cols = max(int(math.ceil(width / cell_size)), 1)
+    cells = (rows, cols, cell_size)
+    half_diagonal = cell_size * math.sqrt(2) / 2
+    reach = SEARCH_RADIUS * (1 + SEARCH_SLACK) + half_diagonal
+    # the pairs of an edge grow with the square of reach / cell_size, so
+    # edges are taken in chunks of about PAIR_CHUNK pairs
+    boxes = cell_boxes(local, cells, reach)
+
+    # every edge that can be as close as the closest one must be in the
+    # R-tree box of every point, which holds when a point of its bounding
+    # box is within the box
+    limit = SEARCH_RADIUS * (1 - SEARCH_SLACK)
+
+    # smallest upper distance bound over every cell of the edges that can be
+    # within limit, inf where there is none
+    closest = np.full(rows * cols, np.inf)
+    reached = np.zeros(rows * cols, dtype=bool)
+    for start, stop in pair_chunks(boxes[3]):
+        i, j, edge = cell_edge_pairs(boxes, start, stop)
+        reached[i * cols + j] = True
+        near = pair_lower(local, i, j, edge, cell_size) <= limit
+        i, j, edge = i[near], j[near], edge[near]
+        np.minimum.at(closest, i * cols + j,
+                      pair_upper(table, i, j, edge, geo, cell_size))
+
+    # candidates in R-tree order of the cells that can be served
+    bound = closest * (1 + DIST_SLACK) + 1
+    servable = bound <= limit
+    found = []
+    for start, stop in pair_chunks(boxes[3]):
+        i, j, edge = cell_edge_pairs(boxes, start, stop)
+        cell = i * cols + j
+        keep = servable[cell]
+        cell, edge = cell[keep], edge[keep]
+        keep = pair_lower(local, i[keep], j[keep], edge, cell_size) <= \
+            bound[cell]
+        found.append((cell[keep].astype(np.int32),
+                      edge[keep].astype(np.int32)))
+    cell, edge = [np.concatenate(column) for column in zip(*found)] \
+        if found else [np.zeros(0, dtype=np.int32)] * 2
+    order = np.lexsort((ranks[edge], cell))
+    cell, edge = cell[order], edge[order]
+    count = np.bincount(cell, minlength=rows * cols)
+    rank = np.arange(len(cell)) - np.repeat(np.cumsum(count) - count, count)
+
+    served = servable & (count <= max_candidates) & (count > 0)
+    lists = np.full((np.sum(served), max_candidates), -1, dtype=np.int64)
+    keep = served[cell]
+    position = np.cumsum(served) - 1
+    lists[position[cell[keep]], rank[keep]] = edge[keep]
+    # cells along the same stretch of road share their list
+    rows_as_bytes = lists.view(np.dtype((np.void, lists.strides[0])))
+    _, first, inverse = np.unique(
+        rows_as_bytes.ravel(), return_index=True, return_inverse=True
+    )
+    unique = lists[first]
+
+    values = np.full(rows * cols, FALLBACK, dtype=np.int32)
+    values[~reached] = EMPTY
+    values[served] = inverse.ravel()
+    lengths = np.sum(unique >= 0, axis=1)
+    offsets = np.zeros(len(unique) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    candidates = unique[unique >= 0].astype(np.int32)
+
+    block_index, blocks = compress_blocks(values.reshape(rows, cols))
+
+    names = sorted(set(item[3] for item in edges))
+    name_ids = dict((name, pos) for pos, name in enumerate(names))
+    edge_names = np.array(
+        [name_ids[item[3]] for item in edges], dtype=np.int32
+    )
+
+    grid_dir = os.path.join(o_dir, GRID_DIR)
+    if not os.path.exists(grid_dir):
+        os.makedirs(grid_dir)
+    for name, array in [('block_index', block_index), ('blocks', blocks),
+                        ('offsets', offsets), ('candidates', candidates),
+                        ('edges', table), ('edge_names', edge_names)]:
+        np.save(os.path.join(grid_dir, name + '.npy'), array)
+    meta = {
+        'bounds': list(geo.bounds),
+        'cell_size': cell_size,
+        'rows': rows,
+        'cols': cols,
+        'block_size': BLOCK_SIZE,
+        'names': names,
+    }
+    json.dump(meta, open(os.path.join(grid_dir, 'meta.json'), 'w'))
+
+    return {
+        'cells': rows * cols,
+        'served': int(np.sum(values >= 0)),
+        'empty': int(np.sum(values == EMPTY)),
+        'fallback': int(np.sum(values == FALLBACK)),
+        'single': int(np.sum(served & (count == 1))),
+        'lists': len(unique),
+        'stored_blocks': len(blocks),
+        'blocks': block_index.size,
+    }
+
+
+def compress_blocks(values):
+    """ splits the cell values into BLOCK_SIZE square blocks
+
+        Returns:
+        (block_index, blocks) where block_index holds the position in blocks
+        of every stored block, or the value shared by all cells of a block
+        when that value is EMPTY or FALLBACK and the block is not stored
+    """
+    rows, cols = values.shape
+    b_rows = -(-rows // BLOCK_SIZE)
+    b_cols = -(-cols // BLOCK_SIZE)
+    padded = np.full(
+        (b_rows * BLOCK_SIZE, b_cols * BLOCK_SIZE), EMPTY, dtype=np.int32
+    )
+    padded[:rows, :cols] = values
+    tiles = padded.reshape(b_rows, BLOCK_SIZE, b_cols, BLOCK_SIZE) \
+        .swapaxes(1, 2).reshape(b_rows * b_cols, BLOCK_SIZE, BLOCK_SIZE)
+    first = tiles[:, 0, 0]
+    uniform = np.all(tiles == first[:, None, None], axis=(1, 2)) & (first < 0)
+
+    block_index = np.where(uniform, first, 0).astype(np.int32)
+    stored = np.flatnonzero(~uniform)
+    block_index[stored] = np.arange(len(stored))
+    return block_index.reshape(b_rows, b_cols), tiles[stored]
+
+
+class LookupGrid(object):
+    """ memory mapped lookup grid of one city, see build """
+
+    def __init__(self, grid_dir):
+        meta = json.load(open(os.path.join(grid_dir, 'meta.json')))
+        minlat, maxlat, minlon, maxlon = meta['bounds']
+        self.geo = GeoTransform(minlat, minlon, maxlat, maxlon, 1, 1)
+        self.cell_size = meta['cell_size']
+        self.rows, self.cols = meta['rows'], meta['cols']
+        self.block_size = meta['block_size']
+        self.names = meta['names']
+        for name in ['block_index', 'blocks', 'offsets', 'candidates',
+                     'edges', 'edge_names']:
+            setattr(self, name, np.load(
+                os.path.join(grid_dir, name + '.npy'), mmap_mode='r'
+            ))
+
+    def cell_values(self, lat, lon):
+        """ returns the value of the cells of lat lon arrays: the candidate
+            list number, EMPTY, or FALLBACK for points off the grid
+        """
+        north, east = self.geo.latlon_to_local(lat, lon)
+        shape = north.shape
+        north, east = north.ravel(), east.ravel()
+        i = np.floor(north / self.cell_size).astype(np.int64)
+        j = np.floor(east / self.cell_size).astype(np.int64)
+        inside = (i >= 0) & (i < self.rows) & (j >= 0) & (j < self.cols)
+        i, j = np.where(inside, i, 0), np.where(inside, j, 0)
+        block = np.asarray(
+            self.block_index[i // self.block_size, j // self.block_size]
+        )
+        values = np.where(block >= 0, 0, block)
+        stored = block >= 0
+        values[stored] = self.blocks[
+            block[stored], i[stored] % self.block_size,
+            j[stored] % self.block_size
+        ]
+        return np.where(inside, values, FALLBACK).reshape(shape)
+
+    def edge(self, edge_id):
+        """ edge in the form stored in the R-tree """
+        lat1, lon1, lat2, lon2, dist = self.edges[edge_id].tolist()
+        return ((lat1, lon1), (lat2, lon2), dist,
+                self.names[self.edge_names[edge_id]])
+
+    def cell_value(self, lat, lon):
+        """ cell_values for a single point, without the array overhead """
+        i = int(math.floor(
+            (lat - self.geo.minlat) * self.geo.m_per_lat / self.cell_size
+        ))
+        j = int(math.floor(
+            (lon - self.geo.minlon) * self.geo.m_per_lon / self.cell_size
+        ))
+        if not (0 <= i < self.rows and 0 <= j < self.cols):
+            return FALLBACK
+        value = int(self.block_index[i // self.block_size,
+                                     j // self.block_size])
+        if value >= 0:
+            value = int(self.blocks[value, i % self.block_size,
+                                    j % self.block_size])
+        return value
+
+    def candidate_edges(self, value):
+        """ returns the candidate edges of a cell value, [] when there is no
+            address and None when the R-tree has to answer
+        """
+        if value == EMPTY:
+            return []
+        if value == FALLBACK:
+            return None
+        start, end = self.offsets[value:value + 2].tolist()
+        return [self.edge(edge_id)
+                for edge_id in self.candidates[start:end].tolist()]
+
+    def lookup(self, lat, lon):
+        """ returns the candidate edges of a point, [] when there is no
+            address and None when the R-tree has to answer
+        """
+        return self.candidate_edges(self.cell_value(lat, lon))
+
+
+def load(path):
+    """ returns the lookup grid stored under path, None if it was not built,
+        grids are loaded once per process
+    """
+    if path not in _grids:
+        start = timer()
+        grid_dir = os.path.join(path, GRID_DIR)
+        _grids[path] = LookupGrid(grid_dir) \
+            if os.path.exists(os.path.join(grid_dir, 'meta.json')) else None
+        geocode_stats.STATS.load(path, 'lookup_grid', start)
+    return _grids[path]
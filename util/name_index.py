@@ -0,0 +1,218 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Sorted street and region names for robocode completion and validation
+
+    A robocode reads <meter><block>.<street>.<city>, for example
+    388A.NA12.city. Every city keeps its street names, with the length of
+    each street, and its region names in sorted lists, so that all names
+    starting with a prefix are one bisect away. A RobocodeIndex combines
+    the name indexes of any number of cities to complete partial robocodes
+    and to check full ones.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+import json
+import os
+from timeit import default_timer as timer
+from util import geocode_stats
+from util.utils import haversine
+
+
+INDEX_FILE = 'name_index.json'
+METER = 5  # meters per robocode meter
+LAST = '\uffff'  # sorts after every character of a name
+COMPLETIONS = 20
+
+_indexes = {}
+
+
+def street_region(street):
+    """ region of a street name, which is the region name and a number """
+    return street.rstrip('0123456789')
+
+
+def build(ways, nodes, o_dir):
+    """ writes the name index of the ways of a city and returns the number
+        of streets and regions
+
+        Keyword arguments:
+        ways -- ways as returned by utils.parse_roads
+        nodes -- nodes as returned by utils.parse_roads
+        o_dir -- output directory
+    """
+    lengths = {}
+    for w in ways:
+        nds = [nodes[nd] for nd in w[1]]
+        lengths[w[2]] = sum(haversine(n1, n2)
+                            for n1, n2 in zip(nds[:-1], nds[1:]))
+    streets = sorted(lengths)
+    regions = sorted(set(street_region(street) for street in streets))
+    with open(os.path.join(o_dir, INDEX_FILE), 'w') as f:
+        json.dump({'streets': streets,
+                   'lengths': [lengths[street] for street in streets],
+                   'regions': regions}, f)
+    return {'streets': len(streets), 'regions': len(regions)}
+
+
+def prefix_range(names, prefix):
+    """ slice of the sorted names that start with prefix """
+    return slice(bisect_left(names, prefix),
+                 bisect_left(names, prefix + LAST))
+
+
+def parse_meter_block(text):
+    """ splits the start of a robocode into (meter, block), None when it is
+        not of that form
+    """
+    if len(text) < 2 or not text[:-1].isdigit():
+        return None
+    return int(text[:-1]), text[-1]
+
+
+def parse(code):
+    """ splits a robocode into (meter, block, street, city), None when it is
+        not of that form
+    """
+    parts = code.split('.', 2)
+    meter_block = parse_meter_block(parts[0])
+    if len(parts) != 3 or meter_block is None:
+        return None
+    return meter_block + (parts[1].upper(), parts[2])
+
+
+class NameIndex(object):
+    """ street and region names of one city, see build """
+
+    def __init__(self, streets, lengths, regions):
+        self.streets = streets
+        self.lengths = lengths
+        self.regions = regions
+
+    def find_streets(self, prefix):
+        """ returns the streets starting with prefix, in order """
+        return self.streets[prefix_range(self.streets, prefix.upper())]
+
+    def find_regions(self, prefix):
+        """ returns the regions starting with prefix, in order """
+        return self.regions[prefix_range(self.regions, prefix.upper())]
+
+    def street_length(self, street):
+        """ length of a street in meters, None for unknown streets """
+        pos = bisect_left(self.streets, street)
+        if pos < len(self.streets) and self.streets[pos] == street:
+            return self.lengths[pos]
+        return None
+
+    def problem(self, meter, block, street):
+        """ returns why the address cannot be on this city's map, None when
+            it can
+        """
+        length = self.street_length(street)
+        if length is None:
+            return 'unknown street'
+        # the meter is rounded to the nearest even or odd number
+        if meter > length / METER + 2:
+            return 'meter past the end of the street'
+        # blocks count up from A with the distance to the street
+        if ord(block) < ord('A'):
+            return 'block out of range'
+        return None
+
+
+class RobocodeIndex(object):
+    """ robocode completion and validation over the name indexes of one or
+        more cities
+    """
+
+    def __init__(self, cities):
+        self.cities = cities
+        self.city_names = sorted(cities)
+
+    @classmethod
+    def load(cls, paths):
+        """ builds the index from a dict of city name to city data path """
+        return cls(dict((city, load(path)) for city, path in paths.items()))
+
+    def find_streets(self, prefix, limit=COMPLETIONS):
+        """ returns up to limit (street, city) pairs of the streets starting
+            with prefix, in order
+        """
+        found = []
+        for city in self.city_names:
+            found.extend((street, city) for street in
+                         self.cities[city].find_streets(prefix)[:limit])
+        return sorted(found)[:limit]
+
+    def complete(self, partial, limit=COMPLETIONS):
+        """ returns up to limit valid robocodes that start with partial, in
+            order
+
+            Keyword arguments:
+            partial -- start of a robocode that includes at least the meter,
+                       the block and the dot after them
+            limit -- largest number of robocodes returned
+        """
+        parts = partial.split('.', 2)
+        if len(parts) < 2:
+            return []
+        if parse_meter_block(parts[0]) is None:
+            return []
+        meter, block = parse_meter_block(parts[0])
+        street = parts[1].upper()
+        city_prefix = parts[2] if len(parts) == 3 else ''
+
+        codes = []
+        for city in self.city_names[prefix_range(self.city_names,
+                                                 city_prefix)]:
+            index = self.cities[city]
+            # a complete street name is the only candidate once the city
+            # has been started
+            streets = [street] if len(parts) == 3 else \
+                index.find_streets(street)
+            found = 0
+            for name in streets:
+                if found == limit:
+                    break
+                if index.problem(meter, block, name) is None:
+                    codes.append(parts[0] + '.' + name + '.' + city)
+                    found += 1
+        return sorted(codes)[:limit]
+
+    def check(self, codes):
+        """ returns for every robocode why it is not valid, None when it is """
+        problems = []
+        for code in codes:
+            address = parse(code)
+            if address is None:
+                problems.append('not a robocode')
+            elif address[3] not in self.cities:
+                problems.append('unknown city')
+            else:
+                problems.append(
+                    self.cities[address[3]].problem(*address[:3])
+                )
+        return problems
+
+
+def load(path):
+    """ returns the name index stored under path, indexes are loaded once
+        per process
+    """
+    if path not in _indexes:
+        start = timer()
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            stored = json.load(f)
+        _indexes[path] = NameIndex(stored['streets'], stored['lengths'],
+                                   stored['regions'])
+        geocode_stats.STATS.load(path, 'name_index', start)
+    return _indexes[path]
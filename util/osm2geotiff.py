@@ -17,33 +17,86 @@ import cv2
 import gdal
 import numpy as np
 from osgeo import osr
+from util import osm_pbf
 import xml.etree.ElementTree as ET
 
 
-def main(xml, out_fn):
+TILE_SIZE = 256
+LINE_THICKNESS = 2
+# 19584 pixels per 0.08789 degrees, about half a metre per pixel at the equator
+PIXELS_PER_DEGREE = 19584 / 0.08789
+
+
+def draw_tiles(segments, width, height, tile_size=TILE_SIZE):
+    """ draws road segments one tile at a time
+
+        Each segment is drawn on its own bounding box and copied into the
+        tiles it covers, so memory and work scale with the roads instead of
+        the image area. cv2.line clips lines to the image it draws on, which
+        moves their pixels, so the box is never clipped by anything but the
+        image border and the result matches drawing on the full image.
+
+        :param segments: list of (col1, row1, col2, row2) pixel segments
+        :param width: image width
+        :param height: image height
+        :param tile_size: tile width and height in pixels
+        :return: yields (col_off, row_off, tile) for every tile with roads
     """
+    tiles = {}
+    pad = LINE_THICKNESS + 1
+    for col1, row1, col2, row2 in segments:
+        left = max(min(col1, col2) - pad, 0)
+        right = min(max(col1, col2) + pad + 1, width)
+        top = max(min(row1, row2) - pad, 0)
+        bottom = min(max(row1, row2) + pad + 1, height)
+        if left >= right or top >= bottom:
+            continue
+
+        box = np.zeros((bottom - top, right - left), np.uint8)
+        cv2.line(box, (col1 - left, row1 - top), (col2 - left, row2 - top),
+                 255, LINE_THICKNESS)
+
+        for tile_row in range(top // tile_size, (bottom - 1) // tile_size + 1):
+            for tile_col in range(left // tile_size,
+                                  (right - 1) // tile_size + 1):
+                row_off, col_off = tile_row * tile_size, tile_col * tile_size
+                r0, r1 = max(top, row_off), min(bottom, row_off + tile_size)
+                c0, c1 = max(left, col_off), min(right, col_off + tile_size)
+                part = box[r0 - top:r1 - top, c0 - left:c1 - left]
+                if not part.any():
+                    continue
+                tile = tiles.get((tile_row, tile_col))
+                if tile is None:
+                    tile = tiles[(tile_row, tile_col)] = np.zeros(
+                        (min(tile_size, height - row_off),
+                         min(tile_size, width - col_off)), np.uint8)
+                view = tile[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+                np.maximum(view, part, out=view)
+
+    for tile_row, tile_col in sorted(tiles):
+        yield tile_col * tile_size, tile_row * tile_size, \
+            tiles[(tile_row, tile_col)]
+
+
+def read_xml(xml):
+    """
+    Reads the highway ways of an xml file
+
     :param xml: xml file (.osm extension)
-    :param out_fn: absolute path with .tif extn to write
-                   geotiff image
+    :return: (bounds, lat, lon, counts), bounds is (min_lat, min_lon,
+             max_lat, max_lon) of the bounds element or, without one, of
+             the way nodes, lat and lon hold the nodes of all ways in
+             order and counts the number of nodes of each way
     """
     tree = ET.parse(xml)
     root = tree.getroot()
 
-    bounds = root.find('bounds')
-    min_lat = float(bounds.get('minlat'))
-    min_lon = float(bounds.get('minlon'))
-    max_lat = float(bounds.get('maxlat'))
-    max_lon = float(bounds.get('maxlon'))
-
-    height = int((max_lat - min_lat) * 19584 / 0.08789)
-    width = int((max_lon - min_lon) * 19584 / 0.08789)
-    image = np.zeros((height, width), np.uint8)
-
     nodeInfo = {}
 
     for node in root.iter('node'):
         nodeInfo[node.get('id')] = [node.get('lat'), node.get('lon')]
 
+    lats, lons, counts = [], [], []
     for way in root.iter('way'):
         isHighway = 0
         for tag in way.findall('tag'):
@@ -52,26 +105,80 @@ def main(xml, out_fn):
 
         if (isHighway == 0):
             continue
-        last_pixel_col = None
-        last_pixel_row = None
-
-        for nd in way.findall('nd'):
-            nodeID = nd.get('ref')
-            node = nodeInfo[nodeID]
 
-            pixel_col = int((float(node[1]) - min_lon) / (max_lon - min_lon) * width)
-            pixel_row = int((max_lat - float(node[0])) / (max_lat - min_lat) * height)
+        nds = way.findall('nd')
+        for nd in nds:
+            node = nodeInfo[nd.get('ref')]
+            lats.append(float(node[0]))
+            lons.append(float(node[1]))
+        counts.append(len(nds))
 
-            if (last_pixel_row is not None and last_pixel_col is not None):
-                cv2.line(image, (pixel_col, pixel_row),
-                                    (last_pixel_col, last_pixel_row), 255, 2)
+    bounds = root.find('bounds')
+    if bounds is not None:
+        min_lat = float(bounds.get('minlat'))
+        min_lon = float(bounds.get('minlon'))
+        max_lat = float(bounds.get('maxlat'))
+        max_lon = float(bounds.get('maxlon'))
+    elif lats:
+        min_lat, min_lon = min(lats), min(lons)
+        max_lat, max_lon = max(lats), max(lons)
+    else:
+        raise ValueError('%s has no bounds and no highway ways' % xml)
+
+    return ((min_lat, min_lon, max_lat, max_lon), np.array(lats, np.float64),
+            np.array(lons, np.float64), np.array(counts, np.int64))
+
+
+def way_segments(lat, lon, counts, bounds, width, height):
+    """
+    Pixel segments between the consecutive nodes of every way
+
+    :param lat: latitudes of the nodes of all ways, in order
+    :param lon: longitudes of the nodes of all ways, in order
+    :param counts: number of nodes of each way
+    :param bounds: (min_lat, min_lon, max_lat, max_lon) of the image
+    :param width: image width
+    :param height: image height
+    :return: list of (col1, row1, col2, row2) pixel segments
+    """
+    min_lat, min_lon, max_lat, max_lon = bounds
+    # astype truncates towards zero like int()
+    pixel_col = ((lon - min_lon) / (max_lon - min_lon) * width
+                 ).astype(np.int64)
+    pixel_row = ((max_lat - lat) / (max_lat - min_lat) * height
+                 ).astype(np.int64)
+    way = np.repeat(np.arange(len(counts)), counts)
+    same_way = way[1:] == way[:-1]
+    return np.column_stack([pixel_col[1:], pixel_row[1:], pixel_col[:-1],
+                            pixel_row[:-1]])[same_way].tolist()
+
+
+def main(xml, out_fn, pixels_per_degree=PIXELS_PER_DEGREE, workers=None):
+    """
+    :param xml: xml file (.osm extension) or OSM PBF file (.osm.pbf)
+    :param out_fn: absolute path with .tif extn to write
+                   geotiff image
+    :param pixels_per_degree: resolution of the geotiff image
+    :param workers: number of worker processes decoding a PBF file,
+                    defaults to the cpu count
+    """
+    if xml.endswith('.pbf'):
+        bounds, lat, lon, counts = osm_pbf.read_highways(xml, workers)
+    else:
+        bounds, lat, lon, counts = read_xml(xml)
+    min_lat, min_lon, max_lat, max_lon = bounds
 
-            last_pixel_row = pixel_row
-            last_pixel_col = pixel_col
+    height = int((max_lat - min_lat) * pixels_per_degree)
+    width = int((max_lon - min_lon) * pixels_per_degree)
+    segments = way_segments(lat, lon, counts, bounds, width, height)
 
     driver_name = 'GTiff'
     driver = gdal.GetDriverByName(str(driver_name))
-    outRaster = driver.Create(out_fn, int(width), int(height), 1, gdal.GDT_Byte)
+    # tiles without roads compress to almost nothing and are never drawn
+    outRaster = driver.Create(out_fn, int(width), int(height), 1, gdal.GDT_Byte,
+                              options=['TILED=YES', 'COMPRESS=LZW',
+                                       'BLOCKXSIZE=%d' % TILE_SIZE,
+                                       'BLOCKYSIZE=%d' % TILE_SIZE])
     outRaster.SetGeoTransform((min_lon, (float)(max_lon - min_lon) / width, 0,
                                     max_lat, 0, (float)(min_lat - max_lat) / height))
 
@@ -80,5 +187,6 @@ def main(xml, out_fn):
     outRaster.SetProjection(outRasterSRS.ExportToWkt())
 
     outband = outRaster.GetRasterBand(1)
-    outband.WriteArray(image)
+    for col_off, row_off, tile in draw_tiles(segments, width, height):
+        outband.WriteArray(tile, col_off, row_off)
     outband.FlushCache()
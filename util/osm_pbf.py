@@ -0,0 +1,313 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Reads the highway ways of an OpenStreetMap .osm.pbf extract
+
+    A .osm.pbf file is a sequence of blobs, each a BlobHeader and a Blob
+    protocol buffer message. The first blob holds the header block with the
+    bounding box and every other one a zlib compressed primitive block of
+    nodes or ways. The blocks are decoded independently by a pool of worker
+    processes. Messages are walked field by field, while the packed ids and
+    coordinates of dense nodes and the node references of ways, which make
+    up most of a file, are varint and delta decoded with numpy. The format
+    is described at https://wiki.openstreetmap.org/wiki/PBF_Format.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from multiprocessing import Pool
+import numpy as np
+import struct
+import zlib
+
+
+HEADER_BLOB = 'OSMHeader'
+DATA_BLOB = 'OSMData'
+NANO = 1e9  # coordinates are stored in nanodegrees
+GRANULARITY = 100  # nanodegrees per coordinate unit unless a block says
+HIGHWAY = b'highway'
+
+
+def varint(buf, pos):
+    """ returns the varint of buf at pos and the position after it """
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value):
+    """ signed value of a zigzag encoded sint64 """
+    return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+    """ signed value of an int64, negative ones are 10 byte varints """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def fields(buf, start=0, end=None):
+    """ yields (field number, value) for the fields of the message in
+        buf[start:end], the value of a length delimited field is the
+        (start, end) slice of its bytes
+
+        Keyword arguments:
+        buf -- bytearray holding the message
+        start -- position of the first field
+        end -- position after the last field, defaults to the end of buf
+    """
+    pos = start
+    end = len(buf) if end is None else end
+    while pos < end:
+        # keys of the fields read here and most values are a single byte
+        key = buf[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = varint(buf, pos)
+        elif wire == 2:
+            size = buf[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size, pos = varint(buf, pos)
+            value = (pos, pos + size)
+            pos += size
+        elif wire == 1:
+            value = None
+            pos += 8
+        elif wire == 5:
+            value = None
+            pos += 4
+        else:
+            raise ValueError('unsupported protocol buffer wire type %d' % wire)
+        yield key >> 3, value
+
+
+def packed_varints(buf, start, end):
+    """ decodes the packed varints of buf[start:end] to a uint64 array """
+    raw = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start) \
+        if end > start else np.zeros(0, dtype=np.uint8)
+    if len(raw) and raw[-1] >= 0x80:
+        raise ValueError('truncated packed varints')
+    last = raw < 0x80
+    firsts = np.append(0, np.flatnonzero(last)[:-1] + 1)
+    # 7 bits per byte, the first byte holds the lowest bits
+    varint_of_byte = np.cumsum(last) - last
+    shift = (np.arange(len(raw)) - firsts[varint_of_byte]) * 7
+    bits = (raw & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    if not len(raw):
+        return bits
+    # the bits of a varint never overlap, so their sum is their union
+    return np.add.reduceat(bits, firsts)
+
+
+def zigzags(values):
+    """ zigzag of a uint64 array, as int64 """
+    return (values >> np.uint64(1)).astype(np.int64) ^ \
+        -(values & np.uint64(1)).astype(np.int64)
+
+
+def delta_ranges(values, counts):
+    """ cumulative sums of values restarting every counts values, which
+        undoes the delta coding of each of the runs
+    """
+    sums = np.cumsum(values)
+    firsts = np.cumsum(counts) - counts
+    return sums - np.repeat(sums[firsts] - values[firsts], counts)
+
+
+def blob_offsets(path):
+    """ returns (type, offset, size) of the Blob messages in the file """
+    blobs = []
+    with open(path, 'rb') as f:
+        while True:
+            length = f.read(4)
+            if not length:
+                return blobs
+            header = bytearray(f.read(struct.unpack('>I', length)[0]))
+            blob_type, size = None, 0
+            for number, value in fields(header):
+                if number == 1:
+                    blob_type = bytes(header[value[0]:value[1]]).decode()
+                elif number == 3:
+                    size = value
+            blobs.append((blob_type, f.tell(), size))
+            f.seek(size, 1)
+
+
+def read_blob(path, offset, size):
+    """ returns the uncompressed data of the Blob at offset """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        blob = bytearray(f.read(size))
+    for number, value in fields(blob):
+        if number == 1:
+            return blob[value[0]:value[1]]
+        if number == 3:
+            return bytearray(zlib.decompress(bytes(blob[value[0]:value[1]])))
+    raise ValueError('blob compression not supported, only raw and zlib are')
+
+
+def header_bounds(block):
+    """ returns (min_lat, min_lon, max_lat, max_lon) of the header block,
+        None when it has no bounding box
+    """
+    for number, value in fields(block):
+        if number == 1:
+            box = dict((field, zigzag(side) / NANO)
+                       for field, side in fields(block, *value))
+            # left, right, top and bottom
+            return box[4], box[1], box[3], box[2]
+    return None
+
+
+def dense_nodes(block, start, end, granularity, lat_offset, lon_offset):
+    """ returns the id, lat and lon arrays of a DenseNodes message, the
+        coordinates in nanodegrees
+    """
+    packed = {}
+    for number, value in fields(block, start, end):
+        if number in (1, 8, 9):
+            packed[number] = np.cumsum(zigzags(packed_varints(block, *value)))
+    ids = packed.get(1, np.zeros(0, dtype=np.int64))
+    return (ids, lat_offset + granularity * packed.get(8, ids[:0]),
+            lon_offset + granularity * packed.get(9, ids[:0]))
+
+
+def packed_keys(buf, start, end):
+    """ list of the packed uint32 varints of buf[start:end] """
+    keys, pos = [], start
+    while pos < end:
+        key, pos = varint(buf, pos)
+        keys.append(key)
+    return keys
+
+
+def decode_block(task):
+    """ returns the nodes and highway ways of a primitive block as
+        (ids, lat, lon, refs, counts) arrays, where the coordinates are in
+        nanodegrees, refs holds the node ids of all highway ways and counts
+        the number of nodes of each of them
+
+        Keyword arguments:
+        task -- (path, offset, size) of the Blob of the block
+    """
+    block = read_blob(*task)
+    strings, groups = [], []
+    granularity, lat_offset, lon_offset = GRANULARITY, 0, 0
+    for number, value in fields(block):
+        if number == 1:
+            strings = [bytes(block[start:end])
+                       for _, (start, end) in fields(block, *value)]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 19:
+            lat_offset = signed(value)
+        elif number == 20:
+            lon_offset = signed(value)
+    highway = strings.index(HIGHWAY) if HIGHWAY in strings else None
+
+    ids, lats, lons, ways = [], [], [], []
+    for group in groups:
+        for number, value in fields(block, *group):
+            if number == 1:
+                node = dict((field, zigzag(coord)) for field, coord in
+                            fields(block, *value) if field in (1, 8, 9))
+                ids.append(np.array([node[1]], dtype=np.int64))
+                lats.append(np.array([lat_offset + granularity * node[8]],
+                                     dtype=np.int64))
+                lons.append(np.array([lon_offset + granularity * node[9]],
+                                     dtype=np.int64))
+            elif number == 2:
+                dense = dense_nodes(block, value[0], value[1], granularity,
+                                    lat_offset, lon_offset)
+                ids.append(dense[0])
+                lats.append(dense[1])
+                lons.append(dense[2])
+            elif number == 3 and highway is not None:
+                keys, refs = None, None
+                for field, way_value in fields(block, *value):
+                    if field == 2:
+                        keys = way_value
+                    elif field == 8:
+                        refs = way_value
+                if keys is None or refs is None or refs[0] == refs[1]:
+                    continue
+                if highway in packed_keys(block, *keys):
+                    ways.append(refs)
+
+    # the refs of all ways are decoded at once, each way is delta coded
+    data = bytearray()
+    for start, end in ways:
+        data += block[start:end]
+    refs = zigzags(packed_varints(data, 0, len(data)))
+    sizes = np.array([end - start for start, end in ways], dtype=np.int64)
+    counts = np.add.reduceat(
+        np.frombuffer(data, dtype=np.uint8) < 0x80, np.cumsum(sizes) - sizes,
+        dtype=np.int64
+    ) if len(ways) else sizes
+    refs = delta_ranges(refs, counts)
+    empty = np.zeros(0, dtype=np.int64)
+    return (np.concatenate(ids or [empty]), np.concatenate(lats or [empty]),
+            np.concatenate(lons or [empty]), refs, counts)
+
+
+def read_highways(path, workers=None):
+    """ returns (bounds, lat, lon, counts) of the highway ways of a .osm.pbf
+        file, bounds is (min_lat, min_lon, max_lat, max_lon) of the header or
+        of the way nodes when the header has none, lat and lon hold the nodes
+        of all ways in order and counts the number of nodes of each way
+
+        Keyword arguments:
+        path -- path to the .osm.pbf file
+        workers -- number of worker processes (defaults to cpu count)
+    """
+    bounds = None
+    tasks = []
+    for blob_type, offset, size in blob_offsets(path):
+        if blob_type == HEADER_BLOB:
+            bounds = header_bounds(read_blob(path, offset, size))
+        elif blob_type == DATA_BLOB:
+            tasks.append((path, offset, size))
+
+    pool = Pool(workers)
+    try:
+        blocks = pool.map(decode_block, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    ids, lat, lon, refs, counts = [
+        np.concatenate([block[i] for block in blocks] or
+                       [np.zeros(0, dtype=np.int64)]) for i in range(5)
+    ]
+    del blocks
+    # extracts list nodes by id, so the ids are usually sorted already
+    if len(ids) > 1 and not (ids[1:] > ids[:-1]).all():
+        order = np.argsort(ids, kind='mergesort')
+        ids, lat, lon = ids[order], lat[order], lon[order]
+    pos = np.minimum(np.searchsorted(ids, refs), max(len(ids) - 1, 0))
+    if len(refs) and (not len(ids) or (ids[pos] != refs).any()):
+        raise ValueError('highway ways refer to nodes missing from %s' % path)
+    lat, lon = lat[pos] / NANO, lon[pos] / NANO
+    if bounds is None and len(lat):
+        bounds = tuple(float(side) for side in
+                       (lat.min(), lon.min(), lat.max(), lon.max()))
+    return bounds, lat, lon, counts
@@ -0,0 +1,356 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Resource estimates and execution settings for run_end2end
+
+    Before a stage runs, its input is inspected cheaply: the element counts
+    and bounds of an OSM file, or the size, road pixel density and road
+    width of a road raster read from a grid of sample windows. From these
+    the planner estimates the time and peak memory of every stage. It then
+    picks the settings the user left open so that the run fits a memory
+    budget on a number of cores: the resolution of a drawn OSM raster, the
+    segmentor scale and threads, and whether the intersection graph is
+    clustered whole or in spatial blocks by parallel workers.
+
+    The estimates multiply the inspected sizes with the per unit costs
+    below. The ingestion costs were measured on a synthetic extract of 2M
+    nodes and ways, the others are rough figures. They are meant to tell
+    a run that fits from one that is off by a large factor, not to
+    predict it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gdal
+import math
+import os
+import re
+from util import osm_pbf
+from util.utils import EARTH_RADIUS, GeoTransform
+
+
+MB = 1 << 20
+PIXEL_LIMIT = 1 << 30  # RoadConnectionLabelling refuses larger images
+ROAD_PIXEL_THRESHOLD = 30  # as in road_segmentation.h
+DEFAULT_SCALE = 0.5  # segmentor default, see road_segmentation.h
+SCALES = [0.5, 0.25, 0.125]  # down to the segmentor's MIN_IMAGE_SCALE
+BLOCK_SIZES = [8192, 4096, 2048, 1024, 512]  # cluster_block_size choices
+SAMPLE_WINDOWS = 8  # raster samples are a grid of 8 x 8 windows
+SAMPLE_SIZE = 256  # pixels on the side of a sample window
+SCAN_CHUNK = 1 << 24
+PBF_BLOCK_ENTITIES = 8000  # nodes or ways per PBF block, as osmium writes
+DRAWN_ROAD_WIDTH = 3  # pixels of a line of osm2geotiff.LINE_THICKNESS
+
+# per unit costs
+BASE_BYTES = 200 * MB  # interpreter with numpy, scipy, sklearn and gdal
+XML_BYTES_PER_ENTITY = 1100
+XML_SECONDS_PER_ENTITY = 8e-6
+PBF_BYTES_PER_ENTITY = 210
+PBF_SECONDS_PER_ENTITY = 1.3e-6  # per worker
+SEGMENT_BYTES_PER_PIXEL = 14  # working images per pixel after scaling
+SEGMENT_SECONDS_PER_PIXEL = 2e-8  # raster passes per pixel after scaling
+SEGMENT_SECONDS_PER_ROAD_PIXEL = 1e-6  # labelling per skeleton pixel
+LOAD_BYTES_PER_POINT = 60  # roads.json stream and RoadSet
+LOAD_SECONDS_PER_POINT = 2e-6
+NAMES_BYTES_PER_POINT = 150  # name_to_road, R-tree and lookup grid
+NAMES_SECONDS_PER_POINT = 2e-5
+JUNCTION_SPACING = 80  # meters of road between intersections
+ROADS_PER_JUNCTION = 1.5
+ROADS_PER_REGION = 88  # as py_pipeline.default_region_count
+EIGEN_BYTES = 32  # per node and eigenvector of the spectral embedding
+EIGEN_SECONDS = 2e-8  # per node and squared eigenvector count
+ROAD_METERS_PER_ENTITY = 10  # road drawn per node or way of an OSM file
+PEAK_CROWDING = 4  # road density of the densest window over the mean
+
+
+class Plan(object):
+    """ estimated stages of a run and the settings chosen for it """
+
+    def __init__(self, budget, cores):
+        self.budget = budget
+        self.cores = cores
+        self.settings = {}
+        self.stages = []
+        self.problems = []
+        self.warnings = []
+
+    def add_stage(self, name, seconds, peak):
+        self.stages.append((name, seconds, peak))
+        if peak > self.budget:
+            self.problems.append('%s needs about %.0f MB of the %.0f MB '
+                                 'budget' % (name, peak / MB,
+                                             self.budget / MB))
+
+    @property
+    def feasible(self):
+        return not self.problems
+
+    def log(self, logger, strict=True):
+        """ logs the settings and the estimate of every stage, the problems
+            as errors when strict and as warnings otherwise
+        """
+        for name, seconds, peak in self.stages:
+            logger.info('Plan: %s about %.0f s, peak %.0f MB', name, seconds,
+                        peak / MB)
+        for key in sorted(self.settings):
+            logger.info('Plan: %s = %s', key, self.settings[key])
+        for warning in self.warnings:
+            logger.warning('Plan: %s', warning)
+        for problem in self.problems:
+            (logger.error if strict else logger.warning)('Plan: %s', problem)
+
+
+def memory_budget():
+    """ physical memory of the machine in bytes """
+    return os.sysconf(str('SC_PAGE_SIZE')) * os.sysconf(str('SC_PHYS_PAGES'))
+
+
+def inspect_osm(path):
+    """ returns bounds (min_lat, min_lon, max_lat, max_lon) and the number
+        of nodes and ways of an .osm or .osm.pbf file. Xml files are
+        scanned for their elements, the blocks of PBF files are counted
+        and assumed full.
+    """
+    if path.endswith('.pbf'):
+        bounds, blocks = None, 0
+        for blob_type, offset, size in osm_pbf.blob_offsets(path):
+            if blob_type == osm_pbf.HEADER_BLOB:
+                bounds = osm_pbf.header_bounds(
+                    osm_pbf.read_blob(path, offset, size))
+            elif blob_type == osm_pbf.DATA_BLOB:
+                blocks += 1
+        return {'bounds': bounds, 'entities': blocks * PBF_BLOCK_ENTITIES,
+                'pbf': True}
+
+    bounds, entities, tail = None, 0, b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(SCAN_CHUNK)
+            if not chunk:
+                break
+            # an element name cut by the chunk boundary is counted once
+            text = tail + chunk
+            entities += text.count(b'<node') + text.count(b'<way') - \
+                tail.count(b'<node') - tail.count(b'<way')
+            tail = text[-4:]
+            if bounds is None:
+                found = re.search(br'<bounds([^>]*)>', text)
+                if found:
+                    sides = dict(re.findall(br'(\w+)="([^"]*)"',
+                                            found.group(1)))
+                    bounds = tuple(float(sides[side]) for side in (
+                        b'minlat', b'minlon', b'maxlat', b'maxlon'))
+    return {'bounds': bounds, 'entities': entities, 'pbf': False}
+
+
+def inspect_raster(path):
+    """ returns the size of a road raster, its meters per pixel and, from
+        a grid of sample windows, the share of road pixels over the whole
+        raster and in the densest window and the width of the roads in
+        pixels
+    """
+    ds = gdal.Open(path)
+    width, height = ds.RasterXSize, ds.RasterYSize
+    band = ds.GetRasterBand(1)
+    geo = GeoTransform.from_gdal(ds.GetGeoTransform(), width, height)
+
+    road = edges = sampled = 0
+    peak = 0.0
+    windows = min(SAMPLE_WINDOWS, max(width, height) // SAMPLE_SIZE + 1)
+    for i in range(windows):
+        for j in range(windows):
+            cols, rows = min(SAMPLE_SIZE, width), min(SAMPLE_SIZE, height)
+            col = int((i + 0.5) * width / windows - cols / 2)
+            row = int((j + 0.5) * height / windows - rows / 2)
+            col = min(max(col, 0), width - cols)
+            row = min(max(row, 0), height - rows)
+            mask = band.ReadAsArray(col, row, cols, rows) > \
+                ROAD_PIXEL_THRESHOLD
+            road += int(mask.sum())
+            # a road of width w and length l has w * l pixels and about
+            # 2 * l edge pixels
+            edges += int((mask[1:] != mask[:-1]).sum() +
+                         (mask[:, 1:] != mask[:, :-1]).sum())
+            sampled += mask.size
+            peak = max(peak, float(mask.mean()))
+    return {'width': width, 'height': height,
+            'meters_per_pixel': geo.m_per_lat * geo.x_range / height,
+            'density': road / max(sampled, 1), 'peak_density': peak,
+            'road_width': max(2.0 * road / edges, 1.0) if edges else 1.0}
+
+
+def estimate_raster(info, pixels_per_degree):
+    """ returns the raster osm2geotiff would draw from an OSM file in the
+        form of inspect_raster, estimated from its bounds and element count
+        without drawing it
+
+        Keyword arguments:
+        info -- see inspect_osm, with bounds
+        pixels_per_degree -- resolution of the raster
+    """
+    min_lat, min_lon, max_lat, max_lon = info['bounds']
+    width = max(int((max_lon - min_lon) * pixels_per_degree), 1)
+    height = max(int((max_lat - min_lat) * pixels_per_degree), 1)
+    meters_per_pixel = math.radians(1) * EARTH_RADIUS / pixels_per_degree
+    road_pixels = info['entities'] * ROAD_METERS_PER_ENTITY / \
+        meters_per_pixel * DRAWN_ROAD_WIDTH
+    density = min(road_pixels / (width * height), 1.0)
+    return {'width': width, 'height': height,
+            'meters_per_pixel': meters_per_pixel, 'density': density,
+            'peak_density': min(density * PEAK_CROWDING, 1.0),
+            'road_width': float(DRAWN_ROAD_WIDTH)}
+
+
+def plan_osm(info, budget, cores, pixels_per_degree, default_ppd,
+             scale=None):
+    """ plans drawing an OSM file and returns the Plan with the
+        pixels_per_degree and scale settings
+
+        The raster is drawn at default_ppd unless it would have more pixels
+        than the segmentor accepts, or hold more memory than the budget.
+        A lower resolution is then made up for by a larger segmentor scale,
+        so roads are segmented at the same resolution when possible.
+
+        Keyword arguments:
+        info -- see inspect_osm
+        budget -- memory budget in bytes
+        cores -- number of cores
+        pixels_per_degree -- resolution given by the user, or None
+        default_ppd -- resolution used when none is given
+        scale -- segmentor scale given by the user, or None
+    """
+    plan = Plan(budget, cores)
+    if info['pbf']:
+        ingest = info['entities'] * PBF_BYTES_PER_ENTITY
+        seconds = info['entities'] * PBF_SECONDS_PER_ENTITY / cores
+    else:
+        ingest = info['entities'] * XML_BYTES_PER_ENTITY
+        seconds = info['entities'] * XML_SECONDS_PER_ENTITY
+    if info['bounds'] is None:
+        # osm2geotiff takes the bounds of the roads, whose size is unknown
+        # until they are read
+        plan.warnings.append('the OSM file has no bounds, the raster size '
+                             'is not planned')
+        if pixels_per_degree is None:
+            plan.settings['pixels_per_degree'] = default_ppd
+        plan.add_stage('osm2geotiff', seconds, BASE_BYTES + ingest)
+        return plan
+    min_lat, min_lon, max_lat, max_lon = info['bounds']
+    area = max((max_lat - min_lat) * (max_lon - min_lon), 1e-12)
+
+    ppd = pixels_per_degree
+    if ppd is None:
+        # the road tiles are at most one byte per pixel, a budget the
+        # ingestion already exceeds is reported by its stage
+        fit = max(budget - BASE_BYTES - ingest, MB)
+        ppd = min(default_ppd, math.sqrt(min(PIXEL_LIMIT, fit) / area))
+        plan.settings['pixels_per_degree'] = ppd
+        if scale is None and ppd < default_ppd:
+            plan.settings['scale'] = min(1.0, DEFAULT_SCALE * default_ppd /
+                                         ppd)
+    pixels = area * ppd * ppd
+    if pixels > PIXEL_LIMIT:
+        plan.problems.append('the raster has %d pixels, more than the %d '
+                             'the segmentor accepts' % (pixels, PIXEL_LIMIT))
+    plan.add_stage('osm2geotiff', seconds, BASE_BYTES + ingest + pixels)
+    return plan
+
+
+def cluster_cost(nodes, roads):
+    """ (seconds, bytes) of the spectral embedding of a graph """
+    k = max(1.0, roads / ROADS_PER_REGION)
+    return EIGEN_SECONDS * nodes * k * k, EIGEN_BYTES * nodes * k
+
+
+def block_cost(info, nodes, roads, scaled_area, block_size):
+    """ returns the number of blocks with roads and the (seconds, bytes)
+        of clustering the fullest one, whose share of the nodes follows
+        the densest sample window of the raster
+    """
+    crowding = info['peak_density'] / max(info['density'], 1e-12)
+    share = min(1.0, block_size * block_size * crowding / scaled_area)
+    blocks = min(math.ceil(scaled_area / block_size ** 2),
+                 math.ceil(1 / share))
+    seconds, peak = cluster_cost(nodes * share, roads * share)
+    return int(blocks), seconds, peak
+
+
+def plan_raster(info, budget, cores, scale=None, threads=None,
+                block_size=None, workers=None):
+    """ plans segmenting and clustering a road raster and returns the Plan
+        with the scale, threads, cluster_block_size and workers settings
+
+        The segmentor keeps its default scale unless the budget needs a
+        smaller one. The intersection graph is clustered whole when its
+        embedding fits the budget, otherwise in the largest spatial blocks
+        that fit with as many workers as cores and memory allow.
+
+        Keyword arguments:
+        info -- see inspect_raster
+        budget -- memory budget in bytes
+        cores -- number of cores
+        scale, threads, block_size, workers -- settings given by the user,
+            or None to choose them
+    """
+    plan = Plan(budget, cores)
+    pixels = info['width'] * info['height']
+    road_pixels = pixels * info['density']
+    if pixels > PIXEL_LIMIT:
+        plan.problems.append('the raster has %d pixels, more than the %d '
+                             'the segmentor accepts' % (pixels, PIXEL_LIMIT))
+
+    def segment_cost(factor):
+        scaled = pixels * factor * factor
+        skeleton = road_pixels * factor / info['road_width']
+        seconds = (scaled * SEGMENT_SECONDS_PER_PIXEL +
+                   skeleton * SEGMENT_SECONDS_PER_ROAD_PIXEL) / cores
+        return seconds, BASE_BYTES + pixels + scaled * SEGMENT_BYTES_PER_PIXEL
+
+    # 'auto' picks a scale from the roads, estimated at the default
+    factor = DEFAULT_SCALE if scale in (None, 'auto') else float(scale)
+    if scale is None:
+        for factor in SCALES:
+            if segment_cost(factor)[1] <= budget:
+                break
+        plan.settings['scale'] = factor
+    if threads is None:
+        plan.settings['threads'] = cores
+    seconds, peak = segment_cost(factor)
+    plan.add_stage('road segmentation', seconds, peak)
+
+    points = road_pixels * factor / info['road_width']
+    load = BASE_BYTES + points * LOAD_BYTES_PER_POINT
+    plan.add_stage('loading roads', points * LOAD_SECONDS_PER_POINT, load)
+
+    road_meters = road_pixels / info['road_width'] * info['meters_per_pixel']
+    nodes = road_meters / JUNCTION_SPACING
+    roads = nodes * ROADS_PER_JUNCTION
+    seconds, embedding = cluster_cost(nodes, roads)
+    scaled_area = max(pixels * factor * factor, 1.0)
+    if block_size is None and load + embedding > budget:
+        for block_size in BLOCK_SIZES:
+            per_worker = block_cost(info, nodes, roads, scaled_area,
+                                    block_size)[2]
+            if load + per_worker <= budget:
+                break
+        plan.settings['cluster_block_size'] = block_size
+    if block_size is not None:
+        blocks, block_seconds, per_worker = block_cost(
+            info, nodes, roads, scaled_area, block_size)
+        count = workers or min(cores, blocks, max(
+            1, int((budget - load) // max(per_worker, 1))))
+        if workers is None:
+            plan.settings['workers'] = count
+        seconds = block_seconds * blocks / count
+        embedding = per_worker * count
+    plan.add_stage('region creation', seconds, load + embedding)
+    plan.add_stage('naming and R-tree', points * NAMES_SECONDS_PER_POINT,
+                   load + points * NAMES_BYTES_PER_POINT)
+    return plan
@@ -0,0 +1,347 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Vectorized round trip validation of a built city
+
+    Sample points spaced a few meters apart over the city bounds are
+    geocoded to robocodes and back to lat lon, a batch of rows at a time.
+    The forward step reproduces gen_robocode.get_address_city on the lookup
+    grid, with a callback for the points the grid leaves to the R-tree, and
+    the reverse step reproduces gen_robocode.get_lat_lon, so the report
+    describes the addresses users get.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import math
+import numpy as np
+import time
+from util import lookup_grid
+from util.edge_query import closest_points, haversines
+
+
+SPACING = 10  # meters between sample points
+BATCH = 65536  # sample points per batch
+FAR = 25  # meters, round trips landing farther away fail
+SPREAD = 50  # meters, one robocode at points farther apart is a collision
+TILE = 500  # meters, side of the tiles failures are counted in
+WORST_TILES = 10
+
+NO_ADDRESS = -1
+UNKNOWN_STREET = -3  # lookup_grid.FALLBACK is -2
+
+
+def py2_round(x):
+    """ round half away from zero, as python 2 rounds the robocode parts """
+    return np.where(x < 0, -np.floor(-x + 0.5), np.floor(x + 0.5))
+
+
+def address_parts(lat, lon, edges, dist, close_lat, close_lon):
+    """ returns (meter, block) arrays of gen_robocode.edge_address
+
+        Keyword arguments:
+        lat, lon -- arrays of the points
+        edges -- (N, 5) array of lat1, lon1, lat2, lon2, meters of the edge
+                 of every point
+        dist -- distance of every point to its edge
+        close_lat, close_lon -- closest point of the edge to every point
+    """
+    block = np.floor(py2_round(dist) / 5 + 65).astype(np.int64)
+    meter = (haversines(close_lat, close_lon, edges[:, 0], edges[:, 1]) +
+             edges[:, 4]) / 5
+    sign = (edges[:, 2] - edges[:, 0]) * (lon - edges[:, 3]) - \
+        (edges[:, 3] - edges[:, 1]) * (lat - edges[:, 2])
+    meter = 2 * py2_round(meter / 2) + (sign > 0)
+    return meter.astype(np.int64), block
+
+
+def closest_candidates(lat, lon, table):
+    """ returns (index, dist, close_lat, close_lon) arrays of the first
+        closest of the candidate edges of every point, as
+        gen_robocode.closest_address picks it
+
+        Keyword arguments:
+        lat, lon -- arrays of N points
+        table -- (N, C, 4) array of lat1, lon1, lat2, lon2 of C candidates
+                 per point, NaN for missing candidates
+    """
+    lat, lon = lat[:, None], lon[:, None]
+    lat1, lon1, lat2, lon2 = [table[..., i] for i in range(4)]
+    close_lat, close_lon = closest_points(lat, lon, lat1, lon1, lat2, lon2)
+    dist = haversines(close_lat, close_lon, lat, lon)
+    dist = np.where(np.isnan(dist), np.inf, dist)
+
+    best = np.argmin(dist, axis=1)
+    rows = np.arange(len(best))
+    return best, dist[rows, best], close_lat[rows, best], \
+        close_lon[rows, best]
+
+
+class Forward(object):
+    """ vectorized get_address_city on a lookup grid """
+
+    def __init__(self, grid, streets):
+        self.grid = grid
+        self.edges = np.asarray(grid.edges)
+        self.offsets = np.asarray(grid.offsets)
+        self.candidates = np.asarray(grid.candidates)
+        # street number of every edge, UNKNOWN_STREET when it has no road
+        numbers = np.array([streets.get(name, UNKNOWN_STREET)
+                            for name in grid.names], dtype=np.int64)
+        self.edge_streets = numbers[np.asarray(grid.edge_names)] \
+            if len(numbers) else np.zeros(0, dtype=np.int64)
+
+    def __call__(self, lat, lon):
+        """ returns (street, meter, block) arrays for lat lon arrays, street
+            is NO_ADDRESS for points without an address and
+            lookup_grid.FALLBACK for points the R-tree has to answer
+        """
+        values = self.grid.cell_values(lat, lon)
+        street = np.where(values == lookup_grid.EMPTY, NO_ADDRESS,
+                          lookup_grid.FALLBACK)
+        meter = np.zeros(len(lat), dtype=np.int64)
+        block = np.zeros(len(lat), dtype=np.int64)
+        served = np.nonzero(values >= 0)[0]
+        if not len(served):
+            return street, meter, block
+
+        start = self.offsets[values[served]]
+        count = self.offsets[values[served] + 1] - start
+        width = count.max()
+        slot = np.arange(width)
+        ids = np.where(slot < count[:, None], start[:, None] + slot, -1)
+        ids = np.where(ids >= 0, self.candidates[np.maximum(ids, 0)], -1)
+        table = np.where((ids >= 0)[..., None],
+                         self.edges[np.maximum(ids, 0), :4], np.nan)
+
+        best, dist, close_lat, close_lon = closest_candidates(
+            lat[served], lon[served], table
+        )
+        edge = ids[np.arange(len(served)), best]
+        meter[served], block[served] = address_parts(
+            lat[served], lon[served], self.edges[edge], dist, close_lat,
+            close_lon
+        )
+        street[served] = self.edge_streets[edge]
+        return street, meter, block
+
+
+class Reverse(object):
+    """ vectorized get_lat_lon over all roads of name_to_road """
+
+    def __init__(self, name_to_road, geo):
+        self.names = sorted(name_to_road)
+        roads = [np.asarray(name_to_road[name], dtype=np.int64)[:, :2]
+                 for name in self.names]
+        lengths = np.array([len(road) for road in roads], dtype=np.int64)
+        pixels = np.concatenate(roads) if roads else np.zeros((0, 2))
+        self.lat, self.lon = geo.pixel_to_latlon(pixels[:, 0], pixels[:, 1])
+        self.first = np.append(0, np.cumsum(lengths)[:-1])
+        self.last = self.first + lengths - 1
+
+        # robocode meters walked along the road at every road point, and
+        # the same for all roads one after the other, a meter apart
+        step = haversines(self.lat[:-1], self.lon[:-1], self.lat[1:],
+                          self.lon[1:]) / 5
+        step[self.last[:-1]] = 0
+        walked = np.append(0, np.cumsum(step))
+        self.walked = walked - walked[self.first].repeat(lengths)
+        self.base = np.append(0, np.cumsum(
+            self.walked[self.last][:-1] + 1
+        )) if len(roads) else np.zeros(0)
+        self.walked_global = self.walked + self.base.repeat(lengths)
+
+    def street_numbers(self):
+        """ dict of street name to street number """
+        return dict((name, i) for i, name in enumerate(self.names))
+
+    def __call__(self, street, meter, block):
+        """ returns lat lon arrays of robocodes given as street number, meter
+            and block arrays, NaN where get_lat_lon fails
+        """
+        # block.upper() only changes the ASCII letters
+        block = np.where((block >= 97) & (block <= 122), block - 32, block)
+        orth_dist = (block - 64.5) * 5
+
+        # the road point the walk stops at and the one after it
+        curr = np.searchsorted(self.walked_global,
+                               self.base[street] + meter, side='right') - 1
+        ended = curr >= self.last[street]
+        curr = np.minimum(curr, self.last[street])
+        nxt = np.where(ended, curr, curr + 1)
+        lat1, lon1 = self.lat[curr], self.lon[curr]
+        lat2, lon2 = self.lat[nxt], self.lon[nxt]
+        dist = meter - self.walked[curr]
+
+        # utils.point_dist_from_start
+        vec_lat, vec_lon = lat2 - lat1, lon2 - lon1
+        perp_lat, perp_lon = -vec_lon, vec_lat
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm1 = 5 * dist / haversines(lat1, lon1, lat2, lon2)
+            vec_lat, vec_lon = norm1 * vec_lat, norm1 * vec_lon
+            norm2 = orth_dist / haversines(vec_lat, vec_lon, perp_lat,
+                                           perp_lon)
+        perp_lat, perp_lon = norm2 * perp_lat, norm2 * perp_lon
+        side = np.where(meter % 2 != 0, 1, -1)
+        same = (lat1 == lat2) & (lon1 == lon2)
+        lat = np.where(same, lat1, lat1 + vec_lat + side * perp_lat)
+        lon = np.where(same, lon1, lon1 + vec_lon + side * perp_lon)
+
+        # a road of a single point has no segment to walk
+        single = self.first[street] == self.last[street]
+        return np.where(single, np.nan, lat), np.where(single, np.nan, lon)
+
+
+def sample_rows(geo, spacing):
+    """ yields (north, east, lat, lon) arrays of the sample points in whole
+        rows of about BATCH points, north and east in meters from the
+        south west corner
+    """
+    height, width = geo.latlon_to_local(geo.maxlat, geo.maxlon)
+    rows = int(math.ceil(height / spacing))
+    cols = int(math.ceil(width / spacing))
+    east = (np.arange(cols) + 0.5) * spacing
+    batch_rows = max(BATCH // max(cols, 1), 1)
+    for start in range(0, rows, batch_rows):
+        north = (np.arange(start, min(start + batch_rows, rows)) + 0.5) \
+            * spacing
+        north, east_grid = [a.ravel() for a in np.meshgrid(north, east,
+                                                           indexing='ij')]
+        lat, lon = geo.local_to_latlon(north, east_grid)
+        yield north, east_grid, lat, lon
+
+
+def validate(grid, name_to_road, geo, spacing=SPACING, fallback=None,
+             logger=None):
+    """ geocodes sample points to robocodes and back and returns a report of
+        the round trip errors
+
+        Keyword arguments:
+        grid -- lookup_grid.LookupGrid of the city
+        name_to_road -- dict of street name to road pixels
+        geo -- GeoTransform between the road pixels and lat lon
+        spacing -- meters between sample points
+        fallback -- called with the lat, lon of every point the grid leaves
+                    to the R-tree, returns (street name, meter, block) or
+                    None for no address, None to count such points only
+        logger -- logs progress once per batch when given
+    """
+    begin = time.time()
+    reverse = Reverse(name_to_road, geo)
+    streets = reverse.street_numbers()
+    forward = Forward(grid, streets)
+
+    counts = dict((key, 0) for key in [
+        'points', 'addressed', 'no_address', 'fallback', 'unanswered',
+        'unknown_street', 'failed_reverse', 'far'
+    ])
+    errors, keys, norths, easts, failed = [], [], [], [], []
+    for north, east, lat, lon in sample_rows(geo, spacing):
+        street, meter, block = forward(lat, lon)
+        for i in np.nonzero(street == lookup_grid.FALLBACK)[0].tolist():
+            counts['fallback'] += 1
+            answer = fallback(lat[i], lon[i]) if fallback else None
+            if fallback is None:
+                counts['unanswered'] += 1
+            elif answer is None:
+                street[i] = NO_ADDRESS
+            else:
+                street[i] = streets.get(answer[0], UNKNOWN_STREET)
+                meter[i], block[i] = answer[1], answer[2]
+
+        counts['points'] += len(lat)
+        counts['no_address'] += int((street == NO_ADDRESS).sum())
+        counts['unknown_street'] += int((street == UNKNOWN_STREET).sum())
+        ok = np.nonzero(street >= 0)[0]
+        counts['addressed'] += len(ok)
+        back_lat, back_lon = reverse(street[ok], meter[ok], block[ok])
+        error = haversines(lat[ok], lon[ok], back_lat, back_lon)
+        counts['failed_reverse'] += int(np.isnan(error).sum())
+        error = np.where(np.isnan(error), np.inf, error)
+        counts['far'] += int((error > FAR).sum())
+        errors.append(error.astype(np.float32))
+
+        # robocodes are collected to find the ones used far apart
+        keys.append((street[ok] << 32) | (meter[ok] << 9) |
+                    np.minimum(block[ok], 511))
+        norths.append(north[ok].astype(np.float32))
+        easts.append(east[ok].astype(np.float32))
+        bad = street != lookup_grid.FALLBACK
+        bad[ok[error <= FAR]] = False
+        failed.append(np.stack([north[bad], east[bad]], axis=1))
+        if logger is not None:
+            logger.info('Validated %d points', counts['points'])
+
+    report = dict(counts)
+    report['spacing'] = spacing
+    report['errors'] = error_percentiles(np.concatenate(errors)
+                                         if errors else np.zeros(0))
+    report['collisions'] = collisions(
+        np.concatenate(keys), np.concatenate(norths), np.concatenate(easts)
+    ) if keys else {'robocodes': 0, 'collisions': 0, 'max_spread': 0}
+    report['worst_tiles'] = worst_tiles(
+        np.concatenate(failed) if failed else np.zeros((0, 2)), geo, spacing
+    )
+    report['seconds'] = round(time.time() - begin, 1)
+    return report
+
+
+def error_percentiles(errors):
+    """ round trip error percentiles in meters, without failed reverses """
+    finite = errors[np.isfinite(errors)]
+    if not len(finite):
+        return {}
+    values = np.percentile(finite, [50, 90, 99, 100])
+    return dict(zip(['p50', 'p90', 'p99', 'max'],
+                    [round(float(v), 2) for v in values]))
+
+
+def collisions(keys, north, east):
+    """ counts the robocodes given to points more than SPREAD meters apart
+    """
+    order = np.argsort(keys, kind='mergesort')
+    keys, north, east = keys[order], north[order], east[order]
+    first = np.nonzero(np.append(True, keys[1:] != keys[:-1]))[0]
+    if not len(first):
+        return {'robocodes': 0, 'collisions': 0, 'max_spread': 0}
+    spread = np.hypot(
+        np.maximum.reduceat(north, first) - np.minimum.reduceat(north, first),
+        np.maximum.reduceat(east, first) - np.minimum.reduceat(east, first)
+    )
+    return {'robocodes': len(first),
+            'collisions': int((spread > SPREAD).sum()),
+            'max_spread': round(float(spread.max()), 1)}
+
+
+def worst_tiles(failed, geo, spacing):
+    """ returns the TILE sized tiles with the most failed sample points,
+        as bounds and the failed share of their points
+    """
+    tiles = np.floor(failed / TILE).astype(np.int64)
+    if not len(tiles):
+        return []
+    found, count = np.unique(tiles[:, 0] * (1 << 32) + tiles[:, 1],
+                             return_counts=True)
+    per_tile = (TILE / spacing) ** 2
+    worst = []
+    for pos in np.argsort(-count, kind='mergesort')[:WORST_TILES].tolist():
+        i, j = found[pos] >> 32, found[pos] & 0xffffffff
+        minlat, minlon = geo.local_to_latlon(i * TILE, j * TILE)
+        maxlat, maxlon = geo.local_to_latlon((i + 1) * TILE, (j + 1) * TILE)
+        worst.append({'bounds': [round(float(v), 6) for v in
+                                 [minlat, minlon, maxlat, maxlon]],
+                      'failed': round(min(count[pos] / per_tile, 1), 3)})
+    return worst
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
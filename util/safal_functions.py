@@ -13,9 +13,9 @@ from __future__ import unicode_literals
 
 from osgeo import gdal
 from region_creator import py_pipeline
+from util.utils import GeoTransform
 import sys
 import subprocess
-import resources
 
 class SAFAL(object):
     """
@@ -29,14 +29,19 @@ class SAFAL(object):
 
     # run road segmentation
     def RoadSegment(self):
-        segBin = self.args['roadSeg_bin'] + " "
         if self.args['input_tiff'] is not None:
-            pred_img = self.args['input_tiff'] + " "
+            pred_img = self.args['input_tiff']
         else:
-            pred_img = self.out_fn + " "
-        roadSegCommand = segBin + pred_img + self.out_dir
-        resources.setrlimit(resource.RLIMIT_STACK, resource.RLIM_INFINITY)
-        output = subprocess.call(['bash','-c', roadSegCommand])
+            pred_img = self.out_fn
+        # arguments are passed as a list, no shell parses them
+        roadSegCommand = [self.args['roadSeg_bin'], pred_img, self.out_dir]
+        if self.args.get('threads'):
+            roadSegCommand += ['--threads', str(self.args['threads'])]
+        if self.args.get('scale'):
+            roadSegCommand += ['--scale', str(self.args['scale'])]
+        if self.args.get('components'):
+            roadSegCommand.append('--components')
+        output = subprocess.call(roadSegCommand)
         if output != 0:
             self.logger.error('Road segmentation failed!')
             sys.exit(-1)
@@ -50,7 +55,9 @@ class SAFAL(object):
         o_dir = self.out_dir
         center_r = self.args['centre_row']
         center_c = self.args['centre_col']
-        ntr_json = py_pipeline.main(js_fn, o_dir, self.logger, center_r, center_c)
+        ntr_json = py_pipeline.main(js_fn, o_dir, self.logger, center_r, center_c,
+                                    block_size=self.args.get('cluster_block_size'),
+                                    workers=self.args.get('workers'))
         return ntr_json
 
     # Extract bounding box info from input geotiff image
@@ -66,9 +73,4 @@ class SAFAL(object):
             ds = gdal.Open(self.out_fn)
             width = ds.RasterXSize
             height = ds.RasterYSize
-        gt = ds.GetGeoTransform()
-        minlon = gt[0]
-        minlat = gt[3] + width * gt[4] + height * gt[5]
-        maxlon = gt[0] + width * gt[1] + height * gt[2]
-        maxlat = gt[3]
-        return(minlat, maxlat, minlon, maxlon)
+        return GeoTransform.from_gdal(ds.GetGeoTransform(), width, height).bounds
@@ -0,0 +1,345 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+""" Pool of persistent road segmentor processes
+
+    RoadConnectionLabelling --worker reads grayscale images from stdin and
+    writes the segmented roads of each to stdout, see
+    road_segmentor/src/worker_methods.cpp for the layout. A worker is started
+    once and then serves any number of tiles, so the process start, the
+    library loading and the roads.json round trip through the disk are paid
+    once per worker instead of once per tile. A SegmentorPool keeps a number
+    of workers running and hands every tile to the next idle one.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import cv2
+import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import os
+import struct
+import subprocess
+import threading
+
+
+WORKER_OK = 0
+WORKER_BAD_IMAGE = 1
+MAX_PIXELS = 1 << 30  # the segmentor refuses larger images
+JOB = struct.Struct('=2i')
+RESULT = struct.Struct('=7id')
+
+
+class SegmentorError(RuntimeError):
+    """ raised when a worker exits or answers with a broken result """
+
+
+def read_exactly(stream, size):
+    """ reads size bytes from stream, raises SegmentorError at its end """
+    data = stream.read(size) if size else b''
+    if len(data) != size:
+        raise SegmentorError('road segmentor worker exited')
+    return data
+
+
+def read_array(stream, dtype, count, width=1):
+    """ reads count rows of width values of dtype from stream """
+    dtype = np.dtype(dtype)
+    data = read_exactly(stream, dtype.itemsize * count * width)
+    return np.frombuffer(data, dtype=dtype).reshape(count, width)
+
+
+class SegmentorWorker(object):
+    """ one RoadConnectionLabelling --worker process """
+
+    def __init__(self, binary, threads=None, scale=None, components=False):
+        """
+        :param binary: path to RoadConnectionLabelling
+        :param threads: OpenCV threads of the worker, defaults to all cores
+        :param scale: resize factor or 'auto', defaults to the segmentor's
+        :param components: segment disconnected road networks separately
+        """
+        command = [binary, '--worker']
+        if threads:
+            command += ['--threads', str(threads)]
+        if scale:
+            command += ['--scale', str(scale)]
+        if components:
+            command.append('--components')
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    def segment(self, image):
+        """
+        Segments one image
+
+        :param image: 2d uint8 array of the grayscale road image, None
+                      for an image that could not be read
+        :return: dict with the roads, see read_result, None when the
+                 segmentor refuses the image
+        """
+        if image is None:
+            return None
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.ndim != 2:
+            raise ValueError('expected a 2d grayscale image')
+        # a job of 0 rows stops the worker
+        if not image.size or image.size > MAX_PIXELS:
+            return None
+        try:
+            self.process.stdin.write(JOB.pack(*image.shape))
+            self.process.stdin.write(image.tobytes())
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            raise SegmentorError('road segmentor worker exited')
+        return self.read_result()
+
+    def read_result(self):
+        """
+        :return: dict with img_meta (width, height and scale as in
+                 roads.json), counts (points of every road), points ([row,
+                 col] rows of all roads in order) and junction_graph (nodes
+                 and edges arrays as returned by road_loader.load_roads),
+                 None for a refused image
+        """
+        stream = self.process.stdout
+        header = RESULT.unpack(read_exactly(stream, RESULT.size))
+        status, rows, cols, roads, points, nodes, edges, scale = header
+        if status == WORKER_BAD_IMAGE:
+            return None
+        if status != WORKER_OK:
+            raise SegmentorError('unknown road segmentor status %d' % status)
+        return {
+            'img_meta': {'width': cols, 'height': rows, 'scale': scale},
+            'counts': read_array(stream, np.int32, roads)[:, 0],
+            'points': read_array(stream, np.int32, points, 2),
+            'junction_graph': {
+                'nodes': read_array(stream, np.int32, nodes, 2),
+                'edges': read_array(stream, np.float64, edges, 4),
+            },
+        }
+
+    def close(self):
+        """ asks the worker to stop and waits for it """
+        try:
+            self.process.stdin.write(JOB.pack(0, 0))
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        return self.process.wait()
+
+    def kill(self):
+        """ kills the worker, which may be blocked on a pipe, and waits for
+            it
+        """
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        return self.process.wait()
+
+
+def write_roads(result, js_fn):
+    """
+    Writes a worker result as the roads.json the segmentor writes
+
+    :param result: dict returned by SegmentorWorker.segment
+    :param js_fn: path of the roads.json to write
+    """
+    # as writeJSON, roads without points are left out and the last road
+    # of a shared pixel owns it
+    ends = np.cumsum(result['counts'])
+    points = np.column_stack([result['points'],
+                              np.zeros(len(result['points']), np.int32)])
+    id_road = {}
+    pixel_road = {}
+    for road, (start, end) in enumerate(zip((ends - result['counts'])
+                                            .tolist(), ends.tolist())):
+        if start == end:
+            continue
+        id_road[str(road)] = points[start:end].tolist()
+        for row, col, _ in id_road[str(road)]:
+            pixel_road['(%d, %d)' % (row, col)] = road
+    graph = result['junction_graph']
+    edges = [[int(a), int(b), length, int(road)] for a, b, length, road in
+             graph['edges'].tolist()]
+    with open(js_fn, 'w') as f:
+        json.dump({'id_road': id_road, 'pixel_road': pixel_road,
+                   'img_meta': result['img_meta'],
+                   'junction_graph': {'nodes': graph['nodes'].tolist(),
+                                      'edges': edges}},
+                  f, sort_keys=True, separators=(',', ':'))
+
+
+class SegmentorPool(object):
+    """ keeps a number of RoadConnectionLabelling --worker processes
+        running
+    """
+
+    def __init__(self, binary, workers=None, threads=None, scale=None,
+                 components=False):
+        """
+        :param binary: path to RoadConnectionLabelling
+        :param workers: number of worker processes, defaults to the cpu count
+        :param threads: OpenCV threads per worker, defaults to the cores
+                        divided among the workers
+        :param scale: resize factor or 'auto', defaults to the segmentor's
+        :param components: segment disconnected road networks separately
+        """
+        self.workers = workers or cpu_count()
+        threads = threads or max(1, cpu_count() // self.workers)
+        self.options = (binary, threads, scale, components)
+        self.idle = [SegmentorWorker(*self.options)
+                     for _ in range(self.workers)]
+        self.live = len(self.idle)
+        self.lock = threading.Condition()
+        # threads only wait on the pipes, the workers do the segmenting
+        self.threads = ThreadPool(self.workers)
+
+    def segment(self, image):
+        """ segments one image on the next idle worker, see
+            SegmentorWorker.segment. A worker that fails is killed and
+            replaced, the pool shrinks when the replacement cannot start.
+        """
+        with self.lock:
+            while not self.idle:
+                if not self.live:
+                    raise SegmentorError('no road segmentor worker left')
+                self.lock.wait()
+            worker = self.idle.pop()
+        try:
+            return worker.segment(image)
+        except SegmentorError:
+            worker.kill()
+            worker = None
+            raise
+        finally:
+            # a failed respawn must not replace the error of the worker
+            if worker is None:
+                worker = self.spawn()
+            with self.lock:
+                if worker is None:
+                    self.live -= 1
+                else:
+                    self.idle.append(worker)
+                self.lock.notify_all()
+
+    def spawn(self):
+        """ starts a worker, returns None when it cannot be started """
+        try:
+            return SegmentorWorker(*self.options)
+        except (OSError, SegmentorError):
+            return None
+
+    def segment_file(self, path):
+        """ segments the image at path, see segment """
+        return self.segment(cv2.imread(path, 0))
+
+    def imap(self, images):
+        """ segments images on all workers, yields the results in order
+
+            The images are all taken at once, see imap_files to segment
+            more images than fit in memory.
+        """
+        return self.threads.imap(self.segment, images)
+
+    def imap_files(self, paths):
+        """ segments the images at paths on all workers, yields the results
+            in order. Every image is read by the task that segments it, so
+            only the images being segmented are in memory.
+        """
+        return self.threads.imap(self.segment_file, paths)
+
+    def close(self):
+        """ stops the workers """
+        self.threads.close()
+        self.threads.join()
+        with self.lock:
+            for worker in self.idle:
+                worker.close()
+            self.idle = []
+
+
+def segment_tiles(binary, tiles, o_dir, workers=None, threads=None,
+                  scale=None, components=False):
+    """
+    Writes o_dir/<tile name>/roads.json for every tile
+
+    :param binary: path to RoadConnectionLabelling
+    :param tiles: paths of the road images
+    :param o_dir: output directory
+    :param workers: number of worker processes, defaults to the cpu count
+    :param threads: OpenCV threads per worker
+    :param scale: resize factor or 'auto'
+    :param components: segment disconnected road networks separately
+    :return: list of the tiles the segmentor refused
+    """
+    pool = SegmentorPool(binary, workers, threads, scale, components)
+    refused = []
+    try:
+        for tile, result in zip(tiles, pool.imap_files(tiles)):
+            if result is None:
+                refused.append(tile)
+                continue
+            tile_dir = os.path.join(
+                o_dir, os.path.splitext(os.path.basename(tile))[0]
+            )
+            if not os.path.exists(tile_dir):
+                os.makedirs(tile_dir)
+            write_roads(result, os.path.join(tile_dir, 'roads.json'))
+    finally:
+        pool.close()
+    return refused
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-bin', '--roadSeg_bin', required=True,
+        help='Binary for road segmentation'
+    )
+    ap.add_argument(
+        '-o_dir', '--out_dir', required=True,
+        help='Directory to save a roads.json per tile in'
+    )
+    ap.add_argument(
+        '-workers', '--workers', required=False, type=int,
+        help='Number of segmentor processes, defaults to the cpu count'
+    )
+    ap.add_argument(
+        '-threads', '--threads', required=False, type=int,
+        help='Threads of every segmentor process'
+    )
+    ap.add_argument(
+        '-scale', '--scale', required=False,
+        help='Resize factor in (0, 1] or auto'
+    )
+    ap.add_argument(
+        '-components', '--components', action='store_true',
+        help='Segment disconnected road networks separately'
+    )
+    ap.add_argument('tiles', nargs='+', help='Road images to segment')
+    args = vars(ap.parse_args())
+    refused = segment_tiles(args['roadSeg_bin'], args['tiles'],
+                            args['out_dir'], args['workers'],
+                            args['threads'], args['scale'],
+                            args['components'])
+    for tile in refused:
+        print('Refused by the segmentor, missing, too big or empty: %s'
+              % tile)
@@ -7,8 +7,11 @@
 
 import math
 import json
+import numpy as np
 from rtree import index
 
+EARTH_RADIUS = 6371e3 # Radius of earth in meters
+
 def haversine((lat1, lon1), (lat2, lon2)):
     """ great circle distance between lat lon points """
     lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
@@ -19,8 +22,7 @@ def haversine((lat1, lon1), (lat2, lon2)):
     a = math.sin(dlat / 2)**2 + math.cos(lat1) \
         * math.cos(lat2) * math.sin(dlon / 2)**2
     c = 2 * math.asin(math.sqrt(a))
-    r = 6371e3 # Radius of earth in meters
-    return c * r
+    return c * EARTH_RADIUS
 
 
 def on_segment((lat1, lon1), (lat2, lon2), (a, b)):
@@ -58,11 +60,10 @@ def get_closest_point((lat1, lon1), (lat2, lon2), (a, b)):
             return (lat2, lon2)
 
 
-def get_bounding_box(lat, lon):
+def get_bounding_box(lat, lon, half_side_in_km=.13):
     assert lat >= -90.0 and lat  <= 90.0
     assert lon >= -180.0 and lon <= 180.0
 
-    half_side_in_km = .13
     lat = math.radians(lat)
     lon = math.radians(lon)
 
@@ -80,22 +81,73 @@ def get_bounding_box(lat, lon):
             rad2deg(lat_max), rad2deg(lon_max)
 
 
-def convert(minlat, minlon, maxlat, maxlon, row, col):
-    """ converts x to lat and y to lon according """
-    minlat, minlon, maxlat, maxlon, row, col = \
-        float(minlat), float(minlon), float(maxlat), \
-        float(maxlon), int(row), int(col)
-    x_range = maxlat - minlat
-    y_range = maxlon - minlon
-
-    def x_to_lat(x):
-        return (((-x + row)* x_range) / float(row)) + minlat
+class GeoTransform(object):
+    """ maps raster pixels (x = row, y = col) to lat lon and back
 
-    def y_to_lon(y):
-        return ((y * y_range) / float(col)) + minlon
+        The transform is immutable once built, so one instance can be shared
+        by any number of threads. Every method takes scalars or arrays and
+        returns arrays of the same shape, converting a whole city in a single
+        numpy call.
+    """
 
-    convert.x_to_lat = x_to_lat
-    convert.y_to_lon = y_to_lon
+    def __init__(self, minlat, minlon, maxlat, maxlon, row, col):
+        self.minlat, self.minlon = float(minlat), float(minlon)
+        self.maxlat, self.maxlon = float(maxlat), float(maxlon)
+        self.row, self.col = int(row), int(col)
+        self.x_range = self.maxlat - self.minlat
+        self.y_range = self.maxlon - self.minlon
+        # equirectangular scale around the centre of the raster
+        mid_lat = math.radians((self.minlat + self.maxlat) / 2.0)
+        self.m_per_lat = math.radians(1) * EARTH_RADIUS
+        self.m_per_lon = self.m_per_lat * math.cos(mid_lat)
+
+    @classmethod
+    def from_gdal(cls, gt, width, height):
+        """ builds the transform from a north-up GDAL geotransform """
+        minlat = gt[3] + width * gt[4] + height * gt[5]
+        maxlon = gt[0] + width * gt[1] + height * gt[2]
+        return cls(minlat, gt[0], gt[3], maxlon, height, width)
+
+    @property
+    def bounds(self):
+        """ (minlat, maxlat, minlon, maxlon) of the raster """
+        return self.minlat, self.maxlat, self.minlon, self.maxlon
+
+    def x_to_lat(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return ((-x + self.row) * self.x_range) / self.row + self.minlat
+
+    def y_to_lon(self, y):
+        y = np.asarray(y, dtype=np.float64)
+        return (y * self.y_range) / self.col + self.minlon
+
+    def lat_to_x(self, lat):
+        lat = np.asarray(lat, dtype=np.float64)
+        return self.row - ((lat - self.minlat) * self.row) / self.x_range
+
+    def lon_to_y(self, lon):
+        lon = np.asarray(lon, dtype=np.float64)
+        return ((lon - self.minlon) * self.col) / self.y_range
+
+    def pixel_to_latlon(self, x, y):
+        """ converts pixel rows and cols to (lat, lon) arrays """
+        return self.x_to_lat(x), self.y_to_lon(y)
+
+    def latlon_to_pixel(self, lat, lon):
+        """ converts lat lons to fractional (x, y) pixel arrays """
+        return self.lat_to_x(lat), self.lon_to_y(lon)
+
+    def latlon_to_local(self, lat, lon):
+        """ converts lat lons to (north, east) meters from minlat, minlon """
+        return (np.asarray(lat, dtype=np.float64) - self.minlat) \
+            * self.m_per_lat, \
+            (np.asarray(lon, dtype=np.float64) - self.minlon) * self.m_per_lon
+
+    def local_to_latlon(self, north, east):
+        """ inverse of latlon_to_local """
+        return np.asarray(north, dtype=np.float64) / self.m_per_lat \
+            + self.minlat, \
+            np.asarray(east, dtype=np.float64) / self.m_per_lon + self.minlon
 
 
 def point_dist_from_start((lat1, lon1), (lat2, lon2), dist, orth_dist, odd):
@@ -149,23 +201,39 @@ def parse_roads(root):
     return nodes, ways
 
 
+def way_edges(ways, nodes):
+    """ yields (edge id, edge) for all edges of the given ways, where edge is
+        ((lat1, lon1), (lat2, lon2), meters along the way, way name)
+    """
+    iid = 0
+    for wi, w in enumerate(ways):
+        dist = 0
+        nds = w[1]
+        name = w[2]
+        for i in range(len(nds) - 1):
+            n1, n2 = nodes[nds[i]], nodes[nds[i + 1]]
+
+            if n1 != n2:
+                yield iid, ((n1[0], n1[1]), (n2[0], n2[1]), dist, name)
+                iid += 1
+                dist += haversine((n1[0], n1[1]), (n2[0], n2[1]))
+
+
 def rtree_for_way_edges(ways, nodes, o_dir):
         """ build an R-tree for all edges of the given ways """
         rtree_idx = index.Rtree(o_dir + '/' + 'rtree')
-        iid = 0
-        for wi, w in enumerate(ways):
-            dist = 0
-            nds = w[1]
-            name = w[2]
-            for i in range(len(nds) - 1):
-                n1, n2 = nodes[nds[i]], nodes[nds[i + 1]]
-
-                if n1 != n2:
-                    rtree_idx.insert(
-                        iid,
-                        bbox([n1, n2]),
-                        ((n1[0], n1[1]), (n2[0], n2[1]), dist, name)
-                    )
-                    iid += 1
-                    dist += haversine((n1[0], n1[1]), (n2[0], n2[1]))
+        for iid, edge in way_edges(ways, nodes):
+            rtree_idx.insert(iid, bbox(edge[:2]), edge)
         return rtree_idx
+
+
+def rtree_order(rtree_idx):
+    """ returns the position of every edge id in the order the R-tree returns
+        edges. The R-tree walks its nodes depth first in a fixed order, so
+        every query returns its edges in this relative order.
+    """
+    ids = np.array(list(rtree_idx.intersection(rtree_idx.bounds)),
+                   dtype=np.int64)
+    ranks = np.zeros(ids.max() + 1 if len(ids) else 0, dtype=np.int64)
+    ranks[ids] = np.arange(len(ids))
+    return ranks